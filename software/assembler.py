@@ -1,11 +1,28 @@
 #
-import argparse
+# Startup time matters for assembling small programs, so only the modules
+# needed to assemble are imported here, and the others where they are used.
+# The classes are written out rather than made dataclasses, which would
+# import `inspect`, and annotations are not evaluated, so that `typing` is
+# only imported by type checkers.
+from __future__ import annotations
+
+import array
+import codecs
+import io
+import mmap
+import os
 import re
 import sys
-from dataclasses import dataclass, field
+import time
+from contextlib import ExitStack, contextmanager
 from enum import Enum, auto
-from termcolor import colored
-from typing import *
+
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import (AbstractSet, Any, BinaryIO, Dict, Iterable, Iterator, List,
+                        Optional, Set, TextIO, Tuple, Union)
+
+    from objfile import ObjectFile
 
 
 # The different kinds of operands we support
@@ -13,12 +30,20 @@ class OperandKind(Enum):
     Imm = auto()
     Reg = auto()
     RegPair = auto()
+    Str = auto()
 
 # An instruction operand, like a register oder an immediate value.
-@dataclass
 class Operand:
-    kind: OperandKind
-    value: Any 
+    __slots__ = ("kind", "value")
+
+    def __init__(self, kind: OperandKind, value: Any):
+        self.kind = kind
+        self.value = value
+
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not Operand:
+            return NotImplemented
+        return self.kind == other.kind and self.value == other.value
 
     def __repr__(self) -> str:
         return f"{self.kind.name}:{self.value}"
@@ -39,16 +64,81 @@ class Opcode(Enum):
 
     # Assembler directives
     D_ORG = auto()
-    
+    D_WORD = auto()
+    D_INCLUDE = auto()
+    D_INCBIN = auto()
+    D_LABEL = auto()
+    D_SECTION = auto()
+    # Data directives, whose bytes are held in `Instruction.data`. A `.word`
+    # with a single value is a `D_WORD`, with several values a `D_WORDS`.
+    D_BYTE = auto()
+    D_WORDS = auto()
+    D_ASCII = auto()
+    D_FILL = auto()
+
+
+# The kinds of operands expected by each opcode
+OPERAND_KINDS: Dict[Opcode, Tuple[OperandKind, ...]] = {
+    Opcode.LDI: (OperandKind.Reg, OperandKind.Imm),
+    Opcode.MV: (OperandKind.Reg, OperandKind.Reg),
+    Opcode.JABSR: (OperandKind.RegPair,),
+    Opcode.JRELI: (OperandKind.Imm,),
+    Opcode.JRELR: (OperandKind.Reg,),
+    Opcode.NOP: (),
+    Opcode.HALT: (),
+    Opcode.D_ORG: (OperandKind.Imm,),
+    Opcode.D_WORD: (OperandKind.Imm,),
+    Opcode.D_INCLUDE: (OperandKind.Str,),
+    Opcode.D_INCBIN: (OperandKind.Str, OperandKind.Imm, OperandKind.Imm),
+    Opcode.D_LABEL: (OperandKind.Str,),
+    Opcode.D_SECTION: (OperandKind.Imm,),
+    Opcode.D_BYTE: (),
+    Opcode.D_WORDS: (),
+    Opcode.D_ASCII: (),
+    Opcode.D_FILL: (OperandKind.Imm, OperandKind.Imm),
+}
+
+# Opcodes whose bytes are placed into the binary as-is from `Instruction.data`
+DATA_OPCODES = (Opcode.D_INCBIN, Opcode.D_BYTE, Opcode.D_WORDS, Opcode.D_ASCII, Opcode.D_FILL)
+
+# Kinds of symbolic immediates: the low or high byte of the address of a
+# label, or the offset from the instruction to the label
+SYMBOL_KINDS = ("lo", "hi", "rel")
 
 
 # An assembly instruction, represented by its opcode and list of operands
-@dataclass
 class Instruction:
-    opcode: Opcode
-    operands: List[Operand] = field(default_factory=list)
-    address: Optional[int] = None
-    encoding: Optional[int] = None
+    __slots__ = ("opcode", "operands", "address", "encoding", "data", "file", "offset",
+                 "symbol")
+
+    def __init__(self, opcode: Opcode, operands: Optional[List[Operand]] = None,
+                 address: Optional[int] = None, encoding: Optional[int] = None,
+                 data: Optional[memoryview] = None, file: Optional[str] = None,
+                 offset: Optional[int] = None, symbol: Optional[Tuple[str, str]] = None):
+        self.opcode = opcode
+        self.operands = operands if operands is not None else []
+        self.address = address
+        self.encoding = encoding
+        # Raw bytes placed into the binary as-is, for `.incbin` and the data
+        # directives. Odd lengths are padded to a full word.
+        self.data = data
+        # Source file and character offset the instruction was parsed from
+        self.file = file
+        self.offset = offset
+        # The kind and label name of a symbolic immediate, like ("lo", "loop").
+        # The immediate operand holds the resolved value once encoded.
+        self.symbol = symbol
+
+    def __eq__(self, other) -> bool:
+        if other.__class__ is not Instruction:
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    # A copy of the instruction with the given fields changed.
+    def replace(self, **changes) -> Instruction:
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return Instruction(**fields)
 
     def __repr__(self) -> str:
         s = self.opcode.name
@@ -58,6 +148,7 @@ class Instruction:
 
 # Report an error and exit with an error code
 def error(message, *args):
+    from termcolor import colored
     sys.stderr.write(
         colored("error:", "red", attrs=["bold"]) + " " +
         colored(message, attrs=["bold"]) + "\n")
@@ -65,310 +156,1160 @@ def error(message, *args):
         if arg is None:
             continue
         elif isinstance(arg, Instruction):
+            if arg.file is not None:
+                sys.stderr.write(format_location(arg.file, arg.offset) + "\n")
             pretty = AssemblyPrinter([arg]).print()
             sys.stderr.write(pretty)
         else:
             sys.stderr.write(arg + "\n")
     sys.exit(1)
 
+# Source text parsed with `AssemblyParser.parse_source`, by file name, encoded
+# as UTF-8.
+source_texts: Dict[str, bytes] = {}
+
+# Format a byte offset into a source file as `file:line:column`.
+def format_location(file: str, offset: int) -> str:
+    if file in source_texts:
+        consumed_lines = source_texts[file][:offset].split(b"\n")
+    else:
+        with open(file, "rb") as f:
+            consumed_lines = f.read(offset).split(b"\n")
+    column = len(consumed_lines[-1].decode(errors="replace")) + 1
+    return f"{file}:{len(consumed_lines)}:{column}"
+
+
+# A compact representation of a program, which stores every instruction field
+# in a separate column array instead of individual `Instruction` objects. This
+# needs only a few bytes per instruction. `Instruction` objects are built on
+# demand when indexing or iterating over the program. Missing addresses and
+# encodings are stored as -1.
+class CompactProgram:
+    def __init__(self):
+        self.opcode = array.array('B')
+        self.operands = [array.array('i') for _ in range(3)]
+        self.address = array.array('i')
+        self.encoding = array.array('i')
+        self.file = array.array('H')
+        self.offset = array.array('L')
+        # Source file names referenced by the `file` column. Index 0 stands
+        # for instructions without a file.
+        self.files: List[Optional[str]] = [None]
+        self.file_indices: Dict[str, int] = {}
+        # Strings referenced by `Str` operands, and the indices of the
+        # instructions whose first operand is a `Str`
+        self.strings: List[str] = []
+        self.string_refs: List[int] = []
+        # Data of `.incbin` and data directives, by instruction index
+        self.data: Dict[int, memoryview] = {}
+        # Indices of all `.include` and `.incbin` directives
+        self.file_refs: List[int] = []
+        # Symbolic immediates, by instruction index
+        self.symbols: Dict[int, Tuple[str, str]] = {}
+        # Reusable instructions handed out by `view`, one per opcode
+        self.views: Dict[Opcode, Instruction] = {}
+
+    def __len__(self) -> int:
+        return len(self.opcode)
+
+    def __iter__(self) -> Iterator[Instruction]:
+        for index in range(len(self)):
+            yield self[index]
+
+    # Build an `Instruction` object for a single index, or a compact program
+    # holding a range of instructions for a slice.
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.slice(index)
+        inst = Instruction(Opcode(self.opcode[index]), [
+            Operand(kind, None)
+            for kind in OPERAND_KINDS[Opcode(self.opcode[index])]
+        ])
+        return self.load(index, inst)
+
+    def slice(self, index: slice) -> "CompactProgram":
+        start, stop, _ = index.indices(len(self))
+        program = CompactProgram()
+        if any(start <= i < stop for i in self.file_refs):
+            return program.extend(self[i] for i in range(start, stop))
+        program.opcode = self.opcode[start:stop]
+        program.operands = [column[start:stop] for column in self.operands]
+        program.address = self.address[start:stop]
+        program.encoding = self.encoding[start:stop]
+        program.file = self.file[start:stop]
+        program.offset = self.offset[start:stop]
+        program.files = list(self.files)
+        program.file_indices = dict(self.file_indices)
+        program.strings = list(self.strings)
+        program.string_refs = [i - start for i in self.string_refs if start <= i < stop]
+        program.symbols = {i - start: symbol for i, symbol in self.symbols.items()
+                           if start <= i < stop}
+        program.data = {i - start: data for i, data in self.data.items() if start <= i < stop}
+        return program
+
+    # Get a reusable `Instruction` object for the instruction at `index`. The
+    # object is only valid until the next call to `view`. Changes made to the
+    # instruction are only stored into the program by `update`.
+    def view(self, index: int) -> Instruction:
+        opcode = Opcode(self.opcode[index])
+        if (inst := self.views.get(opcode)) is None:
+            inst = self.views[opcode] = self[index]
+        return self.load(index, inst)
+
+    # Fill the fields of the instruction at `index` into `inst`.
+    def load(self, index: int, inst: Instruction) -> Instruction:
+        for operand, column in zip(inst.operands, self.operands):
+            operand.value = column[index]
+            if operand.kind == OperandKind.Str:
+                operand.value = self.strings[operand.value]
+        address = self.address[index]
+        encoding = self.encoding[index]
+        inst.address = None if address < 0 else address
+        inst.encoding = None if encoding < 0 else encoding
+        inst.data = self.data.get(index)
+        inst.symbol = self.symbols.get(index)
+        inst.file = self.files[self.file[index]]
+        inst.offset = self.offset[index]
+        return inst
+
+    # Store the address and encoding of `inst` for the instruction at `index`,
+    # and the resolved value of a symbolic immediate.
+    def update(self, index: int, inst: Instruction):
+        self.address[index] = -1 if inst.address is None else inst.address
+        self.encoding[index] = -1 if inst.encoding is None else inst.encoding
+        if inst.symbol is not None:
+            self.operands[len(inst.operands) - 1][index] = inst.operands[-1].value
+
+    def append(self, inst: Instruction):
+        index = len(self)
+        values = [0, 0, 0]
+        for i, operand in enumerate(inst.operands):
+            values[i] = operand.value
+            if operand.kind == OperandKind.Str:
+                values[i] = len(self.strings)
+                self.strings.append(operand.value)
+                self.string_refs.append(index)
+        for column, value in zip(self.operands, values):
+            try:
+                column.append(value)
+            except OverflowError:
+                error(f"immediate value {value} is out of bounds", inst)
+        self.opcode.append(inst.opcode.value)
+        self.address.append(-1 if inst.address is None else inst.address)
+        self.encoding.append(-1 if inst.encoding is None else inst.encoding)
+        self.file.append(self.file_index(inst.file))
+        self.offset.append(inst.offset or 0)
+        if inst.data is not None:
+            self.data[index] = inst.data
+        if inst.symbol is not None:
+            self.symbols[index] = inst.symbol
+        if inst.opcode in (Opcode.D_INCLUDE, Opcode.D_INCBIN):
+            self.file_refs.append(index)
+
+    # Append a sequence of instructions. The columns of another compact
+    # program are copied over directly.
+    def extend(self, program: Iterable[Instruction]) -> "CompactProgram":
+        if not isinstance(program, CompactProgram) or program.file_refs:
+            for inst in program:
+                self.append(inst)
+            return self
+        base = len(self)
+        self.symbols.update((base + i, symbol) for i, symbol in program.symbols.items())
+        self.data.update((base + i, data) for i, data in program.data.items())
+        self.opcode += program.opcode
+        for column, other in zip(self.operands, program.operands):
+            column += other
+        # `Str` operands index into the strings of the other program
+        string_base = len(self.strings)
+        self.strings += program.strings
+        for i in program.string_refs:
+            self.operands[0][base + i] += string_base
+            self.string_refs.append(base + i)
+        self.address += program.address
+        self.encoding += program.encoding
+        self.offset += program.offset
+        files = [self.file_index(file) for file in program.files]
+        if files == list(range(len(files))):
+            self.file += program.file
+        else:
+            self.file.extend(files[i] for i in program.file)
+        return self
+
+    # Get the index of a source file name in `files`, adding it if needed.
+    def file_index(self, file: Optional[str]) -> int:
+        if file is None:
+            return 0
+        if (index := self.file_indices.get(file)) is None:
+            index = self.file_indices[file] = len(self.files)
+            self.files.append(file)
+        return index
+
+
+# Wall time spent in a phase of the assembler and the number of items it
+# processed.
+class PhaseStatistics:
+    def __init__(self, name: str, seconds: float = 0.0, items: int = 0):
+        self.name = name
+        self.seconds = seconds
+        self.items = items
+
+# Statistics collected while assembling. Time spent in nested phases, such as
+# the stages of a streaming pipeline pulling from each other, is only
+# attributed to the innermost phase.
+class Statistics:
+    def __init__(self):
+        self.phases: Dict[str, PhaseStatistics] = {}
+        self.regex_calls = 0
+        self.bytes_written = 0
+        self.instructions_saved = 0
+        # Whether streamed phases should be timed per item
+        self.enabled = False
+        self.active: List[PhaseStatistics] = []
+        self.started = 0.0
+
+    def start(self, name: str) -> PhaseStatistics:
+        now = time.perf_counter()
+        if self.active:
+            self.active[-1].seconds += now - self.started
+        if (phase := self.phases.get(name)) is None:
+            phase = self.phases[name] = PhaseStatistics(name)
+        self.active.append(phase)
+        self.started = now
+        return phase
+
+    def stop(self):
+        now = time.perf_counter()
+        self.active.pop().seconds += now - self.started
+        self.started = now
+
+    # Time the enclosed block as phase `name`.
+    @contextmanager
+    def phase(self, name: str) -> Iterator[PhaseStatistics]:
+        phase = self.start(name)
+        try:
+            yield phase
+        finally:
+            self.stop()
+
+    # Time the production of every item of a stream as phase `name`, and
+    # count the items. Streams are passed through as-is if disabled.
+    def stream(self, name: str, items: Iterable[Any]) -> Iterator[Any]:
+        if not self.enabled:
+            yield from items
+            return
+        items = iter(items)
+        while True:
+            phase = self.start(name)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.stop()
+            phase.items += 1
+            yield item
+
+    def print_phases(self, file: TextIO = sys.stderr):
+        total = sum(phase.seconds for phase in self.phases.values())
+        file.write(f"{'phase':<16s}  {'time':>10s}  {'share':>6s}  {'items':>10s}\n")
+        for phase in self.phases.values():
+            share = phase.seconds / total * 100 if total > 0 else 0
+            file.write(f"{phase.name:<16s}  {phase.seconds*1000:8.2f}ms  "
+                       f"{share:5.1f}%  {phase.items:>10d}\n")
+        file.write(f"{'total':<16s}  {total*1000:8.2f}ms\n")
+
+    def print_counters(self, file: TextIO = sys.stderr):
+        file.write(f"{self.regex_calls:>10d}  regex calls\n")
+        file.write(f"{self.bytes_written:>10d}  bytes written\n")
+        file.write(f"{self.instructions_saved:>10d}  instructions saved by rewrites\n")
+
+stats = Statistics()
+
+
+# Whitespace and comments between tokens
+SKIP_PATTERN = r'(?:\s+|(?:#|//)[^\n]*|(?s:/\*.*?\*/))*'
+# An integer, like 42, -0x2a or 0b1010_1010
+INTEGER_PATTERN = r'[+-]?(?:0x[0-9a-fA-F_]+|0o[0-7_]+|0b[01_]+|[0-9_]+)\b'
+# Spaces and block comments within a line
+INLINE_SKIP_PATTERN = r'(?:[ \t]+|/\*[^\n]*?\*/)*'
+# A comma separated list of integers. Like every instruction, a list ends at
+# the end of its line, such that the language server can parse it line by
+# line.
+INTEGER_LIST_PATTERN = rf'{INTEGER_PATTERN}(?:{INLINE_SKIP_PATTERN},{INLINE_SKIP_PATTERN}{INTEGER_PATTERN})*'
+# The integers and comments of a list matched by `INTEGER_LIST_PATTERN`
+INTEGER_LIST_ITEMS = re.compile(rb'(?:#|//)[^\n]*|/\*.*?\*/|([^\s,]+)', re.S)
+
+INTEGER_BASES = {b"0x": 16, b"0o": 8, b"0b": 2}
+
+# Regular expressions of the parser, compiled to match bytes once when the
+# module is loaded
+SKIP = re.compile(SKIP_PATTERN.encode())
+LABEL = re.compile(rb'([A-Za-z_]\w*)\s*:')
+# The mnemonic of an instruction or the name of a directive
+MNEMONIC = re.compile(rb'\.?[A-Za-z_]\w*')
+SYMBOL_REFERENCE = re.compile(rb'(lo|hi)\(\s*([A-Za-z_]\w*)\s*\)')
+LABEL_REFERENCE = re.compile(rb'([A-Za-z_]\w*)\b')
+COMMA = re.compile(rb',')
+REGISTER = re.compile(rb'r([0-6])\b')
+REGISTER_PAIR = re.compile(rb'r([0-6])r([0-6])\b')
+SIGN = re.compile(rb'[+-]')
+BASE_PREFIX = re.compile(rb'0[xob]')
+DIGITS = {
+    2: re.compile(rb'[01_]+\b'),
+    8: re.compile(rb'[0-7_]+\b'),
+    10: re.compile(rb'[0-9_]+\b'),
+    16: re.compile(rb'[0-9a-fA-F_]+\b'),
+}
+INTEGER_START = re.compile(rb'(?=[+\-0-9])')
+INTEGER_LIST = re.compile(INTEGER_LIST_PATTERN.encode())
+QUOTED_STRING = re.compile(rb'"((?:[^"\\\n]|\\.)*)"')
+QUOTED_PATH = re.compile(rb'"([^"\n]*)"')
+
+# Convert an integer matched by `INTEGER_PATTERN` into its value.
+def parse_integer(token: bytes) -> int:
+    digits = token.lstrip(b"+-").replace(b"_", b"")
+    base = INTEGER_BASES.get(digits[:2], 10)
+    value = int(digits if base == 10 else digits[2:], base)
+    return -value if token.startswith(b"-") else value
+
+# Count the newlines in the first `end` bytes of a source file. The file is
+# looked at in slices, so a mapped file is not copied as a whole.
+def count_newlines(contents: Union[bytes, mmap.mmap], end: int) -> int:
+    step = 1 << 20
+    return sum(contents[i:min(i + step, end)].count(b"\n") for i in range(0, end, step))
+
+# Cache of the instructions parsed from each source file, keyed by the real
+# path of the file. The modification time and size of the file are stored
+# alongside, such that a changed file is parsed again.
+parse_cache: Dict[str, Tuple[Tuple[int, int], CompactProgram]] = {}
 
 # A parser that converts human-readable assembly text into a list of 'instruction' objects
-@dataclass
 class AssemblyParser:
-    program: List[Instruction] = field(default_factory=list)
-    # Abort with an error message.
+    def __init__(self, program: Optional[List[Instruction]] = None,
+                 included: Optional[Set[str]] = None, verbose: bool = False,
+                 cache: bool = True):
+        self.program = program if program is not None else []
+        # Real paths of all files parsed so far
+        self.included = included if included is not None else set()
+        # Print every instruction as it is parsed
+        self.verbose = verbose
+        # Keep the instructions of parsed files in `parse_cache`. Without the
+        # cache, the instructions of a file can become the program itself
+        # instead of being copied into it.
+        self.cache = cache
+
+    # Abort with an error message. Only the line of the error is decoded.
     def error(self, message):
-        consumed = len(self.current_contents) - len(self.current_input)
-        consumed_lines = self.current_contents[0:consumed].split("\n")
-        line_num = len(consumed_lines)
-        col_num = len(consumed_lines[-1])
-        remaining_line = self.current_input.split("\n")[0]
-        
+        contents, position = self.current_contents, self.position
+        line_start = contents.rfind(b"\n", 0, position) + 1
+        line_end = contents.find(b"\n", position)
+        if line_end < 0:
+            line_end = len(contents)
+        line_num = 1 + count_newlines(contents, line_start)
+        consumed = contents[line_start:position].decode(errors="replace")
+        remaining_line = contents[position:line_end].decode(errors="replace")
+        col_num = len(consumed)
+
         error(
             message,
             f"{self.current_file}:{line_num}:{col_num +1}",
             "",
-            f"  {consumed_lines[-1]}{remaining_line}",
+            f"  {consumed}{remaining_line}",
             f"  {' '*col_num}^"
         )
 
-    # Parse an entire assembly file.
+    # Parse an entire assembly file and append its instructions to the
+    # program, followed by the contents of any files it includes. A file that
+    # has already been parsed before is skipped.
     def parse_file(self, file: str):
+        path = os.path.realpath(file)
+        if path in self.included:
+            return
+        self.included.add(path)
+        tokens = self.tokenize_file(file)
+        if (not self.cache and not tokens.file_refs and
+                isinstance(self.program, CompactProgram) and len(self.program) == 0):
+            self.program = tokens
+            return
+        self.expand(tokens)
+
+    # Parse assembly source text as if it had been read from `file`, and append
+    # its instructions to the program.
+    def parse_source(self, source: str, file: str = "<input>"):
+        source_texts[file] = source.encode()
+        self.set_input(file, source_texts[file])
+        tokens = self.parse_program()
+        self.close_file()
+        self.expand(tokens)
+
+    # Append the instructions parsed from a file to the program, followed by
+    # the contents of any files it includes.
+    def expand(self, tokens: CompactProgram):
+        start = 0
+        for index in tokens.file_refs + [len(tokens)]:
+            self.program.extend(tokens if index - start == len(tokens) else tokens[start:index])
+            if index == len(tokens):
+                break
+            inst = tokens[index]
+            if inst.opcode == Opcode.D_INCBIN:
+                inst.data = map_binary_file(inst)
+            self.program.append(inst)
+            if inst.opcode == Opcode.D_INCLUDE:
+                self.parse_file(inst.operands[0].value)
+            start = index + 1
+
+    # Parse the instructions of a single file, without expanding includes.
+    # The result is cached, such that a file included from many places is
+    # only read and tokenized once.
+    def tokenize_file(self, file: str) -> CompactProgram:
+        path = os.path.realpath(file)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self.cache and (cached := parse_cache.get(path)) and cached[0] == key:
+            return cached[1]
+
+        self.open_file(file)
+        program = self.parse_program()
+        self.close_file()
+        if self.cache:
+            parse_cache[path] = (key, program)
+        return program
+
+    # Parse an assembly file and yield its instructions one by one, including
+    # the contents of any files it includes. Unlike `parse_file`, the
+    # instructions are neither added to the program nor cached.
+    def stream_file(self, file: str) -> Iterator[Instruction]:
+        path = os.path.realpath(file)
+        if path in self.included:
+            return
+        self.included.add(path)
+        self.open_file(file)
+        for inst in self.parse_instructions():
+            if inst.opcode == Opcode.D_INCBIN:
+                inst.data = map_binary_file(inst)
+            yield inst
+            if inst.opcode == Opcode.D_INCLUDE:
+                state = (self.current_file, self.current_contents, self.position)
+                yield from self.stream_file(inst.operands[0].value)
+                self.current_file, self.current_contents, self.position = state
+        self.close_file()
+
+    # Make the contents of a source file the current input of the parser.
+    def set_input(self, file: str, contents: Union[bytes, mmap.mmap]):
         self.current_file = file
-        with open(file, "r") as i:
-            self.current_input = i.read()
-            self.current_contents = self.current_input
-        self.parse_program()
-        self.current_file = None
-        self.current_input = None
-        self.current_contents = None
-
-    def parse_program(self):
+        self.current_contents = contents
+        self.position = 0
+
+    # Make a file the current input of the parser. The file is mapped into
+    # memory rather than read, and is never decoded as a whole.
+    def open_file(self, file: str):
+        with open(file, "rb") as i:
+            try:
+                contents = mmap.mmap(i.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files cannot be mapped
+                contents = b""
+        self.set_input(file, contents)
+
+    def close_file(self):
+        if isinstance(self.current_contents, mmap.mmap):
+            self.current_contents.close()
+        self.set_input(None, None)
+
+    def parse_program(self) -> CompactProgram:
+        program = CompactProgram()
+        for inst in self.parse_instructions():
+            program.append(inst)
+        return program
+
+    # Parse the current input and yield the instructions one by one.
+    def parse_instructions(self) -> Iterator[Instruction]:
         self.skip()
-        while len(self.current_input) > 0:
+        while self.position < len(self.current_contents):
+            offset = self.position
             inst = self.parse_instruction()
-            if args.print_assembly:
+            inst.file = self.current_file
+            inst.offset = offset
+            if self.verbose:
                 print(inst)
-            self.program.append(inst)
+            yield inst
         
     # Parse instruction
     def parse_instruction(self) -> Instruction:
+        # Labels
+        if m := self.consume_regex(LABEL):
+            return Instruction(Opcode.D_LABEL, [Operand(OperandKind.Str, m[1].decode())])
+
+        position = self.position
+        m = self.consume_regex(MNEMONIC)
+        mnemonic = m[0] if m else None
+
         # Actual instructions
-        if self.consume_identifier("nop"):
+        if mnemonic == b"nop":
             return Instruction(Opcode.NOP)
         
-        if self.consume_identifier("ldi"):
+        if mnemonic == b"ldi":
             rd = self.parse_register()
-            self.parse_regex(r',')
+            self.parse_regex(COMMA)
+            if m := self.consume_regex(SYMBOL_REFERENCE):
+                return Instruction(Opcode.LDI, [rd, Operand(OperandKind.Imm, 0)],
+                                   symbol=(m[1].decode(), m[2].decode()))
             imm = self.parse_immediate()
             return Instruction(Opcode.LDI, [rd, imm])
         
-        if self.consume_identifier("mv"):
+        if mnemonic == b"mv":
             rd = self.parse_register()
-            self.parse_regex(r',')
+            self.parse_regex(COMMA)
             rs = self.parse_register()
             return Instruction(Opcode.MV, [rd, rs])
         
-        if self.consume_identifier("jabsr"):
+        if mnemonic == b"jabsr":
             rs16 = self.parse_register_pair()
             return Instruction(Opcode.JABSR, [rs16])
 
-        if self.consume_identifier("jreli"):
+        if mnemonic == b"jreli":
+            if m := self.consume_regex(LABEL_REFERENCE):
+                return Instruction(Opcode.JRELI, [Operand(OperandKind.Imm, 0)],
+                                   symbol=("rel", m[1].decode()))
             imm = self.parse_immediate()
             return Instruction(Opcode.JRELI, [imm])
         
-        if self.consume_identifier("jrelr"):
+        if mnemonic == b"jrelr":
             rs = self.parse_register()
             return Instruction(Opcode.JRELR, [rs])
 
         # Pseudo-instructions
-        if self.consume_identifier("halt"):
+        if mnemonic == b"halt":
             return Instruction(Opcode.HALT)
 
         # Directions
-        if self.consume_identifier(r'\.org'):
+        if mnemonic == b".org":
             imm = self.parse_immediate()
             return Instruction(Opcode.D_ORG, [imm])
+
+        # A section that the linker places anywhere, at a multiple of the
+        # optional alignment
+        if mnemonic == b".section":
+            align = Operand(OperandKind.Imm, 1)
+            if self.consume_regex(INTEGER_START, skip=False):
+                align = self.parse_immediate()
+                if align.value < 1 or align.value & (align.value - 1):
+                    self.error(f"section alignment {align.value} is not a power of two")
+            return Instruction(Opcode.D_SECTION, [align])
+
+        if mnemonic == b".word":
+            position = self.position
+            imm = self.parse_immediate()
+            if not self.consume_regex(COMMA):
+                return Instruction(Opcode.D_WORD, [imm])
+            self.position = position
+            values = self.parse_integer_list(-2**15, 2**16)
+            data = array.array('H', [value & 0xFFFF for value in values])
+            if sys.byteorder != "little":
+                data.byteswap()
+            return Instruction(Opcode.D_WORDS, data=memoryview(data.tobytes()))
+
+        # Data directives go into the binary as a single slice of bytes, such
+        # that a large table is one instruction rather than one per word. The
+        # bytes of `.byte` and `.ascii` are packed into little-endian words.
+        if mnemonic == b".byte":
+            values = self.parse_integer_list(-2**7, 2**8)
+            return Instruction(Opcode.D_BYTE, data=memoryview(bytes(v & 0xFF for v in values)))
+
+        if mnemonic == b".ascii":
+            position = self.position
+            m = self.parse_regex(QUOTED_STRING, "expected a quoted string")
+            try:
+                text = codecs.escape_decode(m[1])[0]
+            except ValueError:
+                self.position = position
+                self.error("invalid escape sequence in string")
+            return Instruction(Opcode.D_ASCII, data=memoryview(text))
+
+        # Fill a number of words with the same value, zero by default
+        if mnemonic == b".fill":
+            position = self.position
+            count = self.parse_immediate()
+            if not 0 <= count.value <= 2**16:
+                self.position = position
+                self.error(f"fill count {count.value} is out of bounds")
+            value = Operand(OperandKind.Imm, 0)
+            if self.consume_regex(COMMA):
+                position = self.position
+                value = self.parse_immediate()
+                if not -2**15 <= value.value < 2**16:
+                    self.position = position
+                    self.error(f"fill value {value.value} is out of bounds")
+            data = (value.value & 0xFFFF).to_bytes(2, "little") * count.value
+            return Instruction(Opcode.D_FILL, [count, value], data=memoryview(data))
+
+        if mnemonic == b".include":
+            path = self.parse_path()
+            if not os.path.isfile(path.value):
+                # Report the directive, not the line after it
+                self.position = position
+                self.error(f"cannot find include file '{path.value}'")
+            return Instruction(Opcode.D_INCLUDE, [path])
+
+        if mnemonic == b".incbin":
+            # A length of -1 includes everything up to the end of the file
+            path = self.parse_path()
+            operands = [path, Operand(OperandKind.Imm, 0), Operand(OperandKind.Imm, -1)]
+            if self.consume_regex(COMMA):
+                operands[1] = self.parse_immediate()
+                if self.consume_regex(COMMA):
+                    operands[2] = self.parse_immediate()
+            return Instruction(Opcode.D_INCBIN, operands)
         
+        self.position = position
         self.error("unknown instruction")
 
     # Parse a register Operand like "r0".
     def parse_register(self) -> Operand:
-        idx = int(self.parse_regex(r'r([0-6])\b', "expected a register")[1])
+        idx = int(self.parse_regex(REGISTER, "expected a register")[1])
         return Operand(OperandKind.Reg, idx)
 
     # Parse a register pair, like r0r1
     def parse_register_pair(self) -> Operand:
-        m =self.parse_regex(r'r([0-6])r([0-6])\b', "expected a 16bit register pair")
+        m =self.parse_regex(REGISTER_PAIR, "expected a 16bit register pair")
         lo = int(m[1])
         hi = int(m[2])
         if hi != lo + 1:
-            self.error(f"Registers in 16bit must be conescutive {m[0]}")
+            self.error(f"Registers in 16bit must be conescutive {m[0].decode()}")
         return Operand(OperandKind.RegPair, lo)
     # Parse an immediate, like 42 or 0xbeef or 0b10101111
     def parse_immediate(self) -> Operand:
         negative = False
-        if m := self.consume_regex(r'[+-]', skip=False):
-            negative = m[0] == '-'
+        if m := self.consume_regex(SIGN, skip=False):
+            negative = m[0] == b'-'
         base = 10
-        digits = r'[0-9_]+\b'
-        if m := self.consume_regex(r'0[xob]', skip=False):
-            if m[0] == "0x":
-                base = 16
-                digits = r'[0-9a-fA-F_]+\b'
-            elif m[0] == "0o":
-                base = 8
-                digits = r'[0-7_]+\b'
-            elif m[0] == "0b":
-                base = 2
-                digits = r'[01_]+\b'
+        if m := self.consume_regex(BASE_PREFIX, skip=False):
+            base = INTEGER_BASES[m[0]]
             
-        value = self.parse_regex(digits, f"expected base-{base} integer")
-        value = int(value[0].replace("_", ""), base)
+        value = self.parse_regex(DIGITS[base], f"expected base-{base} integer")
+        value = int(value[0].replace(b"_", b""), base)
         if negative:
             value = -value
         return Operand(OperandKind.Imm, value)
 
-    # Skip over whitespace and comments.
+    # Parse a comma separated list of integers, like "1, 0x20, -3", and check
+    # that every value is at least `lower` and below `upper`. The whole list is
+    # matched at once, without creating an operand for every value.
+    def parse_integer_list(self, lower: int, upper: int) -> List[int]:
+        position = self.position
+        m = self.parse_regex(INTEGER_LIST, "expected a list of integers")
+        if COMMA.match(self.current_contents, self.position):
+            self.error("expected an integer; a list must end on the line it starts")
+        values = [parse_integer(token) for token in INTEGER_LIST_ITEMS.findall(m[0]) if token]
+        if not (lower <= min(values) and max(values) < upper):
+            value = min(values) if min(values) < lower else max(values)
+            self.position = position
+            self.error(f"value {value} is out of bounds [{lower}, {upper})")
+        return values
+
+    # Parse a quoted file path, like "lib/math.s". Relative paths are resolved
+    # relative to the directory of the file being parsed.
+    def parse_path(self) -> Operand:
+        m = self.parse_regex(QUOTED_PATH, "expected a quoted file path")
+        path = os.path.join(os.path.dirname(self.current_file), m[1].decode())
+        return Operand(OperandKind.Str, path)
+
+    # Skip over whitespace, single line comments (# or //) and multiline
+    # comments (/* ... */).
     def skip(self):
-        while True:
-            # skip whitespace
-            if self.consume_regex(r'\s+', skip=False):
-                continue
-            # skip single line comment ( # or //)
-            if self.consume_regex(r'(#|//).*[\n$]', skip=False):
-                continue
-            # skip multiline comment (/* ... +/)
-            if self.consume_regex(r'(?s)/\*.*\*/', skip=False):
-                continue
-            break
+        self.consume_regex(SKIP, skip=False)
+
     # if a regular expression matches at the current position in the input,
     # cosume the matched string and return the regex match object, if "skip" is 
-    # set to true, also skip over whitespace following the match.
-    def consume_regex(self, regex, skip: bool = True) -> Optional[re.Match]:
-        if m := re.match(regex, self.current_input):
-            self.current_input = self.current_input[len(m[0]):]
+    # set to true, also skip over whitespace following the match. The input is
+    # matched in place as bytes, so the groups of the match are bytes.
+    def consume_regex(self, regex: re.Pattern, skip: bool = True) -> Optional[re.Match]:
+        stats.regex_calls += 1
+        if m := regex.match(self.current_contents, self.position):
+            self.position = m.end()
             if skip:
                 self.skip()
             return m
         return None
 
     # Parse a regular expression. Print an error otherwise.
-    def parse_regex(self, regex, error_message: Optional[str] = None) -> re.Match:
+    def parse_regex(self, regex: re.Pattern, error_message: Optional[str] = None) -> re.Match:
         if m := self.consume_regex(regex):
             return m
-        self.error(error_message or f"expeted '{regex}'")
+        self.error(error_message or f"expeted '{regex.pattern.decode()}'")
 
-    # consume an identifier, like ldi or nop
-    def consume_identifier(self, identifier: str) -> bool:
-        if self.consume_regex(rf'{identifier}\b'):
-            return True
-        return False
 
 
 
+# Format a mnemonic padded to a fixed width, followed by placeholders for the
+# given number of operands.
+def opcode_template(mnemonic: str, num_operands: int) -> str:
+    return f"    {mnemonic:<7s}" + ", ".join(["{}"] * num_operands)
+
+# The format of each opcode in assembly text, with `{}` placeholders for the
+# operands.
+PRINT_TEMPLATES: Dict[Opcode, str] = {
+    # Actual instructions
+    Opcode.NOP: opcode_template("nop", 0),
+    Opcode.LDI: opcode_template("ldi", 2),
+    Opcode.MV: opcode_template("mv", 2),
+    Opcode.JABSR: opcode_template("jabsr", 1),
+    Opcode.JRELI: opcode_template("jreli", 1),
+    Opcode.JRELR: opcode_template("jrelr", 1),
+    # Pseudo-instructions
+    Opcode.HALT: opcode_template("halt", 0),
+    # Directives
+    Opcode.D_ORG: ".org {}",
+    Opcode.D_WORD: ".word {}",
+    Opcode.D_INCLUDE: ".include {}",
+    Opcode.D_INCBIN: ".incbin {}, {}, {}",
+    Opcode.D_LABEL: "{}:",
+    Opcode.D_SECTION: ".section {}",
+    Opcode.D_BYTE: ".byte {}",
+    Opcode.D_WORDS: ".word {}",
+    Opcode.D_ASCII: ".ascii {}",
+    Opcode.D_FILL: ".fill {}, {}",
+}
+
+# Number of bytes of data printed per line
+DATA_LINE_BYTES = 16
+
+# Characters escaped in `.ascii` strings
+ASCII_ESCAPES = {ord("\n"): "\\n", ord("\t"): "\\t", ord('"'): '\\"', ord("\\"): "\\\\"}
+
+# Format bytes as the contents of an `.ascii` string.
+def format_ascii(data: bytes) -> str:
+    return "".join(
+        ASCII_ESCAPES.get(b) or (chr(b) if 0x20 <= b < 0x7F else f"\\x{b:02x}")
+        for b in data
+    )
+
 
 # A printer that converts a list of "Instruction" objects into human-readable
 # assembly text.
-@dataclass
 class AssemblyPrinter:
-    program: List[Instruction]
+    def __init__(self, program: Iterable[Instruction], emit_address: Optional[bool] = None,
+                 emit_encoding: Optional[bool] = None, buffer_lines: int = 4096):
+        self.program = program
+        # Whether to print address and encoding columns; determined from the
+        # program if not set
+        self.emit_address = emit_address
+        self.emit_encoding = emit_encoding
+        # Number of lines collected before they are written out
+        self.buffer_lines = buffer_lines
 
     def print(self) -> str:
-        self.emit_address = any(i.address is not None for i in self.program)
-        self.emit_encoding = any(i.encoding is not None for i in self.program)
-        self.output = ""
-        for i in self.program:
-            self.print_instruction(i)
-            self.emit("\n")
-        s = self.output
-        self.output = None
-        return s
-    
-    def print_instruction(self, inst: Instruction):
-        # Print the address prefix
-        if self.emit_address:
-            address = "????"
-            if inst.address is not None:
-                address = f"{inst.address:04X}"
-            self.emit(f"{address}:   ")
+        output = io.StringIO()
+        self.write(output)
+        return output.getvalue()
+
+    # Write the program to a text stream. Lines are written in chunks as the
+    # program is printed, rather than building the entire text in memory.
+    def write(self, file: TextIO):
+        if self.emit_address is None:
+            self.emit_address = any(i.address is not None for i in self.program)
+        if self.emit_encoding is None:
+            self.emit_encoding = any(i.encoding is not None for i in self.program)
+        self.start(file)
+        for inst in self.program:
+            self.write_instruction(inst)
+        self.flush()
+
+    # Start writing individual instructions to a text stream.
+    def start(self, file: TextIO):
+        self.file = file
+        self.lines = []
+
+    def write_instruction(self, inst: Instruction):
+        self.lines.append(self.format_instruction(inst))
+        if len(self.lines) >= self.buffer_lines:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append("")
+            self.file.write("\n".join(self.lines))
+            self.lines.clear()
+
+    def format_instruction(self, inst: Instruction) -> str:
+        if inst.opcode in (Opcode.D_BYTE, Opcode.D_WORDS, Opcode.D_ASCII):
+            return self.format_data(inst)
+        prefix = self.format_prefix(inst.address)
 
         # Print the instruction encoding
         if self.emit_encoding:
             encoding = "    "
             if inst.encoding is not None:
                 encoding = f"{inst.encoding:04X}"
-            self.emit(f"{encoding}  ")
-        # Actual instructions   
-        if inst.opcode == Opcode.NOP:
-            self.print_opcode("nop")
-            return
-        
-        if inst.opcode == Opcode.LDI:
-            self.print_opcode("ldi ")
-            self.print_operand(inst.operands[0])
-            self.emit(", ")
-            self.print_operand(inst.operands[1])
-            return
+            prefix += f"{encoding}  "
 
-        if inst.opcode == Opcode.MV:
-            self.print_opcode("mv ")
-            self.print_operand(inst.operands[0])
-            self.emit(", ")
-            self.print_operand(inst.operands[1])
-            return
+        template = PRINT_TEMPLATES.get(inst.opcode)
+        if template is None:
+            return f"{prefix}<{inst}"
+        if inst.opcode == Opcode.D_LABEL:
+            return prefix + template.format(inst.operands[0].value)
+        operands = [self.format_operand(op) for op in inst.operands]
 
-        if inst.opcode == Opcode.JABSR:
-            self.print_opcode("jabsr ")
-            self.print_operand(inst.operands[0])
-            return
+        if inst.symbol is not None:
+            kind, name = inst.symbol
+            operands[-1] = name if kind == "rel" else f"{kind}({name})"
+            return prefix + template.format(*operands)
 
         if inst.opcode == Opcode.JRELI:
-            self.print_opcode("jreli ")
-            self.print_operand(inst.operands[0], hint_relative=True)
+            operands[0] = self.format_operand(inst.operands[0], hint_relative=True)
             if inst.address is not None:
                 target_addr = inst.address + inst.operands[0].value
-                self.emit(f"  # {target_addr:04X}")
-            return
-              
-        if inst.opcode == Opcode.JRELR:
-            self.print_opcode("jrelr ")
-            self.print_operand(inst.operands[0])
-            return
-        
-        # pseudo-instructions
-        if inst.opcode == Opcode.HALT:
-            self.print_opcode("halt ")
-            return
-        
-        # directives
-        if inst.opcode == Opcode.D_ORG:
-            self.emit(".org ")
-            self.print_operand(inst.operands[0], hint_addr=True)
-            return
+                return f"{prefix}{template.format(*operands)}  # {target_addr:04X}"
 
-        self.emit(f"<{inst}")
-        
+        if inst.opcode in (Opcode.D_ORG, Opcode.D_WORD) and inst.operands[0].value >= 0:
+            operands[0] = self.format_operand(inst.operands[0], hint_addr=True)
+        if inst.opcode == Opcode.D_FILL and inst.operands[1].value >= 0:
+            operands[1] = self.format_operand(inst.operands[1], hint_addr=True)
 
-    def print_opcode(self, text: str):
-        self.emit(f"    {text:<7s}") # der Opcode wird mit mit whitspaces aufgefüllt, left alingned, also Opcode + " " bis es 7 chars sind
-    
-    def print_operand(self, operand: Operand, 
-                      hint_relative: bool = False,
-                      hint_addr=False
-                      ):
+        return prefix + template.format(*operands)
+
+    # Print the address prefix
+    def format_prefix(self, address: Optional[int]) -> str:
+        prefix = ""
+        if self.emit_address:
+            prefix += "????:   " if address is None else f"{address:04X}:   "
+        return prefix
+
+    # Format a data directive as one line per `DATA_LINE_BYTES` bytes, each
+    # with the address of its first word. Every line is a directive of its
+    # own, and an even number of bytes except for the last, so the listing
+    # assembles into the same binary.
+    def format_data(self, inst: Instruction) -> str:
+        template = PRINT_TEMPLATES[inst.opcode]
+        lines = []
+        for start in range(0, max(len(inst.data), 1), DATA_LINE_BYTES):
+            data = bytes(inst.data[start:start + DATA_LINE_BYTES])
+            address = None if inst.address is None else inst.address + start // 2
+            prefix = self.format_prefix(address) + (" " * 6 if self.emit_encoding else "")
+            if inst.opcode == Opcode.D_BYTE:
+                values = ", ".join(f"0x{b:02X}" for b in data)
+            elif inst.opcode == Opcode.D_WORDS:
+                values = ", ".join(f"0x{w:04X}" for w in
+                                   (int.from_bytes(data[i:i + 2], "little")
+                                    for i in range(0, len(data), 2)))
+            else:
+                values = f'"{format_ascii(data)}"'
+            lines.append(prefix + template.format(values))
+        return "\n".join(lines)
+
+    def format_operand(self, operand: Operand, 
+                       hint_relative: bool = False,
+                       hint_addr=False
+                       ) -> str:
         if operand.kind == OperandKind.Imm:
             if hint_addr:
-                self.emit(f"0x{operand.value:04X}")
+                return f"0x{operand.value:04X}"
             elif operand.value >= 0 and hint_relative:
-                self.emit(f"+{operand.value}")
+                return f"+{operand.value}"
             else:
-                self.emit(f"{operand.value}")
+                return f"{operand.value}"
         elif operand.kind == OperandKind.Reg:
-            self.emit(f"r{operand.value}")
+            return f"r{operand.value}"
         elif operand.kind == OperandKind.RegPair:
-            self.emit(f"r{operand.value}r{operand.value + 1}")
+            return f"r{operand.value}r{operand.value + 1}"
+        elif operand.kind == OperandKind.Str:
+            return f'"{operand.value}"'
+        return repr(operand)
 
 
-    def emit(self, text: str):
-        self.output += text
+# The canonical form of a sequence of `ldi` and `mv` instructions, given as
+# (mnemonic, operand, operand) tuples, in which registers and immediates are
+# renumbered in the order they first appear. The CPU has no arithmetic, so
+# sequences with the same canonical form do the same to their registers.
+# Returns the form as text, like "ldi r0, 0; mv r1, r0", and the original
+# registers and immediates in the order of their new numbers.
+def canonical_sequence(sequence: Iterable[Tuple[str, int, int]]
+                       ) -> Tuple[str, List[int], List[int]]:
+    registers: Dict[int, int] = {}
+    immediates: Dict[int, int] = {}
+    parts = []
+    for mnemonic, a, b in sequence:
+        rd = registers.setdefault(a, len(registers))
+        if mnemonic == "ldi":
+            parts.append(f"ldi r{rd}, {immediates.setdefault(b, len(immediates))}")
+        else:
+            parts.append(f"mv r{rd}, r{registers.setdefault(b, len(registers))}")
+    return "; ".join(parts), list(registers), list(immediates)
+
+# Parse a sequence in the text form of `canonical_sequence`.
+def parse_sequence_text(text: str) -> List[Tuple[str, int, int]]:
+    sequence = []
+    for part in filter(None, (part.strip() for part in text.split(";"))):
+        m = re.fullmatch(r'(ldi|mv)\s+r(\d+)\s*,\s*r?(\d+)', part)
+        if not m:
+            raise ValueError(f"invalid instruction '{part}'")
+        sequence.append((m[1], int(m[2]), int(m[3])))
+    return sequence
+
+# A table of rewrites of `ldi` and `mv` sequences into shorter ones that
+# leave all registers the same, as found by superopt.py. Both sides are in
+# canonical form.
+class RewriteTable:
+    def __init__(self):
+        self.rewrites: Dict[str, List[Tuple[str, int, int]]] = {}
+        # Length of the longest sequence in the table
+        self.max_length = 0
+
+    @staticmethod
+    def read(path: str) -> "RewriteTable":
+        import json
+        table = RewriteTable()
+        try:
+            with open(path, "r") as f:
+                for pattern, replacement in json.load(f)["rewrites"].items():
+                    table.rewrites[pattern] = parse_sequence_text(replacement)
+                    table.max_length = max(table.max_length, pattern.count(";") + 1)
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            error(f"cannot read rewrite table '{path}': {e}")
+        return table
+
+# Parse a comma separated list of registers, like "r5,r6".
+def parse_register_list(text: str) -> Set[int]:
+    registers = set()
+    for name in filter(None, (name.strip() for name in text.split(","))):
+        if not (m := re.fullmatch(r'r([0-6])', name)):
+            error(f"invalid register '{name}'", "expected r0 to r6")
+        registers.add(int(m[1]))
+    return registers
+
+# Replace sequences of `ldi` and `mv` instructions with the shorter ones of
+# a rewrite table, before the program is laid out. Sequences end at labels
+# and at any other instruction, as the code may be jumped to there. Jumps
+# that do not go to a label would no longer land where they should, so they
+# are not allowed: relative jumps by a fixed offset, and absolute jumps
+# unless their register pair holds `lo()` and `hi()` of the same label.
+#
+# A rewrite only keeps the registers the same at the end of a sequence, and
+# leaves out writes that are overwritten later in it. A device mapped to a
+# register (see `devices.py`) sees every write, so writes to the registers
+# in `keep` also end a sequence and are never left out.
+def rewrite_instructions(program: Iterable[Instruction], table: RewriteTable,
+                         keep: AbstractSet[int] = frozenset()) -> Iterator[Instruction]:
+    window: List[Instruction] = []
+    # The label reference loaded into every register since the last label,
+    # as (kind, name)
+    loaded: Dict[int, Tuple[str, str]] = {}
+    for inst in program:
+        if inst.opcode == Opcode.LDI:
+            if inst.symbol is None:
+                loaded.pop(inst.operands[0].value, None)
+            else:
+                loaded[inst.operands[0].value] = inst.symbol
+        elif inst.opcode == Opcode.MV:
+            if (source := loaded.get(inst.operands[1].value)) is not None:
+                loaded[inst.operands[0].value] = source
+            else:
+                loaded.pop(inst.operands[0].value, None)
+        elif inst.opcode == Opcode.D_LABEL:
+            loaded.clear()
+        elif inst.opcode == Opcode.JABSR:
+            lo, hi = (loaded.get(inst.operands[0].value + i) for i in range(2))
+            if lo is None or hi is None or lo[0] != "lo" or hi != ("hi", lo[1]):
+                error("cannot rewrite a program with absolute jumps that are not to a label",
+                      inst, "load the register pair with lo() and hi() of the target label")
+        if (inst.opcode in (Opcode.LDI, Opcode.MV) and inst.symbol is None and
+                inst.operands[0].value not in keep):
+            window.append(inst)
+            continue
+        if (inst.opcode == Opcode.JRELR or inst.opcode == Opcode.JRELI and
+                inst.symbol is None and inst.operands[0].value != 0):
+            error("cannot rewrite a program with relative jumps by a fixed offset", inst)
+        yield from rewrite_window(window, table)
+        window.clear()
+        yield inst
+    yield from rewrite_window(window, table)
+
+def rewrite_window(window: List[Instruction], table: RewriteTable) -> Iterator[Instruction]:
+    if len(window) < 2:
+        yield from window
+        return
+    window = list(window)
+    i = 0
+    while i < len(window):
+        for length in range(min(table.max_length, len(window) - i), 1, -1):
+            part = window[i:i + length]
+            pattern, registers, immediates = canonical_sequence(
+                ("ldi" if inst.opcode == Opcode.LDI else "mv",
+                 inst.operands[0].value, inst.operands[1].value) for inst in part)
+            replacement = table.rewrites.get(pattern)
+            if replacement is None:
+                continue
+            # The replacement may be part of a longer rewrite, so it is
+            # looked at again
+            window[i:i + length] = [
+                Instruction(Opcode.LDI, [Operand(OperandKind.Reg, registers[a]),
+                                         Operand(OperandKind.Imm, immediates[b])],
+                            file=inst.file, offset=inst.offset)
+                if mnemonic == "ldi" else
+                Instruction(Opcode.MV, [Operand(OperandKind.Reg, registers[a]),
+                                        Operand(OperandKind.Reg, registers[b])],
+                            file=inst.file, offset=inst.offset)
+                for (mnemonic, a, b), inst in zip(replacement, part)
+            ]
+            stats.instructions_saved += length - len(replacement)
+            break
+        else:
+            yield window[i]
+            i += 1
 
 
 # Utility to compute the exact address of instructions in the binary
-@dataclass
 class Layouter:
-    current_address: int = 0
+    def __init__(self, current_address: int = 0, symbols: Optional[Dict[str, int]] = None,
+                 symbol_sections: Optional[Dict[str, int]] = None, section: int = 0,
+                 relocatable: bool = False):
+        self.current_address = current_address
+        # Address of every label
+        self.symbols = symbols if symbols is not None else {}
+        # Index of the section every label is in. Every `.org` and `.section`
+        # starts a new section.
+        self.symbol_sections = symbol_sections if symbol_sections is not None else {}
+        self.section = section
+        # Lay out every `.section` from address 0, for the linker to place.
+        # The linker checks that `.org` sections do not overlap, so they may
+        # come in any order. Otherwise a `.section` follows the previous one,
+        # aligned.
+        self.relocatable = relocatable
+
+    def error(self, message: str, inst: Instruction):
+        error(message, inst)
+
+    def layout_program(self, program: Union[List[Instruction], CompactProgram]):
+        if isinstance(program, CompactProgram):
+            for index in range(len(program)):
+                inst = program.view(index)
+                self.layout_instruction(inst)
+                program.update(index, inst)
+            return
+        for inst in program:
+            self.layout_instruction(inst)
 
-    def layout_program(self, program: List[Instruction]):
+    # Compute the address of every instruction in a stream as it passes
+    # through.
+    def layout_stream(self, program: Iterable[Instruction]) -> Iterator[Instruction]:
         for inst in program:
             self.layout_instruction(inst)
+            yield inst
 
     def layout_instruction(self, inst: Instruction):
         if inst.opcode == Opcode.D_ORG:
             org_address = inst.operands[0].value
-            if self.current_address > org_address:
-                error(f"org directive address 0x{org_address:04X} behind current address 0x{self.current_address:04X}", inst)    
+            if not self.relocatable and self.current_address > org_address:
+                self.error(f"org directive address 0x{org_address:04X} behind current address 0x{self.current_address:04X}", inst)
             self.current_address = org_address
             inst.address = org_address
+            self.section += 1
+            return
+
+        if inst.opcode == Opcode.D_SECTION:
+            align = inst.operands[0].value
+            if self.relocatable:
+                self.current_address = 0
+            else:
+                self.current_address = -(-self.current_address // align) * align
+            inst.address = self.current_address
+            self.section += 1
+            return
+
+        if inst.opcode == Opcode.D_LABEL:
+            name = inst.operands[0].value
+            if name in self.symbols:
+                self.error(f"label '{name}' is already defined", inst)
+            inst.address = self.current_address
+            self.symbols[name] = inst.address
+            self.symbol_sections[name] = self.section
+            return
+
+        if inst.opcode == Opcode.D_INCLUDE:
+            inst.address = self.current_address
+            return
+
+        # Included binary data and data directives occupy as many words as
+        # needed to hold their bytes
+        if inst.opcode in DATA_OPCODES:
+            inst.address = self.current_address
+            self.current_address += (len(inst.data) + 1) // 2
             return
         
         inst.address = self.current_address
         self.current_address += 1
 
-# An encoder that computes the binary encoding for every instruction in a program
+# An encoder that computes the binary encoding for every instruction in a program.
+# Symbolic immediates are resolved with the label addresses computed by a
+# `Layouter`. In relocatable mode, references to labels whose address is not
+# known until link time are encoded as 0 and recorded as relocations instead.
 class InstructionEncoder:
+    def __init__(self, symbols: Optional[Dict[str, int]] = None,
+                 symbol_sections: Optional[Dict[str, int]] = None,
+                 relocatable: bool = False):
+        self.symbols = symbols if symbols is not None else {}
+        self.symbol_sections = symbol_sections if symbol_sections is not None else {}
+        self.relocatable = relocatable
+        # Origin of every section, or None for relocatable sections
+        self.section_origins: List[Optional[int]] = [None]
+        # (section, word offset, symbol kind, label name) of every reference
+        # left for the linker
+        self.relocations: List[Tuple[int, int, str, str]] = []
+
     def error(self, message: str):
         error(message, self.inst)
 
-    def encode_program(self, program: List[Instruction]):
+    def encode_program(self, program: Union[List[Instruction], CompactProgram]):
+        if isinstance(program, CompactProgram):
+            for index in range(len(program)):
+                inst = program.view(index)
+                self.encode(inst)
+                program.update(index, inst)
+            return
         for inst in program:
-            self.inst = inst
-            self.encoding = 0
-            self.encode_instruction(inst)
-            inst.encoding = self.encoding
+            self.encode(inst)
             #sys.stdout.write(AssemblyPrinter([inst]).print())
 
+    # Encode every instruction in a stream as it passes through. The label
+    # addresses are filled in by a `Layouter` earlier in the stream. An
+    # instruction that refers to a label that is not defined yet is held
+    # back, together with all instructions after it, until the label is
+    # defined. Only the instructions between a forward reference and its
+    # label are kept in memory.
+    def encode_stream(self, program: Iterable[Instruction]) -> Iterator[Instruction]:
+        pending: List[Instruction] = []
+        undefined: Set[str] = set()
+        for inst in program:
+            if inst.symbol is not None and inst.symbol[1] not in self.symbols:
+                undefined.add(inst.symbol[1])
+            if not undefined:
+                self.encode(inst)
+                yield inst
+                continue
+            pending.append(inst)
+            if inst.opcode == Opcode.D_LABEL:
+                undefined.discard(inst.operands[0].value)
+                if not undefined:
+                    yield from self.encode_pending(pending)
+        # Labels that are never defined are reported by `resolve_symbol`
+        yield from self.encode_pending(pending)
+
+    def encode_pending(self, pending: List[Instruction]) -> Iterator[Instruction]:
+        for inst in pending:
+            self.encode(inst)
+            yield inst
+        pending.clear()
+
+    def encode(self, inst: Instruction):
+        self.inst = inst
+        self.encoding = 0
+        self.encode_instruction(inst)
+        inst.encoding = self.encoding
+
     def encode_instruction(self, inst: Instruction):
+        if inst.symbol is not None:
+            self.resolve_symbol(inst)
+
         # Actual instructions
         if inst.opcode == Opcode.NOP:
             self.encode_bits(0, 16, 0x0000)
@@ -405,11 +1346,49 @@ class InstructionEncoder:
             self.encode_bits(0, 16, 0x0009)
             return
         
+        # Directives
+        if inst.opcode == Opcode.D_WORD:
+            self.check_imm(inst.operands[0], -2**15, 2**16)
+            self.encode_bits(0, 16, inst.operands[0].value & 0xFFFF)
+            return
+
         if inst.opcode == Opcode.D_ORG:
+            self.section_origins.append(inst.operands[0].value)
+        if inst.opcode == Opcode.D_SECTION:
+            self.section_origins.append(None)
+
+        if inst.opcode in (Opcode.D_ORG, Opcode.D_SECTION, Opcode.D_INCLUDE, Opcode.D_LABEL):
+            self.encoding = None
+            return
+
+        if inst.opcode in DATA_OPCODES:
             self.encoding = None
             return
 
         self.error("unencodable instruction")
+
+    # Replace a symbolic immediate with its value. Relative references within
+    # a section are the same wherever the section is placed, so only the
+    # other references are left for the linker in relocatable mode.
+    def resolve_symbol(self, inst: Instruction):
+        kind, name = inst.symbol
+        operand = inst.operands[-1]
+        section = len(self.section_origins) - 1
+        if self.relocatable and not (kind == "rel" and self.symbol_sections.get(name) == section):
+            offset = inst.address - (self.section_origins[section] or 0)
+            self.relocations.append((section, offset, kind, name))
+            operand.value = 0
+            return
+        if name not in self.symbols:
+            self.error(f"undefined label '{name}'")
+        address = self.symbols[name]
+        if kind == "rel":
+            operand.value = address - inst.address
+            if not -128 <= operand.value < 128:
+                self.error(f"label '{name}' is out of range of a relative jump, "
+                           f"{operand.value} words away")
+        else:
+            operand.value = address >> 8 if kind == "hi" else address & 0xFF
         
     # Store the "value" into the instruction bits from "offset" to "offset+length"
     def encode_bits(self, offset: int, length: int, value: int):
@@ -457,86 +1436,435 @@ class InstructionEncoder:
         value = operand.value
         if value < lower or value >= upper:
             self.error(f"immediate vlaue {value} is out of bounds, expected {lower} <= value < {upper}")
-        
+
+
+# Map the file referenced by an `.incbin` directive into memory and return a
+# read-only view of the requested bytes. The data is not copied until it is
+# placed into the output binary. A length of -1 is replaced with the number of
+# bytes up to the end of the file.
+def map_binary_file(inst: Instruction) -> memoryview:
+    path = inst.operands[0].value
+    offset = inst.operands[1].value
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if inst.operands[2].value == -1:
+                inst.operands[2] = Operand(OperandKind.Imm, max(size - offset, 0))
+            length = inst.operands[2].value
+            if offset < 0 or length < 0 or offset + length > size:
+                error(f"range {offset}+{length} is outside of '{path}' with {size} bytes", inst)
+            if length == 0:
+                return memoryview(b"")
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError as e:
+        error(f"cannot read '{path}': {e.strerror}", inst)
+    return memoryview(data)[offset:offset + length]
+
 # convert a list of instructions to their binary representation. The
 # instructions must have already been encoded with an "instructionEncoder"
-def convert_program_to_bytes(program: List[Instruction],
+def convert_program_to_bytes(program: Union[List[Instruction], CompactProgram],
                              output_size: Optional[int] = None) -> bytes:
-    buffer = bytes()
+    if isinstance(program, CompactProgram):
+        program = map(program.view, range(len(program)))
+    output = io.BytesIO()
+    write_program_stream(program, output, output_size)
+    return output.getvalue()
+
+# Build an object file from a program that was laid out and encoded in
+# relocatable mode. `relocations` are the ones recorded by the encoder.
+def build_object(program: Iterable[Instruction],
+                 relocations: List[Tuple[int, int, str, str]]) -> "ObjectFile":
+    from objfile import ObjectFile, Relocation, Section, Symbol
+    obj = ObjectFile()
+    section = Section(None, array.array("H"))
+    obj.sections.append(section)
+    symbol_indices: Dict[str, int] = {}
+    def add_symbol(name: str) -> int:
+        if name not in symbol_indices:
+            symbol_indices[name] = len(obj.symbols)
+            obj.symbols.append(Symbol(name, None))
+        return symbol_indices[name]
+
+    for inst in program:
+        origin = section.origin or 0
+        if inst.opcode in (Opcode.D_ORG, Opcode.D_SECTION):
+            if inst.opcode == Opcode.D_ORG:
+                section = Section(inst.operands[0].value, array.array("H"))
+            else:
+                section = Section(None, array.array("H"), inst.operands[0].value)
+            obj.sections.append(section)
+            continue
+        if inst.opcode == Opcode.D_LABEL:
+            symbol = obj.symbols[add_symbol(inst.operands[0].value)]
+            symbol.section = len(obj.sections) - 1
+            symbol.offset = inst.address - origin
+            continue
+        if inst.data is None and inst.encoding is None:
+            continue
+        words = section.words
+        offset = inst.address - origin
+        if offset > len(words):
+            words.extend([0] * (offset - len(words)))
+        if inst.data is not None:
+            data = bytes(inst.data) + b"\0" * (len(inst.data) % 2)
+            data_words = array.array("H", data)
+            if sys.byteorder != "little":
+                data_words.byteswap()
+            words.extend(data_words)
+        else:
+            words.append(inst.encoding)
+
+    for section_index, offset, kind, name in relocations:
+        obj.relocations.append(Relocation(section_index, offset, kind, add_symbol(name)))
+    return obj
+
+# Whether a program has sections for the linker to place.
+def has_sections(program: Union[List[Instruction], CompactProgram]) -> bool:
+    if isinstance(program, CompactProgram):
+        return Opcode.D_SECTION.value in program.opcode
+    return any(inst.opcode == Opcode.D_SECTION for inst in program)
+
+# Move the instructions of a program that was laid out in relocatable mode to
+# the addresses its sections were placed at, and take their encodings from
+# the linked binary.
+def relocate_program(program: Union[List[Instruction], CompactProgram],
+                     section_addresses: List[int], binary: bytes):
+    section, delta = 0, section_addresses[0]
+    for index, inst in enumerate(program):
+        if inst.opcode in (Opcode.D_ORG, Opcode.D_SECTION):
+            section += 1
+            delta = section_addresses[section] - inst.address
+        if inst.address is None:
+            continue
+        inst.address += delta
+        if inst.encoding is not None:
+            inst.encoding = binary[2 * inst.address] | binary[2 * inst.address + 1] << 8
+        if isinstance(program, CompactProgram):
+            program.update(index, inst)
+
+# Place the sections of a program that was laid out and encoded in
+# relocatable mode, like linker.py places those of object files, and move its
+# instructions to their final address. Returns the binary, and the object
+# file, section addresses and symbols of the link for a memory map.
+def link_program(program: Union[List[Instruction], CompactProgram],
+                 relocations: List[Tuple[int, int, str, str]], name: str,
+                 output_size: Optional[int] = None) -> Tuple[bytes, "ObjectFile", Any, Any]:
+    from linker import link
+    obj = build_object(program, relocations)
+    # Code before the first `.org` or `.section` starts at address 0
+    if obj.sections[0].words:
+        obj.sections[0].origin = 0
+    binary, addresses, symbols = link([obj], [name], output_size)
+    relocate_program(program, [addresses[0, j] for j in range(len(obj.sections))], binary)
+    return binary, obj, addresses, symbols
+
+# Lay out and encode a parsed program, and return its binary. Programs with
+# sections are linked in-process, such that every tool builds the same image
+# from a source as the assembler does.
+def build_binary(program: Union[List[Instruction], CompactProgram], name: str,
+                 output_size: Optional[int] = None) -> bytes:
+    relocatable = has_sections(program)
+    layouter = Layouter(relocatable=relocatable)
+    layouter.layout_program(program)
+    encoder = InstructionEncoder(layouter.symbols, layouter.symbol_sections,
+                                 relocatable=relocatable)
+    encoder.encode_program(program)
+    if not relocatable:
+        return convert_program_to_bytes(program, output_size)
+    return link_program(program, encoder.relocations, name, output_size)[0]
+
+# Write a stream of encoded instructions to a binary output as they arrive.
+# Every instruction occupies two bytes, so an instruction's address is half
+# its byte offset in the binary. Only a small buffer of pending bytes is kept
+# in memory. Returns the number of bytes written.
+def write_program_stream(program: Iterable[Instruction],
+                         output: BinaryIO,
+                         output_size: Optional[int] = None,
+                         buffer_size: int = 65536) -> int:
+    buffer = bytearray()
+    written = 0
     for inst in program:
-        if inst.encoding is None or inst.address is None:
+        if inst.address is None:
             continue
-        if inst.address > len(buffer):
-            buffer += bytes(inst.address - len(buffer))
-        buffer += bytes([inst.encoding & 0xFF, (inst.encoding >> 8) & 0xFF])
+        if inst.data is None and inst.encoding is None:
+            continue
+        if 2 * inst.address > written + len(buffer):
+            buffer += bytes(2 * inst.address - written - len(buffer))
+        if inst.data is not None:
+            buffer += inst.data
+            if len(inst.data) % 2 != 0:
+                buffer.append(0)
+        else:
+            buffer += bytes([inst.encoding & 0xFF, (inst.encoding >> 8) & 0xFF])
+        if len(buffer) >= buffer_size:
+            output.write(buffer)
+            written += len(buffer)
+            buffer.clear()
+    written += len(buffer)
     if output_size is not None:
-        if len(buffer) > output_size:
-            error(f"binary size {len(buffer)} exceeds configured output size {output_size}")
-        buffer += bytes(output_size - len(buffer))
-    return buffer
+        if written > output_size:
+            error(f"binary size {written} exceeds configured output size {output_size}")
+        buffer += bytes(output_size - written)
+        written = output_size
+    output.write(buffer)
+    stats.bytes_written += written
+    return written
+
+# Characters shown for each byte value in the hexdump, with a dot for bytes
+# that are not printable
+HEXDUMP_CHARS = bytes(byte if byte in range(32, 128) else ord(".") for byte in range(256))
+NONZERO_BYTE = re.compile(rb'[^\x00]')
 
-# print a blob of bytes as a hex dump
-def print_binary_hexdump(binary: bytes, bytes_per_line: int = 8):
+# print a blob of bytes as a hex dump. Runs of lines with only zeros are
+# collapsed into a single line. The dump is written out in one go.
+def print_binary_hexdump(binary: bytes, bytes_per_line: int = 8,
+                         file: Optional[TextIO] = None):
     offset_width = len(f"{len(binary):x}")
-    zeros = False
-    for offset in range(0, len(binary), bytes_per_line):
+    bytes_width = 3 * bytes_per_line - 1
+    zero_line = bytes(bytes_per_line)
+    lines = []
+    offset = 0
+    while offset < len(binary):
         chunk = binary[offset:offset + bytes_per_line]
-        if all(byte == 0 for byte in chunk):
-            if not zeros:
-                print(f"{'.'*offset_width}.  [zeros]")
-            zeros = True
+        if chunk == zero_line[:len(chunk)]:
+            lines.append(f"{'.'*offset_width}.  [zeros]\n")
+            # continue at the line with the next non-zero byte
+            if (m := NONZERO_BYTE.search(binary, offset)) is None:
+                break
+            offset = m.start() - m.start() % bytes_per_line
             continue
-        zeros = False
-        str_bytes = " ".join(f"{byte:02X}" for byte in chunk)
-        str_chars = "".join(
-            chr(byte) if byte in range(32, 128) else "."
-            for byte in chunk
-        )
-        print(f"{offset:0{offset_width}X}:  {str_bytes:{3*bytes_per_line-1}}  {str_chars}")
-    print(f"{len(binary):0{offset_width}X}:  [end of binary]") 
-
-# parse commandline arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("inputs", metavar="INPUT", nargs="*",
-    help="input files to assemble")
-parser.add_argument("-o", "--output", type = str,
-    help="output file")
-parser.add_argument("-s", "--size", type = int,
-    help="size of the output binary")
-parser.add_argument("-v", "--print-assembly", action="store_true",
-    help="print final assembly")
-parser.add_argument("-x", "--print-binary", action="store_true",
-    help="print hexdump of final binary")
-args = parser.parse_args()
-
-# parse the input file
-parser = AssemblyParser()
-for i in args.inputs:
-    parser.parse_file(i)
-
-
-# compute the addresses of each instruction
-Layouter().layout_program(parser.program)
-
-# Compute the binary encoding of each instruction
-InstructionEncoder().encode_program(parser.program)
-
-#print ("List of instructions that we parsed:\n")
-#print(parser.program)
-
-# Print the assembly
-if args.print_assembly:
-    print("Assembler parsed Output: \n")
-    print(AssemblyPrinter(parser.program).print())
-
-# collect the encoded instructions into blob of bytes
-binary = convert_program_to_bytes(parser.program, args.size)
-
-#write the binary to an output file if requested
-if args.output:
-    with open(args.output, "wb") as f:
-        f.write(binary)
-
-# print a hexdump of the binary if no output file is provided
-if not args.output or args.print_binary:
-    print_binary_hexdump(binary)
\ No newline at end of file
+        str_bytes = chunk.hex(" ").upper()
+        str_chars = chunk.translate(HEXDUMP_CHARS).decode("ascii")
+        lines.append(f"{offset:0{offset_width}X}:  {str_bytes:{bytes_width}}  {str_chars}\n")
+        offset += bytes_per_line
+    lines.append(f"{len(binary):0{offset_width}X}:  [end of binary]\n")
+    (file or sys.stdout).write("".join(lines))
+
+# Print every instruction of a stream to a text stream as it passes through.
+def print_stream(program: Iterable[Instruction],
+                 file: TextIO) -> Iterator[Instruction]:
+    printer = AssemblyPrinter([], True, True)
+    printer.start(file)
+    for inst in program:
+        printer.write_instruction(inst)
+        yield inst
+    printer.flush()
+
+# Format the help of the command line arguments. The width of the terminal
+# is only looked up with `shutil`, which is slow to import, if not given, and
+# argparse creates a formatter for every argument added.
+def help_formatter(prog: str):
+    import argparse
+    try:
+        width = int(os.environ["COLUMNS"])
+    except (KeyError, ValueError):
+        try:
+            width = os.get_terminal_size(sys.__stdout__.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            width = 80
+    return argparse.HelpFormatter(prog, width=width - 2)
+
+def main():
+    import argparse
+    # parse commandline arguments
+    parser = argparse.ArgumentParser(formatter_class=help_formatter)
+    parser.add_argument("inputs", metavar="INPUT", nargs="*",
+        help="input files to assemble")
+    parser.add_argument("-o", "--output", type = str,
+        help="output file")
+    parser.add_argument("-c", "--compile", action="store_true",
+        help="write a relocatable object file for linker.py instead of a binary")
+    parser.add_argument("-s", "--size", type = int,
+        help="size of the output binary")
+    parser.add_argument("-m", "--map", action="store_true",
+        help="print a memory map with the used and free ranges and every label")
+    parser.add_argument("-v", "--print-assembly", action="store_true",
+        help="print final assembly")
+    parser.add_argument("-x", "--print-binary", action="store_true",
+        help="print hexdump of final binary")
+    parser.add_argument("-l", "--listing", metavar="FILE", type = str,
+        help="write the final assembly to FILE")
+    parser.add_argument("--hexdump-width", metavar="N", type = int, default=8,
+        help="number of bytes per line in the hexdump")
+    parser.add_argument("-r", "--rewrite", metavar="TABLE", type = str,
+        help="replace instruction sequences with the shorter ones of a rewrite "
+             "table written by superopt.py. This leaves out register writes that "
+             "are overwritten later, which devices mapped to a register would see")
+    parser.add_argument("--keep-writes", metavar="REGS", type = str, default="",
+        help="comma separated registers, like r5,r6, whose writes --rewrite keeps, "
+             "such as the registers of output devices")
+    parser.add_argument("--compact", action="store_true",
+        help="store the program in compact columns to save memory on large sources")
+    parser.add_argument("--stream", action="store_true",
+        help="stream instructions from the parser directly into the output")
+    parser.add_argument("--time-passes", action="store_true",
+        help="print the time spent in each phase of the assembler")
+    parser.add_argument("--stats", action="store_true",
+        help="print statistics counters of the assembler")
+    parser.add_argument("--profile", metavar="FILE", type = str,
+        help="profile the assembler and write the pstats to FILE")
+    args = parser.parse_args()
+    if args.hexdump_width < 1:
+        parser.error("hexdump width must be at least 1")
+    if args.compile and (args.stream or not args.output):
+        parser.error("-c needs an output file and cannot be used with --stream")
+    if args.map and (args.stream or args.compile):
+        parser.error("--map cannot be used with --stream or -c")
+    stats.enabled = args.time_passes
+
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(run, args)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        run(args)
+
+    if args.time_passes:
+        stats.print_phases()
+    if args.stats:
+        stats.print_counters()
+
+def run(args):
+    if args.stream:
+        assemble_stream(args)
+        return
+
+    # parse the input file
+    with stats.phase("parse") as phase:
+        parser = AssemblyParser(verbose=args.print_assembly, cache=False)
+        if args.compact:
+            parser.program = CompactProgram()
+        for i in args.inputs:
+            parser.parse_file(i)
+        phase.items = len(parser.program)
+
+    # Replace instruction sequences with shorter ones
+    if args.rewrite:
+        with stats.phase("rewrite") as phase:
+            table = RewriteTable.read(args.rewrite)
+            program = CompactProgram() if args.compact else []
+            program.extend(rewrite_instructions(parser.program, table,
+                                                parse_register_list(args.keep_writes)))
+            phase.items = len(parser.program)
+            parser.program = program
+
+    # Programs with sections are linked in-process, so that the sections are
+    # placed like linker.py places those of object files
+    relocatable = args.compile or args.map or has_sections(parser.program)
+
+    # compute the addresses of each instruction
+    with stats.phase("layout") as phase:
+        layouter = Layouter(relocatable=relocatable)
+        layouter.layout_program(parser.program)
+        phase.items = len(parser.program)
+
+    # Compute the binary encoding of each instruction
+    with stats.phase("encode") as phase:
+        encoder = InstructionEncoder(layouter.symbols, layouter.symbol_sections,
+                                     relocatable=relocatable)
+        encoder.encode_program(parser.program)
+        phase.items = len(parser.program)
+
+    # Place the sections, and move the instructions to their final address
+    if relocatable and not args.compile:
+        with stats.phase("link") as phase:
+            name = ", ".join(args.inputs)
+            binary, obj, addresses, symbols = link_program(
+                parser.program, encoder.relocations, name, args.size)
+            phase.items = len(parser.program)
+        if args.map:
+            from linker import print_map
+            print_map([obj], [name], addresses, symbols)
+
+    #print ("List of instructions that we parsed:\n")
+    #print(parser.program)
+
+    # Print the assembly
+    if args.print_assembly:
+        with stats.phase("print assembly") as phase:
+            print("Assembler parsed Output: \n")
+            AssemblyPrinter(parser.program).write(sys.stdout)
+            print()
+            phase.items = len(parser.program)
+
+    # Write the assembly listing
+    if args.listing:
+        with stats.phase("listing") as phase, open(args.listing, "w") as f:
+            AssemblyPrinter(parser.program).write(f)
+            phase.items = len(parser.program)
+
+    # write an object file with the sections, labels and relocations
+    if args.compile:
+        with stats.phase("write") as phase:
+            obj = build_object(parser.program, encoder.relocations)
+            obj.write(args.output)
+            phase.items = len(parser.program)
+        return
+
+    # collect the encoded instructions into blob of bytes
+    if not relocatable:
+        with stats.phase("convert") as phase:
+            binary = convert_program_to_bytes(parser.program, args.size)
+            phase.items = len(parser.program)
+
+    #write the binary to an output file if requested
+    if args.output:
+        with stats.phase("write") as phase:
+            with open(args.output, "wb") as f:
+                f.write(binary)
+            phase.items = len(binary)
+
+    # print a hexdump of the binary if no output file is provided
+    if not args.output or args.print_binary:
+        with stats.phase("hexdump") as phase:
+            print_binary_hexdump(binary, args.hexdump_width)
+            phase.items = len(binary)
+
+# Assemble the inputs in a single pass. Instructions flow from the parser
+# through layout and encoding straight into the output, without keeping the
+# program in memory. Instructions that refer to labels further down are held
+# back by the encoder until the label has been laid out.
+def assemble_stream(args):
+    parser = AssemblyParser()
+    layouter = Layouter()
+    encoder = InstructionEncoder(layouter.symbols)
+    program = (inst for i in args.inputs for inst in parser.stream_file(i))
+    program = stats.stream("parse", program)
+    if args.rewrite:
+        table = RewriteTable.read(args.rewrite)
+        keep = parse_register_list(args.keep_writes)
+        program = stats.stream("rewrite", rewrite_instructions(program, table, keep))
+    program = stats.stream("layout", layouter.layout_stream(program))
+    program = stats.stream("encode", encoder.encode_stream(program))
+    if args.print_assembly:
+        print("Assembler parsed Output: \n")
+        program = stats.stream("print assembly", print_stream(program, sys.stdout))
+
+    with ExitStack() as files:
+        if args.listing:
+            listing = files.enter_context(open(args.listing, "w"))
+            program = stats.stream("listing", print_stream(program, listing))
+
+        # write straight to the output file, unless a hexdump needs the binary
+        if args.output and not args.print_binary:
+            with stats.phase("write") as phase, open(args.output, "wb") as f:
+                phase.items = write_program_stream(program, f, args.size)
+            return
+        with stats.phase("write") as phase:
+            output = io.BytesIO()
+            phase.items = write_program_stream(program, output, args.size)
+            binary = output.getvalue()
+            if args.print_assembly:
+                print()
+            if args.output:
+                with open(args.output, "wb") as f:
+                    f.write(binary)
+    with stats.phase("hexdump") as phase:
+        print_binary_hexdump(binary, args.hexdump_width)
+        phase.items = len(binary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,627 @@
+#!/usr/bin/env python3
+# A language server for assembly sources, speaking the Language Server
+# Protocol over stdin and stdout. It stays running while an editor is open,
+# so the assembler is only loaded once, and publishes the errors of the
+# parser, layouter and encoder as diagnostics. Hovering an instruction shows
+# its address and encoding.
+#
+# Instructions are line-oriented, so every open document is kept as a list of
+# parsed lines, and an edit only parses the lines it changed again. Only a
+# block comment opened or closed by the edit makes the following lines be
+# parsed again too. The lines are grouped into chunks that remember where
+# their labels, `.org` directives and symbolic immediates are, such that the
+# addresses that depend on the rest of the document are computed without
+# looking at every line.
+import argparse
+import bisect
+import io
+import json
+import os
+import re
+import sys
+import time
+import traceback
+import urllib.parse
+from contextlib import redirect_stderr
+from dataclasses import dataclass, field
+from typing import *
+
+from assembler import (DATA_OPCODES, AssemblyParser, AssemblyPrinter, Instruction,
+                       InstructionEncoder, Layouter, Opcode, Operand, map_binary_file)
+
+# Number of lines per chunk of a document
+CHUNK_LINES = 256
+
+# LSP constants
+SYNC_INCREMENTAL = 2
+SEVERITY_ERROR = 1
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+
+# Strings, line comments and the start of a block comment in a line
+COMMENT_START = re.compile(r'"[^"\n]*"|#.*|//.*|/\*')
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+
+# An error in a line, at a column of the line if known.
+class LineError(Exception):
+    def __init__(self, message: str, column: Optional[int] = None):
+        super().__init__(message)
+        self.message = message
+        self.column = column
+
+# The parser, layouter and encoder of the assembler, raising the errors they
+# find instead of exiting.
+class LineParser(AssemblyParser):
+    def error(self, message):
+        raise LineError(message, self.position)
+
+class LineLayouter(Layouter):
+    def error(self, message: str, inst: Instruction):
+        raise LineError(message)
+
+class LineEncoder(InstructionEncoder):
+    def error(self, message: str):
+        raise LineError(message)
+
+# Call a function of the assembler that reports errors by exiting, and raise
+# the error as a `LineError` instead.
+def capture_errors(function: Callable, *args) -> Any:
+    stderr = io.StringIO()
+    try:
+        with redirect_stderr(stderr):
+            return function(*args)
+    except SystemExit:
+        message = ANSI_ESCAPE.sub("", stderr.getvalue()).split("\n")[0]
+        raise LineError(message.removeprefix("error: ") or "error")
+
+# Replace the block comments in a line with spaces, such that the columns of
+# the remaining text stay the same. Returns the text and whether the line
+# ends inside a block comment.
+def mask_comments(text: str, in_comment: bool) -> Tuple[str, bool]:
+    parts = []
+    position = 0
+    while True:
+        if in_comment:
+            end = text.find("*/", position)
+            if end < 0:
+                parts.append(" " * (len(text) - position))
+                return "".join(parts), True
+            parts.append(" " * (end + 2 - position))
+            position = end + 2
+            in_comment = False
+        m = COMMENT_START.search(text, position)
+        if m is None or m[0] != "/*":
+            parts.append(text[position:])
+            return "".join(parts), False
+        parts.append(text[position:m.start()] + "  ")
+        position = m.end()
+        in_comment = True
+
+# Number of words an instruction occupies in the binary.
+def instruction_words(inst: Instruction) -> int:
+    if inst.opcode in (Opcode.D_LABEL, Opcode.D_INCLUDE, Opcode.D_ORG, Opcode.D_SECTION):
+        return 0
+    if inst.opcode in DATA_OPCODES:
+        return (len(inst.data) + 1) // 2
+    return 1
+
+# The address following an instruction. Addresses in a `.section` are
+# relative to its start, as the linker decides where it goes.
+def next_address(address: int, inst: Instruction) -> int:
+    if inst.opcode == Opcode.D_ORG:
+        address = inst.operands[0].value
+    elif inst.opcode == Opcode.D_SECTION:
+        address = 0
+    return address + instruction_words(inst)
+
+# Lay out or resolve a single instruction at an address, with the given
+# labels known. Returns the error of the layouter or encoder, if any.
+def check_instruction(inst: Instruction, address: int, symbols: Dict[str, int]) -> Optional[str]:
+    inst.address = address
+    try:
+        if inst.symbol is not None:
+            encoder = LineEncoder(symbols)
+            encoder.inst = inst
+            encoder.resolve_symbol(inst)
+        else:
+            LineLayouter(address, symbols).layout_instruction(inst)
+    except LineError as e:
+        return e.message
+    return None
+
+# The address of base + offset in a chunk at `address`, where a base of None
+# stands for the start of the chunk.
+def chunk_address(address: int, base: Optional[int], offset: int) -> int:
+    return (address if base is None else base) + offset
+
+
+# The instructions parsed from a line. Lines with the same text are parsed
+# only once and share their instructions, so the address of an instruction is
+# only set while checking it.
+@dataclass
+class ParsedLine:
+    # Whether the line starts and ends inside a block comment
+    comment_start: bool
+    comment_end: bool
+    instructions: List[Instruction] = field(default_factory=list)
+    # The instructions as laid out, with the contents of included files, and
+    # the column each one is reported at
+    layout: List[Tuple[int, Instruction]] = field(default_factory=list)
+    errors: List[Tuple[int, str]] = field(default_factory=list)
+    # Whether the line depends on other files, and cannot be shared
+    external: bool = False
+
+# A range of lines of a document. Chunks remember what the rest of the
+# document needs to know about their lines. Positions in a chunk are stored
+# as (base, offset): the address is base + offset, or the address of the
+# chunk plus offset if `base` is None. Lines are relative to the first line
+# of the chunk.
+@dataclass
+class Chunk:
+    count: int
+    dirty: bool = True
+    # The first definition of every label in the chunk, as
+    # (base, offset, line, column, instruction)
+    labels: Dict[str, Tuple[Optional[int], int, int, int, Instruction]] = field(default_factory=dict)
+    # `.org` directives, and relative jumps to labels in other chunks, as
+    # (line, column, base, offset, instruction)
+    orgs: List[Tuple[int, int, Optional[int], int, Instruction]] = field(default_factory=list)
+    jumps: List[Tuple[int, int, Optional[int], int, Instruction]] = field(default_factory=list)
+    # The (line, column, instruction) of the references to every label
+    references: Dict[str, List[Tuple[int, int, Instruction]]] = field(default_factory=dict)
+    # Errors that do not depend on the rest of the document, as
+    # (line, column, message)
+    errors: List[Tuple[int, int, str]] = field(default_factory=list)
+    # The position following the chunk
+    end_base: Optional[int] = None
+    end_offset: int = 0
+    # Whether the chunk has a `.section`
+    sections: bool = False
+    # Set when laying out the document
+    first_line: int = 0
+    address: int = 0
+
+
+# An open source file.
+class Document:
+    def __init__(self, uri: str, text: str):
+        self.uri = uri
+        parsed = urllib.parse.urlparse(uri)
+        self.path = urllib.parse.unquote(parsed.path) if parsed.scheme == "file" else uri
+        self.parser = LineParser()
+        self.encoder = LineEncoder()
+        # Parsed lines by their text and block comment state
+        self.cache: Dict[Tuple[str, bool], ParsedLine] = {}
+        # The chunks defining every label, and the number of references to
+        # every label
+        self.definitions: Dict[str, List[Chunk]] = {}
+        self.reference_counts: Dict[str, int] = {}
+        # Labels referenced but not defined, and labels defined in several
+        # chunks. They are updated from the labels whose definitions or
+        # references changed since the last layout.
+        self.undefined: Set[str] = set()
+        self.duplicates: Set[str] = set()
+        self.changed_labels: Set[str] = set()
+        self.diagnostics: List[dict] = []
+
+        self.lines = text.split("\n")
+        self.parsed: List[Optional[ParsedLine]] = [None] * len(self.lines)
+        self.parse_lines(0, len(self.lines))
+        self.chunks = [Chunk(min(CHUNK_LINES, len(self.lines) - i))
+                       for i in range(0, len(self.lines), CHUNK_LINES)]
+        self.layout()
+
+    # Apply a change sent by the editor. A change without a range replaces
+    # the whole text.
+    def change(self, change: dict):
+        if "range" not in change:
+            self.__init__(self.uri, change["text"])
+            return
+        start, end = change["range"]["start"], change["range"]["end"]
+        first, last = start["line"], min(end["line"], len(self.lines) - 1)
+        # A range may end just past the last line
+        suffix = self.lines[last][end["character"]:] if end["line"] == last else ""
+        text = self.lines[first][:start["character"]] + change["text"] + suffix
+        new_lines = text.split("\n")
+        self.lines[first:last + 1] = new_lines
+        self.parsed[first:last + 1] = [None] * len(new_lines)
+        reparsed_end = self.parse_lines(first, first + len(new_lines))
+
+        # Merge the chunks holding the replaced lines, and mark the chunks of
+        # all lines parsed again as changed
+        index = self.chunk_index(first)
+        merged = self.chunk_index(last)
+        line = self.chunks[index].first_line
+        count = len(new_lines) - (last + 1 - first)
+        for chunk in self.chunks[index:merged + 1]:
+            self.forget(chunk)
+            count += chunk.count
+        self.chunks[index:merged + 1] = [Chunk(count)]
+        for chunk in self.chunks[index:]:
+            if line >= reparsed_end:
+                break
+            chunk.dirty = True
+            line += chunk.count
+        self.split_chunks(index)
+        self.layout()
+
+    # Parse the lines from `start` to `end`, and the lines after them whose
+    # block comment state changed. Returns the end of the lines parsed.
+    def parse_lines(self, start: int, end: int) -> int:
+        if len(self.cache) > 4 * len(self.lines) + CHUNK_LINES:
+            self.cache.clear()
+        in_comment = self.parsed[start - 1].comment_end if start > 0 else False
+        line = start
+        while line < len(self.lines):
+            if line >= end and self.parsed[line].comment_start == in_comment:
+                break
+            key = (self.lines[line], in_comment)
+            if (parsed := self.cache.get(key)) is None:
+                parsed = self.parse_line(*key)
+                if not parsed.external:
+                    self.cache[key] = parsed
+            self.parsed[line] = parsed
+            in_comment = parsed.comment_end
+            line += 1
+        return line
+
+    def parse_line(self, text: str, in_comment: bool) -> ParsedLine:
+        masked, comment_end = mask_comments(text.rstrip("\r"), in_comment)
+        line = ParsedLine(in_comment, comment_end)
+        encoded = masked.encode()
+        self.parser.set_input(self.path, encoded)
+        try:
+            for inst in self.parser.parse_instructions():
+                line.instructions.append(inst)
+        except LineError as e:
+            line.errors.append((e.column, e.message))
+
+        # The parser reports byte offsets, while editors count characters
+        if len(encoded) != len(masked):
+            def column(offset: int) -> int:
+                return len(encoded[:offset].decode(errors="replace"))
+            for inst in line.instructions:
+                inst.offset = column(inst.offset)
+            line.errors = [(column(offset), message) for offset, message in line.errors]
+
+        for inst in line.instructions:
+            line.layout.append((inst.offset, inst))
+            try:
+                if inst.opcode == Opcode.D_INCBIN:
+                    line.external = True
+                    # The document may not be saved, so the error must not
+                    # quote its location
+                    inst.data = memoryview(b"")
+                    inst.data = capture_errors(map_binary_file, inst.replace(file=None))
+                elif inst.opcode == Opcode.D_INCLUDE:
+                    line.external = True
+                    included = AssemblyParser(included={os.path.realpath(self.path)})
+                    capture_errors(included.parse_file, inst.operands[0].value)
+                    line.layout += [(inst.offset, i) for i in included.program]
+                elif inst.symbol is None:
+                    self.encoder.encode(inst)
+            except LineError as e:
+                line.errors.append((inst.offset, e.message))
+        return line
+
+    # Index of the chunk holding a line.
+    def chunk_index(self, line: int) -> int:
+        starts = [chunk.first_line for chunk in self.chunks]
+        return max(bisect.bisect_right(starts, line) - 1, 0)
+
+    # Split the chunks from `index` on that grew too large.
+    def split_chunks(self, index: int):
+        while index < len(self.chunks):
+            chunk = self.chunks[index]
+            if chunk.count <= 2 * CHUNK_LINES:
+                break
+            self.chunks[index:index + 1] = [
+                Chunk(min(CHUNK_LINES, chunk.count - i)) for i in range(0, chunk.count, CHUNK_LINES)
+            ]
+            index += chunk.count // CHUNK_LINES + 1
+
+    # Collect the labels, references and errors of the lines of a chunk.
+    # Relative jumps to labels in the same chunk are checked right away, as
+    # the distance does not depend on where the chunk is.
+    def summarize(self, chunk: Chunk, first_line: int):
+        self.forget(chunk)
+        chunk.labels, chunk.orgs, chunk.jumps, chunk.references, chunk.errors = {}, [], [], {}, []
+        chunk.sections = False
+        seen: Dict[str, int] = {}
+        jumps = []
+        base, offset = None, 0
+        for line in range(chunk.count):
+            parsed = self.parsed[first_line + line]
+            for column, message in parsed.errors:
+                chunk.errors.append((line, column, message))
+            for column, inst in parsed.layout:
+                if inst.opcode == Opcode.D_ORG:
+                    chunk.orgs.append((line, column, base, offset, inst))
+                    base, offset = inst.operands[0].value, 0
+                elif inst.opcode == Opcode.D_SECTION:
+                    chunk.sections = True
+                    base, offset = 0, 0
+                elif inst.opcode == Opcode.D_LABEL:
+                    if message := check_instruction(inst, offset, seen):
+                        chunk.errors.append((line, column, message))
+                    else:
+                        chunk.labels[inst.operands[0].value] = (base, offset, line, column, inst)
+                elif inst.symbol is not None:
+                    chunk.references.setdefault(inst.symbol[1], []).append((line, column, inst))
+                    if inst.symbol[0] == "rel":
+                        jumps.append((line, column, base, offset, inst))
+                offset += instruction_words(inst)
+        chunk.end_base, chunk.end_offset = base, offset
+
+        for line, column, base, offset, inst in jumps:
+            name = inst.symbol[1]
+            label = chunk.labels.get(name)
+            if label is None or (label[0] is None) != (base is None) or chunk.sections:
+                chunk.jumps.append((line, column, base, offset, inst))
+                continue
+            if message := check_instruction(inst, (base or 0) + offset,
+                                            {name: (label[0] or 0) + label[1]}):
+                chunk.errors.append((line, column, message))
+        for name in chunk.labels:
+            self.definitions.setdefault(name, []).append(chunk)
+        for name, references in chunk.references.items():
+            self.reference_counts[name] = self.reference_counts.get(name, 0) + len(references)
+        self.changed_labels.update(chunk.labels, chunk.references)
+        chunk.dirty = False
+
+    # Remove the labels and references of a chunk from the document.
+    def forget(self, chunk: Chunk):
+        for name in chunk.labels:
+            self.definitions[name].remove(chunk)
+            if not self.definitions[name]:
+                del self.definitions[name]
+        for name, references in chunk.references.items():
+            self.reference_counts[name] -= len(references)
+            if not self.reference_counts[name]:
+                del self.reference_counts[name]
+        self.changed_labels.update(chunk.labels, chunk.references)
+        chunk.labels, chunk.references = {}, {}
+
+    # The address of a label, or None if it is not defined.
+    def symbol_address(self, name: str) -> Optional[int]:
+        if name not in self.definitions:
+            return None
+        chunk = min(self.definitions[name], key=lambda chunk: chunk.first_line)
+        base, offset = chunk.labels[name][:2]
+        return chunk_address(chunk.address, base, offset)
+
+    # Compute the addresses of all chunks, and collect the diagnostics of the
+    # document.
+    def layout(self):
+        diagnostics = []
+        first_line = 0
+        for chunk in self.chunks:
+            if chunk.dirty:
+                self.summarize(chunk, first_line)
+            first_line += chunk.count
+        # With sections, the assembler leaves the checks of `.org` addresses
+        # and of jumps between sections to the linker
+        relocatable = any(chunk.sections for chunk in self.chunks)
+
+        address, first_line = 0, 0
+        for chunk in self.chunks:
+            chunk.first_line, chunk.address = first_line, address
+            for line, column, message in chunk.errors:
+                diagnostics.append(self.diagnostic(first_line + line, column, message))
+            for line, column, base, offset, inst in [] if relocatable else chunk.orgs:
+                inst_address = chunk_address(address, base, offset)
+                if message := check_instruction(inst, inst_address, {}):
+                    diagnostics.append(self.diagnostic(first_line + line, column, message))
+            address = chunk_address(address, chunk.end_base, chunk.end_offset)
+            first_line += chunk.count
+
+        for name in self.changed_labels:
+            defined = len(self.definitions.get(name, []))
+            if defined == 0 and name in self.reference_counts:
+                self.undefined.add(name)
+            else:
+                self.undefined.discard(name)
+            if defined > 1:
+                self.duplicates.add(name)
+            else:
+                self.duplicates.discard(name)
+        self.changed_labels.clear()
+
+        # Labels defined in several chunks
+        for name in self.duplicates:
+            chunks = sorted(self.definitions[name], key=lambda chunk: chunk.first_line)
+            for chunk in chunks[1:]:
+                _, _, line, column, inst = chunk.labels[name]
+                message = check_instruction(inst, 0, {name: 0})
+                diagnostics.append(self.diagnostic(chunk.first_line + line, column, message))
+
+        # References to labels that are not defined, and relative jumps to
+        # labels in other chunks
+        for chunk in self.chunks:
+            for name in self.undefined:
+                for line, column, inst in chunk.references.get(name, []):
+                    message = check_instruction(inst, 0, {})
+                    diagnostics.append(self.diagnostic(chunk.first_line + line, column, message))
+            for line, column, base, offset, inst in [] if relocatable else chunk.jumps:
+                name = inst.symbol[1]
+                if (target := self.symbol_address(name)) is None:
+                    continue
+                inst_address = chunk_address(chunk.address, base, offset)
+                if message := check_instruction(inst, inst_address, {name: target}):
+                    diagnostics.append(self.diagnostic(chunk.first_line + line, column, message))
+        self.diagnostics = diagnostics
+
+    def diagnostic(self, line: int, column: Optional[int], message: str) -> dict:
+        text = self.lines[line].rstrip()
+        column = min(column or 0, len(text))
+        return {
+            "range": {"start": {"line": line, "character": column},
+                      "end": {"line": line, "character": len(text)}},
+            "severity": SEVERITY_ERROR,
+            "source": "assembler",
+            "message": message,
+        }
+
+    # Describe the instruction at a position, with its address and encoding.
+    def hover(self, line: int, character: int) -> Optional[str]:
+        if line >= len(self.lines) or not self.parsed[line].instructions:
+            return None
+        target = self.parsed[line].instructions[0]
+        for inst in self.parsed[line].instructions:
+            if inst.offset <= character:
+                target = inst
+
+        chunk = self.chunks[self.chunk_index(line)]
+        address = chunk.address
+        for parsed in self.parsed[chunk.first_line:line]:
+            for _, inst in parsed.layout:
+                address = next_address(address, inst)
+        for _, inst in self.parsed[line].layout:
+            if inst is target:
+                break
+            address = next_address(address, inst)
+
+        hovered = target.replace(operands=[Operand(op.kind, op.value) for op in target.operands],
+                                 address=address)
+        if hovered.opcode == Opcode.D_ORG:
+            hovered.address = hovered.operands[0].value
+        description = ""
+        if hovered.symbol is not None:
+            name = hovered.symbol[1]
+            hovered.encoding = None
+            symbols = {} if (target_address := self.symbol_address(name)) is None else {name: target_address}
+            try:
+                LineEncoder(symbols).encode(hovered)
+                description = f"\n\n`{name}` = 0x{target_address:04X}"
+            except LineError as e:
+                description = f"\n\n{e.message}"
+        elif hovered.opcode in DATA_OPCODES:
+            description = f"\n\n{len(hovered.data)} bytes"
+        printer = AssemblyPrinter([], emit_address=True, emit_encoding=True)
+        return f"```\n{printer.format_instruction(hovered)}\n```{description}"
+
+
+# Read a message from a stream. Returns None at the end of the stream.
+def read_message(stream: BinaryIO) -> Optional[dict]:
+    length = None
+    while True:
+        header = stream.readline()
+        if not header:
+            return None
+        header = header.strip()
+        if not header:
+            break
+        name, _, value = header.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    if length is None:
+        return {}
+    return json.loads(stream.read(length))
+
+def write_message(stream: BinaryIO, message: dict):
+    body = json.dumps(message, separators=(",", ":")).encode()
+    stream.write(b"Content-Length: %d\r\n\r\n" % len(body) + body)
+    stream.flush()
+
+
+class Server:
+    def __init__(self, output: BinaryIO, verbose: bool = False):
+        self.output = output
+        self.verbose = verbose
+        self.documents: Dict[str, Document] = {}
+        self.shut_down = False
+
+    def handle(self, message: dict):
+        start = time.perf_counter()
+        method = message.get("method")
+        try:
+            result = self.dispatch(method, message.get("params") or {})
+        except Exception as e:
+            # Keep serving the other documents
+            traceback.print_exc()
+            if "id" in message:
+                self.send({"id": message["id"],
+                           "error": {"code": INTERNAL_ERROR, "message": f"{type(e).__name__}: {e}"}})
+            return
+        if "id" in message and method is not None:
+            if result is NotImplemented:
+                self.send({"id": message["id"],
+                           "error": {"code": METHOD_NOT_FOUND, "message": f"unknown method {method}"}})
+            else:
+                self.send({"id": message["id"], "result": result})
+        if self.verbose:
+            sys.stderr.write(f"{method}: {(time.perf_counter() - start) * 1000:.2f}ms\n")
+
+    def dispatch(self, method: Optional[str], params: dict) -> Any:
+        if method == "initialize":
+            return {
+                "capabilities": {
+                    "textDocumentSync": {"openClose": True, "change": SYNC_INCREMENTAL},
+                    "hoverProvider": True,
+                },
+                "serverInfo": {"name": "assembler_server"},
+            }
+
+        if method == "shutdown":
+            self.shut_down = True
+            return None
+
+        if method == "exit":
+            sys.exit(0 if self.shut_down else 1)
+
+        if method == "textDocument/didOpen":
+            document = params["textDocument"]
+            self.documents[document["uri"]] = Document(document["uri"], document["text"])
+            self.publish(document["uri"], document.get("version"))
+            return None
+
+        if method == "textDocument/didChange":
+            document = params["textDocument"]
+            for change in params["contentChanges"]:
+                self.documents[document["uri"]].change(change)
+            self.publish(document["uri"], document.get("version"))
+            return None
+
+        if method == "textDocument/didClose":
+            uri = params["textDocument"]["uri"]
+            self.documents.pop(uri, None)
+            self.send({"method": "textDocument/publishDiagnostics",
+                       "params": {"uri": uri, "diagnostics": []}})
+            return None
+
+        if method == "textDocument/hover":
+            document = self.documents.get(params["textDocument"]["uri"])
+            position = params["position"]
+            text = document and document.hover(position["line"], position["character"])
+            if not text:
+                return None
+            return {"contents": {"kind": "markdown", "value": text}}
+
+        # Other notifications are ignored
+        if method is None or method.startswith("$/") or method == "initialized":
+            return None
+        return NotImplemented
+
+    def publish(self, uri: str, version: Optional[int]):
+        params = {"uri": uri, "diagnostics": self.documents[uri].diagnostics}
+        if version is not None:
+            params["version"] = version
+        self.send({"method": "textDocument/publishDiagnostics", "params": params})
+
+    def send(self, message: dict):
+        write_message(self.output, {"jsonrpc": "2.0", **message})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="log the time taken for every message to stderr")
+    args = parser.parse_args()
+
+    server = Server(sys.stdout.buffer, args.verbose)
+    while (message := read_message(sys.stdin.buffer)) is not None:
+        server.handle(message)
+
+if __name__ == "__main__":
+    main()
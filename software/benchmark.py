@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# Benchmarks for the assembler tool chain. Synthetic programs of different
+# sizes are generated, every phase of the tools is timed in-process, and the
+# results are written as JSON. Two result files can be compared to find
+# performance regressions.
+#
+# The startup of the assembler as a command is tracked as well: the import
+# time of the assembler module as reported by `python -X importtime`, and the
+# wall time of assembling in a new process. `benchmark.py startup` checks
+# them against a budget and lists the slowest imports.
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from typing import *
+
+import assembler
+import disassembler
+import emulator
+
+
+# Generate a random but valid assembly program with the given number of lines.
+# The same seed always produces the same program.
+def generate_program(lines: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    reg = lambda: f"r{rng.randint(0, 6)}"
+    output = []
+    address = 0
+    while len(output) < lines:
+        choice = rng.random()
+        if choice < 0.40:
+            value = rng.randint(0, 255)
+            imm = rng.choice([f"{value}", f"0x{value:02X}", f"0b{value:08b}"])
+            output.append(f"    ldi {reg()}, {imm}")
+        elif choice < 0.60:
+            output.append(f"    mv {reg()}, {reg()}")
+        elif choice < 0.68:
+            output.append(f"    jreli {rng.randint(-128, 127)}")
+        elif choice < 0.73:
+            output.append(f"    jrelr {reg()}")
+        elif choice < 0.78:
+            lo = rng.randint(0, 5)
+            output.append(f"    jabsr r{lo}r{lo + 1}")
+        elif choice < 0.81:
+            output.append(rng.choice(["    nop", "    halt"]))
+        elif choice < 0.90:
+            output.append(f"    mv {reg()}, {reg()}  # trailing comment")
+        elif choice < 0.91:
+            address += rng.randint(1, 64)
+            output.append(f".org 0x{address:04X}")
+            continue
+        elif choice < 0.99:
+            output.append(rng.choice(["# comment", "    // comment", ""]))
+            continue
+        else:
+            output += ["/* block", "   comment */"]
+            continue
+        address += 1
+    return "\n".join(output[:lines]) + "\n"
+
+
+# Time the enclosed block and store the elapsed seconds in `results[name]`.
+@contextmanager
+def timed(results: Dict[str, float], name: str):
+    start = time.perf_counter()
+    yield
+    results[name] = time.perf_counter() - start
+
+
+# Run every phase of the assembler on an input file.
+def bench_assembler(path: str, results: Dict[str, float], compact: bool = False):
+    assembler.parse_cache.clear()
+    with timed(results, "parse"):
+        parser = assembler.AssemblyParser()
+        if compact:
+            parser.program = assembler.CompactProgram()
+        parser.parse_file(path)
+    with timed(results, "layout"):
+        assembler.Layouter().layout_program(parser.program)
+    with timed(results, "encode"):
+        assembler.InstructionEncoder().encode_program(parser.program)
+    with timed(results, "print"):
+        assembler.AssemblyPrinter(parser.program).print()
+    with timed(results, "convert"):
+        binary = assembler.convert_program_to_bytes(parser.program)
+    with timed(results, "hexdump"), redirect_stdout(io.StringIO()):
+        assembler.print_binary_hexdump(binary)
+
+def bench_compact(path: str, results: Dict[str, float]):
+    bench_assembler(path, results, compact=True)
+
+# Run the streaming assembler pipeline on an input file.
+def bench_stream(path: str, results: Dict[str, float]):
+    with timed(results, "assemble"):
+        parser = assembler.AssemblyParser()
+        program = parser.stream_file(path)
+        program = assembler.Layouter().layout_stream(program)
+        program = assembler.InstructionEncoder().encode_stream(program)
+        assembler.write_program_stream(program, io.BytesIO())
+
+
+# Assemble an input file and decode the binary again.
+def bench_disassemble(path: str, results: Dict[str, float]):
+    assembler.parse_cache.clear()
+    parser = assembler.AssemblyParser()
+    parser.parse_file(path)
+    assembler.Layouter().layout_program(parser.program)
+    assembler.InstructionEncoder().encode_program(parser.program)
+    binary = assembler.convert_program_to_bytes(parser.program)
+    with timed(results, "decode"):
+        program = disassembler.disassemble_binary(binary)
+    with timed(results, "print"):
+        assembler.AssemblyPrinter(program).print()
+
+
+# Run an assembled input file in the emulator, then step back through it.
+# The generated programs halt at random places, so execution continues after
+# every halt until the number of steps is reached.
+def bench_emulate(path: str, results: Dict[str, float], steps: int = 200000):
+    assembler.parse_cache.clear()
+    binary = emulator.load_image(path)
+    with timed(results, "load"):
+        emu = emulator.Emulator(checkpoint_interval=steps // 16)
+        emu.load_binary(binary)
+    with timed(results, "run"):
+        while emu.steps < steps:
+            emu.run(steps - emu.steps)
+            if emu.halted:
+                emu.set_pc(emu.pc + 1)
+    with timed(results, "reverse"):
+        emu.reverse_step(steps // 3)
+        emu.run_back_to_write(0)
+
+
+# The assembler as a command, and the directory to import it from
+SOFTWARE_DIR = os.path.dirname(os.path.abspath(__file__))
+ASSEMBLER = os.path.join(SOFTWARE_DIR, "assembler.py")
+
+# Import a module in a new interpreter with `-X importtime`. Returns the
+# cumulative seconds of the module and of each module it imports directly,
+# in the order they were imported.
+def import_times(module: str = "assembler") -> Tuple[float, List[Tuple[str, float]]]:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=SOFTWARE_DIR, capture_output=True, text=True, check=True)
+    # Every line is "import time: SELF | CUMULATIVE | NAME", where NAME is
+    # indented by two spaces per level of nesting. A module is listed after
+    # the modules it imports.
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        seconds = int(cumulative) / 1e6
+        if depth == 0 and name.strip() == module:
+            return seconds, children
+        if depth == 0:
+            children = []
+        elif depth == 1:
+            children.append((name.strip(), seconds))
+    raise RuntimeError(f"no import time reported for '{module}'")
+
+# Import the assembler, and assemble an input file with it as a command.
+def bench_startup(path: str, results: Dict[str, float]):
+    results["import"] = import_times()[0]
+    with tempfile.TemporaryDirectory() as tmp:
+        with timed(results, "process"):
+            subprocess.run([sys.executable, ASSEMBLER, path, "-o", os.path.join(tmp, "out.bin")],
+                           check=True)
+
+# Measure the startup of the assembler on a small program, keeping the
+# fastest of `repeat` runs, and print the slowest modules it imports.
+# Returns whether the wall time of a run is within `budget` seconds.
+def check_startup(repeat: int, budget: float, top: int = 8) -> bool:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "startup.s")
+        with open(path, "w") as f:
+            f.write(generate_program(20))
+        # Write the bytecode caches before measuring
+        bench_startup(path, {})
+        best = {}
+        for _ in range(repeat):
+            times = {}
+            bench_startup(path, times)
+            for phase, seconds in times.items():
+                best[phase] = min(seconds, best.get(phase, seconds))
+    _, children = import_times()
+    print(f"import assembler    {best['import']*1000:8.2f}ms")
+    for name, seconds in sorted(children, key=lambda child: -child[1])[:top]:
+        print(f"  {name:<18s}  {seconds*1000:8.2f}ms")
+    print(f"assemble process    {best['process']*1000:8.2f}ms  (budget {budget*1000:.0f}ms)")
+    return best["process"] <= budget
+
+
+# All benchmarks, by name. Every benchmark is called with the path of a
+# generated source file and fills in the seconds spent in each of its phases.
+BENCHMARKS: Dict[str, Callable[[str, Dict[str, float]], None]] = {
+    "assembler": bench_assembler,
+    "compact": bench_compact,
+    "stream": bench_stream,
+    "disassemble": bench_disassemble,
+    "emulate": bench_emulate,
+    "startup": bench_startup,
+}
+
+
+# Run the selected benchmarks on programs of each size. Every benchmark is
+# repeated and the fastest time of each phase is kept. Returns the seconds per
+# phase, keyed by `benchmark.phase/size`.
+def run_benchmarks(names: List[str], sizes: List[int], repeat: int,
+                   verbose: bool = True) -> Dict[str, float]:
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            path = os.path.join(tmp, f"bench_{size}.s")
+            with open(path, "w") as f:
+                f.write(generate_program(size))
+            for name in names:
+                best = {}
+                for _ in range(repeat):
+                    times = {}
+                    BENCHMARKS[name](path, times)
+                    for phase, seconds in times.items():
+                        best[phase] = min(seconds, best.get(phase, seconds))
+                for phase, seconds in best.items():
+                    key = f"{name}.{phase}/{size}"
+                    results[key] = seconds
+                    if verbose:
+                        sys.stderr.write(f"{key:<32s} {seconds*1000:10.2f}ms\n")
+    return results
+
+
+# Compare the results of two benchmark runs. Prints a table of all
+# benchmarks present in both, and returns the keys that became slower by more
+# than `threshold` percent.
+def compare_results(baseline: Dict[str, float], current: Dict[str, float],
+                    threshold: float, min_seconds: float = 0.001) -> List[str]:
+    regressions = []
+    print(f"{'benchmark':<32s} {'baseline':>10s} {'current':>10s} {'change':>8s}")
+    for key in sorted(baseline.keys() & current.keys()):
+        old = baseline[key]
+        new = current[key]
+        change = (new - old) / old * 100 if old > 0 else 0
+        flag = ""
+        # ignore noise on very short timings
+        if max(old, new) >= min_seconds:
+            if change > threshold:
+                flag = "REGRESSION"
+                regressions.append(key)
+            elif change < -threshold:
+                flag = "improved"
+        print(f"{key:<32s} {old*1000:8.2f}ms {new*1000:8.2f}ms "
+              f"{change:+7.1f}%  {flag}")
+    for key in sorted(baseline.keys() - current.keys()):
+        print(f"{key:<32s} missing from current results")
+    return regressions
+
+
+def load_results(path: str) -> Dict[str, float]:
+    with open(path, "r") as f:
+        return json.load(f)["results"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate",
+        help="write a synthetic assembly program")
+    generate.add_argument("lines", type=int, help="number of lines")
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument("-o", "--output", type=str, help="output file")
+
+    run = commands.add_parser("run", help="run the benchmarks")
+    run.add_argument("benchmarks", metavar="NAME", nargs="*",
+        help=f"benchmarks to run; one of {', '.join(BENCHMARKS)} (default: all)")
+    run.add_argument("--sizes", type=str, default="1000,10000",
+        help="comma-separated program sizes in lines, up to 1000000")
+    run.add_argument("--repeat", type=int, default=3,
+        help="number of runs per benchmark; the fastest one is kept")
+    run.add_argument("-o", "--output", type=str,
+        help="write the results as JSON to this file")
+
+    compare = commands.add_parser("compare",
+        help="compare benchmark results against a baseline")
+    compare.add_argument("baseline", help="JSON results of the baseline")
+    compare.add_argument("current", help="JSON results to check")
+    compare.add_argument("--threshold", type=float, default=10.0,
+        help="slowdown in percent that counts as a regression")
+    startup = commands.add_parser("startup",
+        help="check the startup time of the assembler against a budget")
+    startup.add_argument("--budget", type=float, default=50.0,
+        help="maximum wall time in milliseconds to assemble a small program")
+    startup.add_argument("--repeat", type=int, default=10,
+        help="number of runs; the fastest one is kept")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        program = generate_program(args.lines, args.seed)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(program)
+        else:
+            sys.stdout.write(program)
+
+    if args.command == "run":
+        names = args.benchmarks or list(BENCHMARKS)
+        for name in names:
+            if name not in BENCHMARKS:
+                assembler.error(f"unknown benchmark '{name}'")
+        sizes = [int(size) for size in args.sizes.split(",")]
+        results = run_benchmarks(names, sizes, args.repeat)
+        report = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+            "results": results,
+        }
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+                f.write("\n")
+
+    if args.command == "compare":
+        regressions = compare_results(load_results(args.baseline),
+                                      load_results(args.current),
+                                      args.threshold)
+        if regressions:
+            sys.stderr.write(f"{len(regressions)} benchmarks regressed by more "
+                             f"than {args.threshold}%\n")
+            sys.exit(1)
+
+    if args.command == "startup":
+        if not check_startup(args.repeat, args.budget / 1000):
+            sys.stderr.write(f"assembler startup is over the budget of {args.budget:.0f}ms\n")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+# Profile-guided code layout. A program is first run in the emulator to
+# record how often every instruction and every jump was executed:
+#
+#   blocklayout.py profile program.s -o profile.json
+#
+# The basic blocks of the program are then reordered so that hot jumps go to
+# the block placed right after them, and the jump can be left out:
+#
+#   blocklayout.py layout program.s --profile profile.json -o fast.s
+#
+# Blocks that fall through to the next one stay together as a chain. Chains
+# joined by the hottest jumps are merged first, and the merged chains are
+# ordered so that each follows the one it is most often jumped to from,
+# with code that never ran at the end. Far jumps, `ldi lo` / `ldi hi` /
+# `jabsr`, whose registers are overwritten at the target before they are
+# read, become a `jreli` where the target is within reach. Code within reach
+# of a `jrelr` keeps its place relative to it. Jumps removed or
+# shortened this way save their cycles every time they are executed, and the
+# saving is reported both as estimated from the profile and as measured by
+# running both programs. Layout needs a program without `.org` or `.section`,
+# whose relative jumps use labels.
+#
+# Profiles are saved by source location, like code coverage, as JSON:
+#
+#   {"files": {PATH: {"hash": SHA256 of the file, "counts": {OFFSET: COUNT}}},
+#    "edges": [[PATH, OFFSET, TARGET PATH, TARGET OFFSET, COUNT], ...]}
+import argparse
+import json
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import *
+
+from assembler import (AssemblyParser, AssemblyPrinter, Instruction, Layouter,
+                       Opcode, Operand, OperandKind, build_binary, error)
+from codecoverage import EXECUTABLE, JUMPS, file_hash
+from emulator import (CYCLES_PER_INSTRUCTION, MEMORY_WORDS, Emulator,
+                      assemble_program)
+
+# A source location: a file and byte offset
+Location = Tuple[str, int]
+
+
+# A set of blocks `(start, end, target)` like `codecoverage.Coverage.blocks`,
+# which counts how often each block was added. Used in place of a set to
+# record a profile, at the cost of a method call per jump.
+class BlockCounts(dict):
+    def add(self, block: Tuple[int, int, int]):
+        self[block] = self.get(block, 0) + 1
+
+# The blocks executed by an emulator and how often, attached to it in place
+# of a `codecoverage.Coverage`.
+class Profile:
+    def __init__(self):
+        self.blocks = BlockCounts()
+
+    # The number of times every address was executed.
+    def counts(self) -> List[int]:
+        # Add the count of a block at its start and subtract it after its end
+        deltas = [0] * (MEMORY_WORDS + 1)
+        for (start, end, _), count in self.blocks.items():
+            deltas[start] += count
+            deltas[end + 1] -= count
+            if end < start:
+                deltas[0] += count
+                deltas[MEMORY_WORDS] -= count
+        counts = []
+        total = 0
+        for delta in deltas[:MEMORY_WORDS]:
+            total += delta
+            counts.append(total)
+        return counts
+
+
+# Execution counts by source location, and the counts of the jumps between
+# them.
+@dataclass
+class SourceProfile:
+    hashes: Dict[str, str] = field(default_factory=dict)
+    counts: Dict[Location, int] = field(default_factory=dict)
+    edges: Dict[Tuple[Location, Location], int] = field(default_factory=dict)
+
+    # Add the profile of a run of a program with the address of every
+    # instruction filled in.
+    def add_run(self, program: Iterable[Instruction], profile: Profile):
+        locations: Dict[int, Location] = {}
+        jumps: Set[int] = set()
+        for inst in program:
+            if inst.opcode not in EXECUTABLE or inst.file is None:
+                continue
+            path = os.path.realpath(inst.file)
+            if path not in self.hashes:
+                self.hashes[path] = file_hash(path)
+            locations[inst.address] = (path, inst.offset)
+            if inst.opcode in JUMPS:
+                jumps.add(inst.address)
+        counts = profile.counts()
+        for address, location in locations.items():
+            if counts[address]:
+                self.counts[location] = self.counts.get(location, 0) + counts[address]
+        for (_, end, target), count in profile.blocks.items():
+            if end == target or end not in jumps or target not in locations:
+                continue
+            edge = (locations[end], locations[target])
+            self.edges[edge] = self.edges.get(edge, 0) + count
+
+    def write(self, path: str):
+        files = {p: {"hash": h, "counts": {}} for p, h in self.hashes.items()}
+        for (file, offset), count in sorted(self.counts.items()):
+            files[file]["counts"][str(offset)] = count
+        edges = [[*source, *target, count] for (source, target), count in sorted(self.edges.items())]
+        with open(path, "w") as f:
+            json.dump({"files": files, "edges": edges}, f)
+
+    @staticmethod
+    def read(path: str) -> "SourceProfile":
+        profile = SourceProfile()
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            for file, entry in data["files"].items():
+                profile.hashes[file] = entry["hash"]
+                for offset, count in entry["counts"].items():
+                    profile.counts[(file, int(offset))] = count
+            for file, offset, target_file, target_offset, count in data["edges"]:
+                profile.edges[((file, offset), (target_file, target_offset))] = count
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            error(f"cannot read profile '{path}': {e}")
+        for file, hash in profile.hashes.items():
+            if not os.path.exists(file) or file_hash(file) != hash:
+                error(f"profile '{path}' was recorded from another version of '{os.path.relpath(file)}'")
+        return profile
+
+
+# Run the binary image of a program with the address and encoding of every
+# instruction filled in, and record its profile. Returns the profile and the
+# emulator after the run.
+def profile_program(binary: bytes, program: List[Instruction],
+                    steps: int) -> Tuple[SourceProfile, Emulator]:
+    emulator = Emulator()
+    emulator.load_binary(binary)
+    emulator.coverage = Profile()
+    emulator.run(steps)
+    profile = SourceProfile()
+    profile.add_run(program, emulator.coverage)
+    return profile, emulator
+
+
+# A basic block: labels followed by instructions, up to and including a
+# jump or halt.
+@dataclass
+class Block:
+    instructions: List[Instruction]
+    # Executions of the first instruction
+    count: int = 0
+    # Whether the block may be the target of a `jrelr`, and so must keep its
+    # distance to it
+    fixed: bool = False
+
+    @property
+    def labels(self) -> List[str]:
+        return [inst.operands[0].value for inst in self.instructions
+                if inst.opcode == Opcode.D_LABEL]
+
+    # The label the jump at the end of the block always goes to, if any
+    def static_jump(self) -> Optional[str]:
+        last = self.instructions[-1]
+        if last.opcode == Opcode.JRELI and last.symbol is not None:
+            return last.symbol[1]
+        if (far := far_jump(self.instructions)) is not None:
+            return far[0]
+        return None
+
+# The target label and registers of a far jump at the end of a list of
+# instructions: `ldi rX, lo(L)`, `ldi rY, hi(L)` and `jabsr rXrY`, in either
+# order of the `ldi`s.
+def far_jump(insts: List[Instruction]) -> Optional[Tuple[str, Set[int]]]:
+    if len(insts) < 3 or insts[-1].opcode != Opcode.JABSR:
+        return None
+    first, second, jump = insts[-3:]
+    pair = jump.operands[0].value
+    if not (first.opcode == Opcode.LDI and second.opcode == Opcode.LDI and
+            first.symbol is not None and second.symbol is not None):
+        return None
+    loads = {first.symbol[0]: first, second.symbol[0]: second}
+    if (set(loads) == {"lo", "hi"} and first.symbol[1] == second.symbol[1] and
+            loads["lo"].operands[0].value == pair and loads["hi"].operands[0].value == pair + 1):
+        return first.symbol[1], {pair, pair + 1}
+    return None
+
+# Instructions after which execution does not continue with the next one
+TRANSFERS = {Opcode.JRELI, Opcode.JABSR, Opcode.HALT}
+
+# Split a program into blocks, and the blocks into chains that must stay
+# together. A block stays after the one before it unless that ends with a
+# jump or halt and the block starts with a label, so it can only be reached
+# by a jump to the label. The targets of a `jrelr` are only known at run
+# time, so all blocks within its reach stay where they are relative to it.
+def split_chains(program: List[Instruction]) -> List[List[Block]]:
+    blocks = [Block([])]
+    for inst in program:
+        current = blocks[-1]
+        if inst.opcode == Opcode.D_LABEL and any(i.opcode != Opcode.D_LABEL
+                                                 for i in current.instructions):
+            current = Block([])
+            blocks.append(current)
+        current.instructions.append(inst)
+        if inst.opcode in TRANSFERS or inst.opcode == Opcode.JRELR:
+            blocks.append(Block([]))
+    blocks = [block for block in blocks if block.instructions]
+
+    # Index of the chain of every block
+    chain_index = [0] * len(blocks)
+    for i in range(1, len(blocks)):
+        starts_chain = (blocks[i - 1].instructions[-1].opcode in TRANSFERS and
+                        blocks[i].instructions[0].opcode == Opcode.D_LABEL)
+        chain_index[i] = chain_index[i - 1] + starts_chain
+
+    Layouter().layout_program(program)
+    for block in blocks:
+        jump = block.instructions[-1]
+        if jump.opcode != Opcode.JRELR:
+            continue
+        reach = [i for i, other in enumerate(blocks)
+                 if other.instructions[0].address <= jump.address + 127 and
+                 other.instructions[-1].address >= jump.address - 128]
+        first, last = chain_index[reach[0]], chain_index[reach[-1]]
+        for i in reach:
+            blocks[i].fixed = True
+        chain_index = [first if first <= index <= last else index for index in chain_index]
+
+    chains: Dict[int, List[Block]] = {}
+    for block, index in zip(blocks, chain_index):
+        chains.setdefault(index, []).append(block)
+    return list(chains.values())
+
+# Whether the given registers are all written before they are read, from
+# the start of a block on. Only the block itself is looked at, so registers
+# still unwritten at its end count as read.
+def registers_dead(block: Block, registers: Set[int]) -> bool:
+    pending = set(registers)
+    for inst in block.instructions:
+        reads = set()
+        if inst.opcode == Opcode.MV:
+            reads = {inst.operands[1].value}
+        elif inst.opcode == Opcode.JABSR:
+            reads = {inst.operands[0].value, inst.operands[0].value + 1}
+        elif inst.opcode == Opcode.JRELR:
+            reads = {inst.operands[0].value}
+        if pending & reads:
+            return False
+        if inst.opcode in (Opcode.LDI, Opcode.MV):
+            pending.discard(inst.operands[0].value)
+        if not pending:
+            return True
+        if inst.opcode in TRANSFERS or inst.opcode == Opcode.JRELR:
+            return False
+    return False
+
+
+# Reorders the blocks of a program by a profile.
+class BlockLayout:
+    def __init__(self, program: List[Instruction], profile: SourceProfile):
+        for inst in program:
+            if inst.opcode in (Opcode.D_ORG, Opcode.D_SECTION):
+                error("profile-guided layout needs a program without .org or .section", inst)
+            if (inst.opcode == Opcode.JRELI and inst.symbol is None and
+                    inst.operands[0].value != 0):
+                error("profile-guided layout needs relative jumps to use labels", inst)
+        self.profile = profile
+        self.chains = split_chains([inst for inst in program if inst.opcode != Opcode.D_INCLUDE])
+        self.blocks = [block for chain in self.chains for block in chain]
+        self.block_of_label = {label: block for block in self.blocks for label in block.labels}
+        block_of_location: Dict[Location, Block] = {}
+        for block in self.blocks:
+            for inst in block.instructions:
+                if inst.opcode in EXECUTABLE and inst.file is not None:
+                    block_of_location[(os.path.realpath(inst.file), inst.offset)] = block
+            block.count = next((self.count_of(inst) for inst in block.instructions
+                                if inst.opcode in EXECUTABLE), 0)
+        # Executions of the jumps between two blocks, by the ids of the blocks
+        self.edges: Dict[Tuple[int, int], int] = {}
+        for (source, target), count in profile.edges.items():
+            if source in block_of_location and target in block_of_location:
+                key = (id(block_of_location[source]), id(block_of_location[target]))
+                self.edges[key] = self.edges.get(key, 0) + count
+
+    # Executions of an instruction in the profile
+    def count_of(self, inst: Instruction) -> int:
+        if inst.file is None:
+            return 0
+        return self.profile.counts.get((os.path.realpath(inst.file), inst.offset), 0)
+
+    # Merge chains along the hottest jumps to a label, such that the target
+    # follows the jump. The first chain holds the entry point and stays first.
+    def merge_chains(self) -> List[List[Block]]:
+        chain_of = {id(block): i for i, chain in enumerate(self.chains) for block in chain}
+        chains = dict(enumerate(self.chains))
+        jumps = []
+        for block in self.blocks:
+            label = block.static_jump()
+            if label in self.block_of_label and not block.fixed:
+                target = self.block_of_label[label]
+                if count := self.edges.get((id(block), id(target)), 0):
+                    jumps.append((count, block, target))
+        for _, block, target in sorted(jumps, key=lambda jump: -jump[0]):
+            source, destination = chain_of[id(block)], chain_of[id(target)]
+            if (source == destination or destination == 0 or chains[source][-1] is not block or
+                    chains[destination][0] is not target):
+                continue
+            chains[source] += chains.pop(destination)
+            for moved in chains[source]:
+                chain_of[id(moved)] = source
+        return [chains[i] for i in sorted(chains)]
+
+    # Order merged chains: each next chain is the one with the most jumps
+    # between it and the chains placed so far. Chains that never ran go last,
+    # in their original order.
+    def order_chains(self, chains: List[List[Block]]) -> List[List[Block]]:
+        weight = lambda chain: sum(block.count for block in chain)
+        placed = [chains[0]]
+        placed_ids = {id(block) for block in chains[0]}
+        remaining = [chain for chain in chains[1:] if weight(chain)]
+        while remaining:
+            def affinity(chain: List[Block]) -> int:
+                ids = {id(block) for block in chain}
+                return sum(count for (a, b), count in self.edges.items()
+                           if (a in placed_ids and b in ids) or (b in placed_ids and a in ids))
+            best = max(remaining, key=lambda chain: (affinity(chain), weight(chain)))
+            remaining.remove(best)
+            placed.append(best)
+            placed_ids.update(id(block) for block in best)
+        return placed + [chain for chain in chains[1:] if not weight(chain)]
+
+    # Lay out the program with the chains in the given order, leaving out
+    # jumps to the next block and shortening far jumps where possible.
+    # Returns the program and the estimated number of cycles saved.
+    def build(self, chains: List[List[Block]]) -> Tuple[List[Instruction], int]:
+        order = [block for chain in chains for block in chain]
+        saved = 0
+        bodies: Dict[int, List[Instruction]] = {}
+        # Blocks ending with a far jump that may become a `jreli`
+        far_blocks: List[Block] = []
+        for index, block in enumerate(order):
+            insts = bodies[id(block)] = list(block.instructions)
+            label = block.static_jump()
+            if block.fixed or label not in self.block_of_label:
+                continue
+            target = self.block_of_label[label]
+            far = far_jump(insts)
+            dead = far is not None and registers_dead(target, far[1])
+            if index + 1 < len(order) and order[index + 1] is target:
+                # Fall through to the target. A far jump must still load its
+                # registers, unless the target overwrites them.
+                removed = 3 if dead else 1
+                saved += removed * self.count_of(insts[-1]) * CYCLES_PER_INSTRUCTION
+                del insts[-removed:]
+            elif dead:
+                far_blocks.append(block)
+
+        # Turn far jumps into a `jreli` where the target is within reach.
+        # That only brings other code closer, so jumps in reach stay in reach.
+        shortened: Set[int] = set()
+        while True:
+            program = self.concatenate(order, bodies, shortened)
+            addresses = {inst.operands[0].value: inst.address for inst in program
+                         if inst.opcode == Opcode.D_LABEL}
+            progress = False
+            for block in far_blocks:
+                if id(block) in shortened:
+                    continue
+                insts = bodies[id(block)]
+                offset = addresses[far_jump(insts)[0]] - insts[-3].address
+                # The jump is two words shorter, which moves a later target
+                # closer
+                if -128 <= (offset - 2 if offset > 0 else offset) < 128:
+                    shortened.add(id(block))
+                    saved += 2 * self.count_of(insts[-1]) * CYCLES_PER_INSTRUCTION
+                    progress = True
+            if not progress:
+                return program, saved
+
+    # Concatenate the blocks, with the far jumps of the `shortened` blocks
+    # replaced by a `jreli`, and lay out the result.
+    def concatenate(self, order: List[Block], bodies: Dict[int, List[Instruction]],
+                    shortened: Set[int]) -> List[Instruction]:
+        program = []
+        for block in order:
+            insts = bodies[id(block)]
+            if id(block) in shortened:
+                jump = Instruction(Opcode.JRELI, [Operand(OperandKind.Imm, 0)],
+                                   file=insts[-3].file, offset=insts[-3].offset,
+                                   symbol=("rel", far_jump(insts)[0]))
+                insts = insts[:-3] + [jump]
+            program += insts
+        Layouter().layout_program(program)
+        return program
+
+    # Whether every `jreli` of a laid out program reaches its label.
+    @staticmethod
+    def jumps_in_reach(program: List[Instruction]) -> bool:
+        addresses = {inst.operands[0].value: inst.address for inst in program
+                     if inst.opcode == Opcode.D_LABEL}
+        return all(-128 <= addresses[inst.symbol[1]] - inst.address < 128
+                   for inst in program if inst.opcode == Opcode.JRELI and
+                   inst.symbol is not None and inst.symbol[1] in addresses)
+
+    # Lay out the program by the profile. Keeps the original order of the
+    # chains if moving them puts a `jreli` out of reach of its label.
+    # Returns the program and the estimated number of cycles saved.
+    def layout(self) -> Tuple[List[Instruction], int]:
+        program, saved = self.build(self.order_chains(self.merge_chains()))
+        if self.jumps_in_reach(program):
+            return program, saved
+        sys.stderr.write("warning: reordering puts jumps out of reach, keeping the original order\n")
+        return self.build(self.chains)
+
+
+# Write a program as assembly source. Included files are already part of
+# the program, and binary files are referenced by absolute path.
+def write_source(program: List[Instruction], path: str):
+    printed = []
+    for inst in program:
+        inst.address = inst.encoding = None
+        if inst.opcode == Opcode.D_INCBIN:
+            inst.operands[0].value = os.path.abspath(inst.operands[0].value)
+        printed.append(inst)
+    with open(path, "w") as f:
+        AssemblyPrinter(printed, emit_address=False, emit_encoding=False).write(f)
+
+
+# Run a program before and after layout and print the cycles saved. Programs
+# that do not halt are compared by how often the hottest instruction of the
+# original, which is kept by the layout, ran in the same number of cycles.
+def measure(original: Tuple[bytes, List[Instruction]], program: List[Instruction],
+            steps: int):
+    before, before_emulator = profile_program(*original, steps)
+    after, after_emulator = profile_program(build_binary(program, "<layout>"), program, steps)
+    if before_emulator.halted and after_emulator.halted:
+        cycles, new_cycles = before_emulator.cycles, after_emulator.cycles
+        share = (cycles - new_cycles) / cycles * 100 if cycles else 0
+        print(f"measured: {cycles} -> {new_cycles} cycles, "
+              f"{cycles - new_cycles} cycles ({share:.1f}%) saved")
+        return
+    kept = [location for location in before.counts if location in after.counts]
+    if not kept:
+        print(f"measured: no instruction ran in both programs within {steps} steps")
+        return
+    hottest = max(kept, key=lambda location: before.counts[location])
+    runs, new_runs = before.counts[hottest], after.counts[hottest]
+    print(f"measured: in {steps * CYCLES_PER_INSTRUCTION} cycles, the hottest instruction "
+          f"ran {runs} -> {new_runs} times, {new_runs / runs:.2f}x as often")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    profile_parser = subparsers.add_parser("profile",
+        help="run a program and record how often every instruction and jump executed")
+    profile_parser.add_argument("input", metavar="INPUT",
+        help="assembly source to run")
+    profile_parser.add_argument("-o", "--output", type=str, required=True,
+        help="profile file to write")
+    profile_parser.add_argument("-n", "--steps", type=int, default=10**7,
+        help="maximum number of instructions to execute")
+
+    layout_parser = subparsers.add_parser("layout",
+        help="reorder the blocks of a program by a profile")
+    layout_parser.add_argument("input", metavar="INPUT",
+        help="assembly source to reorder")
+    layout_parser.add_argument("--profile", type=str, required=True,
+        help="profile recorded with the profile command")
+    layout_parser.add_argument("-o", "--output", type=str, required=True,
+        help="assembly source to write")
+    layout_parser.add_argument("-n", "--steps", type=int, default=10**7,
+        help="maximum number of instructions to execute when measuring")
+    args = parser.parse_args()
+
+    if args.command == "profile":
+        profile, emulator = profile_program(*assemble_program(args.input), args.steps)
+        profile.write(args.output)
+        emulator.print_state()
+    elif args.command == "layout":
+        profile = SourceProfile.read(args.profile)
+        source = AssemblyParser()
+        source.parse_file(args.input)
+        program, estimated = BlockLayout(source.program, profile).layout()
+        write_source(program, args.output)
+
+        print(f"estimated from the profile: {estimated} cycles saved")
+        measure(assemble_program(args.input), program, args.steps)
+
+if __name__ == "__main__":
+    main()
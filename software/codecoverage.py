@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# Code coverage of programs run in the emulator. While a `Coverage` is
+# attached to an emulator, the step loops record every run of instructions
+# up to a jump as a block `(start, end, target)`, where `target` is where the
+# jump at `end` went. The blocks are turned into a flag per executed address
+# afterwards, so instructions that do not jump cost nothing.
+#
+# Coverage is saved by source location rather than by address, so that the
+# coverage of different programs including the same files can be merged.
+# Every file has a bitmap with a bit per byte offset, set at the offsets of
+# executed instructions, and merging ORs the bitmaps. The targets of jumps
+# are kept as sets of source locations. Coverage files are JSON:
+#
+#   {"files": {PATH: {"hash": SHA256 of the file,
+#                     "executed": the bitmap as a hex number,
+#                     "jumps": {OFFSET: [[PATH, OFFSET], ...]}}}}
+#
+# Jump targets that are not an instruction of the program are stored as
+# [null, ADDRESS]. Binary images are their own source file, with the byte
+# offset of every word as its location.
+import argparse
+import hashlib
+import json
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import *
+
+from assembler import (AssemblyParser, AssemblyPrinter, Instruction, Opcode,
+                       count_newlines, error)
+from disassembler import disassemble_binary
+from emulator import MEMORY_WORDS, Emulator, assemble_program, load_image
+
+# Opcodes of the instructions that are executed, and of the jumps among them
+EXECUTABLE = {Opcode.LDI, Opcode.MV, Opcode.JABSR, Opcode.JRELI, Opcode.JRELR,
+              Opcode.NOP, Opcode.HALT}
+JUMPS = {Opcode.JABSR, Opcode.JRELI, Opcode.JRELR}
+# Jumps whose target depends on registers
+REGISTER_JUMPS = {Opcode.JABSR, Opcode.JRELR}
+
+# A source location: a file and byte offset, or None and an address
+Location = Tuple[Optional[str], int]
+
+
+# The blocks executed by an emulator. Blocks that end without a jump, because
+# a run stopped, have the address after their end as target.
+class Coverage:
+    def __init__(self):
+        self.blocks: Set[Tuple[int, int, int]] = set()
+
+    # A non-zero byte for every executed address.
+    def hits(self) -> bytearray:
+        hits = bytearray(MEMORY_WORDS)
+        for start, end, _ in self.blocks:
+            if end >= start:
+                hits[start:end + 1] = b"\x01" * (end + 1 - start)
+            else:
+                hits[start:] = b"\x01" * (MEMORY_WORDS - start)
+                hits[:end + 1] = b"\x01" * (end + 1)
+        return hits
+
+    # The addresses every jump went to, by the address of the jump.
+    def targets(self) -> Dict[int, Set[int]]:
+        targets: Dict[int, Set[int]] = {}
+        for _, end, target in self.blocks:
+            targets.setdefault(end, set()).add(target)
+        return targets
+
+
+# Coverage of source files, merged from any number of runs.
+@dataclass
+class SourceCoverage:
+    # Hash of the contents of every file, by real path
+    hashes: Dict[str, str] = field(default_factory=dict)
+    # Bitmap of the offsets of executed instructions, by file
+    executed: Dict[str, int] = field(default_factory=dict)
+    # Targets taken by the jumps of every file, by offset of the jump
+    jumps: Dict[str, Dict[int, Set[Location]]] = field(default_factory=dict)
+
+    def add_file(self, path: str, hash: str):
+        if path not in self.hashes:
+            self.hashes[path] = hash
+            self.executed[path] = 0
+            self.jumps[path] = {}
+        elif self.hashes[path] != hash:
+            error(f"coverage of '{os.path.relpath(path)}' was recorded from different "
+                  f"versions of the file")
+
+    # Add the coverage of a run of a program. The program must have the
+    # address of every instruction filled in.
+    def add_run(self, program: Iterable[Instruction], coverage: Coverage):
+        paths: Dict[str, str] = {}
+        bitmaps: Dict[str, bytearray] = {}
+        locations: Dict[int, Tuple[Opcode, str, int]] = {}
+        for inst in program:
+            if inst.opcode not in EXECUTABLE or inst.file is None or inst.address is None:
+                continue
+            if (path := paths.get(inst.file)) is None:
+                path = paths[inst.file] = os.path.realpath(inst.file)
+                self.add_file(path, file_hash(path))
+                bitmaps[path] = bytearray(os.path.getsize(path) // 8 + 1)
+            locations[inst.address] = (inst.opcode, path, inst.offset)
+
+        hits = coverage.hits()
+        for address, (_, path, offset) in locations.items():
+            if hits[address]:
+                bitmaps[path][offset >> 3] |= 1 << (offset & 7)
+        for path, bitmap in bitmaps.items():
+            self.executed[path] |= int.from_bytes(bitmap, "little")
+
+        for address, targets in coverage.targets().items():
+            if (location := locations.get(address)) is None or location[0] not in JUMPS:
+                continue
+            _, path, offset = location
+            taken = self.jumps[path].setdefault(offset, set())
+            for target in targets:
+                if (target_location := locations.get(target)) is not None:
+                    taken.add(target_location[1:])
+                else:
+                    taken.add((None, target))
+
+    def merge(self, other: "SourceCoverage"):
+        for path, hash in other.hashes.items():
+            self.add_file(path, hash)
+            self.executed[path] |= other.executed[path]
+            for offset, targets in other.jumps[path].items():
+                self.jumps[path].setdefault(offset, set()).update(targets)
+
+    def write(self, path: str):
+        files = {
+            file: {
+                "hash": hash,
+                "executed": f"{self.executed[file]:x}",
+                "jumps": {str(offset): sorted(targets, key=lambda t: (t[0] or "", t[1]))
+                          for offset, targets in sorted(self.jumps[file].items())},
+            }
+            for file, hash in sorted(self.hashes.items())
+        }
+        with open(path, "w") as f:
+            json.dump({"files": files}, f)
+
+    @staticmethod
+    def read(path: str) -> "SourceCoverage":
+        try:
+            with open(path, "r") as f:
+                files = json.load(f)["files"]
+            coverage = SourceCoverage()
+            for file, entry in files.items():
+                coverage.hashes[file] = entry["hash"]
+                coverage.executed[file] = int(entry["executed"], 16)
+                coverage.jumps[file] = {int(offset): set(map(tuple, targets))
+                                        for offset, targets in entry["jumps"].items()}
+        except OSError as e:
+            error(f"cannot read coverage '{path}': {e.strerror}")
+        except (ValueError, KeyError, TypeError):
+            error(f"'{path}' is not a coverage file")
+        return coverage
+
+
+def file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# Read a binary image, or assemble a source file. Returns the image and its
+# instructions with their addresses and source locations.
+def load_program(path: str) -> Tuple[bytes, List[Instruction]]:
+    if path.endswith(".s"):
+        return assemble_program(path)
+    binary = load_image(path)
+    program = disassemble_binary(binary)
+    for inst in program:
+        inst.file, inst.offset = path, 2 * inst.address
+    return binary, program
+
+# The instructions of a covered file, with their offsets. Source files are
+# parsed without expanding includes, and binary images are disassembled.
+def file_instructions(path: str) -> List[Instruction]:
+    if path.endswith(".s"):
+        return list(AssemblyParser(cache=False).tokenize_file(path))
+    return load_program(path)[1]
+
+
+# Counts of covered and total instructions and jumps of a file
+@dataclass
+class FileSummary:
+    path: str
+    executed: int = 0
+    instructions: int = 0
+    taken: int = 0
+    jumps: int = 0
+
+def percentage(count: int, total: int) -> str:
+    return f"{100 * count / total:5.1f}%" if total else "    -"
+
+# Print a listing of every covered file with the coverage of every
+# instruction, followed by a summary. Instructions that never ran are marked
+# with `#####`, and register jumps list the locations they went to.
+def print_report(coverage: SourceCoverage, listing: bool = True, file: TextIO = sys.stdout):
+    sources: Dict[str, bytes] = {}
+    summaries = []
+    for path in sorted(coverage.hashes):
+        if not os.path.exists(path) or file_hash(path) != coverage.hashes[path]:
+            error(f"'{os.path.relpath(path)}' changed since its coverage was recorded")
+        program = file_instructions(path)
+        executed = coverage.executed[path].to_bytes(os.path.getsize(path) // 8 + 1, "little")
+        jumps = coverage.jumps[path]
+        summary = FileSummary(os.path.relpath(path))
+        summaries.append(summary)
+        is_source = path.endswith(".s")
+        line, line_offset = 1, 0
+        printer = AssemblyPrinter(program, emit_address=not is_source, emit_encoding=not is_source)
+        if listing:
+            file.write(f"== {summary.path}\n")
+        for inst in program:
+            note = ""
+            if inst.opcode not in EXECUTABLE:
+                mark = "     "
+            else:
+                hit = executed[inst.offset >> 3] >> (inst.offset & 7) & 1
+                mark = "    +" if hit else "#####"
+                summary.instructions += 1
+                summary.executed += hit
+                if inst.opcode in JUMPS:
+                    summary.jumps += 1
+                    summary.taken += hit
+                if inst.opcode in REGISTER_JUMPS and inst.offset in jumps:
+                    targets = sorted(jumps[inst.offset], key=lambda t: (t[0] or "", t[1]))
+                    note = "  # -> " + ", ".join(format_target(path, target, sources)
+                                                 for target in targets)
+            if listing and is_source:
+                # Instructions are in the order of the file
+                line += source_text(path, sources).count(b"\n", line_offset, inst.offset)
+                line_offset = inst.offset
+                file.write(f"{mark} {line:>5d}: {printer.format_instruction(inst).rstrip()}{note}\n")
+            elif listing:
+                file.write(f"{mark} {printer.format_instruction(inst).rstrip()}{note}\n")
+        if listing:
+            file.write("\n")
+
+    total = FileSummary("total")
+    for summary in summaries:
+        total.executed += summary.executed
+        total.instructions += summary.instructions
+        total.taken += summary.taken
+        total.jumps += summary.jumps
+    width = max(len(s.path) for s in summaries + [total])
+    for summary in summaries + [total]:
+        file.write(f"{summary.path:<{width}s}  "
+                   f"instructions {summary.executed:>6d}/{summary.instructions:<6d} "
+                   f"{percentage(summary.executed, summary.instructions)}  "
+                   f"jumps {summary.taken:>5d}/{summary.jumps:<5d} "
+                   f"{percentage(summary.taken, summary.jumps)}\n")
+
+# The contents of a source file, read once per report.
+def source_text(path: str, sources: Dict[str, bytes]) -> bytes:
+    if path not in sources:
+        with open(path, "rb") as f:
+            sources[path] = f.read()
+    return sources[path]
+
+# Describe a jump target relative to the file of the jump.
+def format_target(path: str, target: Location, sources: Dict[str, bytes]) -> str:
+    target_path, offset = target
+    if target_path is None:
+        return f"0x{offset:04X}"
+    if target_path.endswith(".s"):
+        line = 1 + count_newlines(source_text(target_path, sources), offset)
+        if target_path == path:
+            return f"line {line}"
+        return f"{os.path.relpath(target_path)}:{line}"
+    if target_path == path:
+        return f"0x{offset // 2:04X}"
+    return f"{os.path.relpath(target_path)}:0x{offset // 2:04X}"
+
+def merge_files(paths: List[str]) -> SourceCoverage:
+    coverage = SourceCoverage()
+    for path in paths:
+        coverage.merge(SourceCoverage.read(path))
+    return coverage
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run",
+        help="run a program and save which of its instructions were executed")
+    run.add_argument("input", metavar="INPUT",
+        help="binary image or assembly source to run")
+    run.add_argument("-o", "--output", type=str, required=True,
+        help="coverage file to write")
+    run.add_argument("-n", "--steps", type=int, default=10**7,
+        help="maximum number of instructions to execute")
+
+    merge = commands.add_parser("merge", help="combine coverage files")
+    merge.add_argument("inputs", metavar="COVERAGE", nargs="+",
+        help="coverage files to merge")
+    merge.add_argument("-o", "--output", type=str, required=True,
+        help="coverage file to write")
+
+    report = commands.add_parser("report",
+        help="print the covered files annotated with their coverage")
+    report.add_argument("inputs", metavar="COVERAGE", nargs="+",
+        help="coverage files, which are merged")
+    report.add_argument("--summary", action="store_true",
+        help="only print the coverage of every file")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        binary, program = load_program(args.input)
+        emulator = Emulator()
+        emulator.load_binary(binary)
+        emulator.coverage = Coverage()
+        emulator.run(args.steps)
+        coverage = SourceCoverage()
+        coverage.add_run(program, emulator.coverage)
+        coverage.write(args.output)
+        emulator.print_state()
+
+    if args.command == "merge":
+        merge_files(args.inputs).write(args.output)
+
+    if args.command == "report":
+        print_report(merge_files(args.inputs), listing=not args.summary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# An interactive debugger for programs running in the emulator. Supports
+# breakpoints, register watchpoints, stepping forwards and backwards, and
+# disassembling memory. Type `help` at the prompt for a list of commands.
+import argparse
+import cmd
+import shlex
+from typing import *
+
+from assembler import AssemblyPrinter
+from disassembler import decode_instruction
+from emulator import NUM_REGISTERS, Emulator, load_image
+
+
+class DebuggerError(Exception):
+    pass
+
+def parse_number(text: str) -> int:
+    try:
+        return int(text, 0)
+    except ValueError:
+        raise DebuggerError(f"expected a number, found '{text}'")
+
+def parse_register(text: str) -> int:
+    if len(text) == 2 and text[0] == "r" and text[1].isdigit():
+        if int(text[1]) < NUM_REGISTERS:
+            return int(text[1])
+    raise DebuggerError(f"expected a register r0 to r{NUM_REGISTERS - 1}, found '{text}'")
+
+def parse_args(line: str, min_args: int, max_args: int) -> List[str]:
+    try:
+        args = shlex.split(line)
+    except ValueError as e:
+        raise DebuggerError(str(e).lower())
+    if not min_args <= len(args) <= max_args:
+        raise DebuggerError("wrong number of arguments")
+    return args
+
+
+class Debugger(cmd.Cmd):
+    prompt = "(dbg) "
+
+    def __init__(self, emulator: Emulator, stdout=None):
+        super().__init__(stdout=stdout)
+        self.emulator = emulator
+
+    def onecmd(self, line: str) -> bool:
+        try:
+            return super().onecmd(line)
+        except DebuggerError as e:
+            self.stdout.write(f"error: {e}\n")
+            return False
+
+    def emptyline(self) -> bool:
+        return False
+
+    def default(self, line: str):
+        raise DebuggerError(f"unknown command '{line.split()[0]}'")
+
+    def format_instruction(self, address: int) -> str:
+        inst = decode_instruction(self.emulator.memory.read(address), address)
+        return AssemblyPrinter([inst]).print().rstrip("\n")
+
+    def print_location(self):
+        emu = self.emulator
+        if emu.stop is not None:
+            self.stdout.write(f"stopped at {emu.stop}\n")
+        elif emu.halted:
+            self.stdout.write("halted\n")
+        self.stdout.write(self.format_instruction(emu.pc) + "\n")
+
+    def do_break(self, line: str):
+        "break ADDRESS: stop before executing the instruction at ADDRESS"
+        address, = parse_args(line, 1, 1)
+        self.emulator.add_breakpoint(parse_number(address))
+
+    def do_delete(self, line: str):
+        "delete ADDRESS: remove the breakpoint at ADDRESS"
+        address, = parse_args(line, 1, 1)
+        self.emulator.remove_breakpoint(parse_number(address))
+
+    def do_watch(self, line: str):
+        "watch REG: stop after an instruction changes REG"
+        register, = parse_args(line, 1, 1)
+        self.emulator.add_watchpoint(parse_register(register))
+
+    def do_unwatch(self, line: str):
+        "unwatch REG: remove the watchpoint on REG"
+        register, = parse_args(line, 1, 1)
+        self.emulator.remove_watchpoint(parse_register(register))
+
+    def do_info(self, line: str):
+        "info: list breakpoints, watchpoints and checkpoints"
+        parse_args(line, 0, 0)
+        emu = self.emulator
+        breakpoints = " ".join(f"{a:04X}" for a in emu.breakpoint_addresses())
+        watchpoints = " ".join(f"r{r}" for r in emu.watched_registers())
+        checkpoints = " ".join(str(c.steps) for c in emu.checkpoints)
+        self.stdout.write(f"breakpoints: {breakpoints or '-'}\n"
+                          f"watchpoints: {watchpoints or '-'}\n"
+                          f"checkpoints at steps: {checkpoints}\n")
+
+    def do_continue(self, line: str):
+        "continue [COUNT]: run until a breakpoint, watchpoint or halt"
+        args = parse_args(line, 0, 1)
+        self.emulator.run(parse_number(args[0]) if args else 10**12)
+        self.print_location()
+
+    def do_step(self, line: str):
+        "step [COUNT]: execute COUNT instructions (default: 1)"
+        args = parse_args(line, 0, 1)
+        self.emulator.run(parse_number(args[0]) if args else 1)
+        self.print_location()
+
+    def do_rstep(self, line: str):
+        "rstep [COUNT]: step backwards by COUNT instructions (default: 1)"
+        args = parse_args(line, 0, 1)
+        self.emulator.stop = None
+        self.emulator.reverse_step(parse_number(args[0]) if args else 1)
+        self.print_location()
+
+    def do_rwatch(self, line: str):
+        "rwatch REG: run back to the last instruction that wrote REG"
+        register, = parse_args(line, 1, 1)
+        self.emulator.stop = None
+        if not self.emulator.run_back_to_write(parse_register(register)):
+            raise DebuggerError(f"{register} was not written since reset")
+        self.print_location()
+
+    def do_goto(self, line: str):
+        "goto STEPS: go to the state after STEPS instructions, forwards or backwards"
+        text, = parse_args(line, 1, 1)
+        steps = parse_number(text)
+        if steps < 0:
+            raise DebuggerError("cannot go back past reset")
+        self.emulator.stop = None
+        self.emulator.run_to(steps)
+        self.print_location()
+
+    def do_regs(self, line: str):
+        "regs: print the registers, pc and step count"
+        parse_args(line, 0, 0)
+        self.emulator.print_state(self.stdout)
+
+    def do_set(self, line: str):
+        "set REG|pc VALUE: change a register or the pc"
+        target, value = parse_args(line, 2, 2)
+        if target == "pc":
+            self.emulator.set_pc(parse_number(value))
+        else:
+            self.emulator.set_register(parse_register(target), parse_number(value))
+
+    def do_list(self, line: str):
+        "list [ADDRESS [COUNT]]: disassemble COUNT words at ADDRESS (default: pc)"
+        args = parse_args(line, 0, 2)
+        address = parse_number(args[0]) if args else self.emulator.pc
+        count = parse_number(args[1]) if len(args) > 1 else 8
+        for a in range(address, min(address + count, 1 << 16)):
+            marker = ">" if a == self.emulator.pc else "*" if self.emulator.breakpoints[a] else " "
+            self.stdout.write(f"{marker} {self.format_instruction(a)}\n")
+
+    def do_quit(self, line: str) -> bool:
+        "quit: exit the debugger"
+        return True
+
+    do_EOF = do_quit
+    do_b = do_break
+    do_c = do_continue
+    do_s = do_step
+    do_q = do_quit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", metavar="INPUT",
+        help="binary image or assembly source to debug")
+    parser.add_argument("-b", "--break", dest="breakpoints", action="append",
+        type=lambda x: int(x, 0), default=[],
+        help="set a breakpoint at an address; may be repeated")
+    parser.add_argument("-x", "--commands", type=str,
+        help="file of debugger commands to run before the prompt")
+    args = parser.parse_args()
+
+    emulator = Emulator()
+    emulator.load_binary(load_image(args.input))
+    for address in args.breakpoints:
+        emulator.add_breakpoint(address)
+    debugger = Debugger(emulator)
+    if args.commands:
+        with open(args.commands, "r") as f:
+            for line in f:
+                if debugger.onecmd(line.strip()):
+                    return
+    debugger.print_location()
+    debugger.cmdloop()
+
+if __name__ == "__main__":
+    main()
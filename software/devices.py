@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# Peripheral devices for the emulator, to run programs that do I/O without
+# the hardware. The CPU has no load or store instructions, so devices are
+# connected in the two ways a program can reach them:
+#
+# - Output devices are mapped to a register and receive every value written
+#   to it, like a latch that drives a display from the register.
+# - Input devices own an `ldi` instruction in memory and keep its immediate
+#   set to their current value. The program reads an input by calling the
+#   instruction, which is followed by a jump back:
+#
+#       read_switches:
+#           ldi r0, 0       # immediate set by the device
+#           jabsr r5r6
+#
+# Timed inputs, like a timer or a scripted change of a switch, are events
+# scheduled on the emulator. Run a program headless with, for example:
+#
+#   devices.py program.s --output r6 --timer read_timer:1000 \
+#       --input read_switches=5000:0x01,9000:0x00
+import argparse
+import sys
+from collections import deque
+from typing import *
+
+from assembler import Opcode, error
+from emulator import Emulator, assemble_program, load_image
+
+
+# A device connected to the emulator. Subclasses override the methods they
+# need.
+class Device:
+    # Map the device to registers and addresses of the emulator.
+    def attach(self, emulator: Emulator):
+        pass
+
+    # Bring the device into its initial state, and schedule its first
+    # events. Called when attached and whenever the CPU is reset.
+    def reset(self, emulator: Emulator):
+        pass
+
+    # A register the device is mapped to was written at `cycle`.
+    def write(self, register: int, value: int, cycle: int):
+        pass
+
+    # The program jumped to an address the device is mapped to at `cycle`,
+    # before the instruction there is executed.
+    def fetch(self, address: int, cycle: int):
+        pass
+
+
+# An output latch mapped to a register, which records every value written
+# to it. With `echo`, each write is also printed as it happens.
+class OutputPort(Device):
+    def __init__(self, register: int, name: Optional[str] = None,
+                 echo: Optional[TextIO] = None):
+        self.register = register
+        self.name = name or f"r{register}"
+        self.echo = echo
+        self.value = 0
+        # (cycle, value) of every write
+        self.writes: List[Tuple[int, int]] = []
+
+    def attach(self, emulator: Emulator):
+        emulator.map_register(self.register, self)
+
+    def reset(self, emulator: Emulator):
+        self.value = 0
+        self.writes.clear()
+
+    def write(self, register: int, value: int, cycle: int):
+        self.value = value
+        self.writes.append((cycle, value))
+        if self.echo is not None:
+            self.echo.write(f"{cycle:>10d}  {self.name} = 0x{value:02X}\n")
+
+
+# An input that holds its value in the immediate of the `ldi` instruction
+# at `address`. The value changes to the given (cycle, value) pairs at
+# their cycles.
+class InputPort(Device):
+    def __init__(self, address: int, value: int = 0,
+                 changes: Sequence[Tuple[int, int]] = ()):
+        self.address = address & 0xFFFF
+        self.initial = value
+        self.changes = list(changes)
+        self.value = value
+
+    def attach(self, emulator: Emulator):
+        self.emulator = emulator
+
+    def reset(self, emulator: Emulator):
+        if emulator.memory.read(self.address) & 0x0F != 0x08:
+            error(f"device at {self.address:04X} needs an ldi instruction there")
+        self.set(self.initial)
+        for cycle, value in self.changes:
+            emulator.schedule(cycle, lambda value=value: self.set(value))
+
+    def set(self, value: int):
+        self.value = value & 0xFF
+        memory = self.emulator.memory
+        memory.write(self.address, memory.read(self.address) & 0xFF | self.value << 8)
+
+
+# A counter that counts up every `period` cycles, wrapping around at 256.
+class Timer(InputPort):
+    def __init__(self, address: int, period: int):
+        super().__init__(address)
+        self.period = period
+
+    def reset(self, emulator: Emulator):
+        super().reset(emulator)
+        self.next_tick = self.period
+        emulator.schedule(self.next_tick, self.tick)
+
+    def tick(self):
+        self.set(self.value + 1)
+        self.next_tick += self.period
+        self.emulator.schedule(self.next_tick, self.tick)
+
+
+# A queue of input values, like key presses, that arrive at the given
+# (cycle, value) pairs. Every call of the input takes the next value from
+# the queue, or reads 0 while it is empty.
+class InputQueue(InputPort):
+    def __init__(self, address: int, arrivals: Sequence[Tuple[int, int]]):
+        super().__init__(address)
+        self.arrivals = list(arrivals)
+        self.pending: Deque[int] = deque()
+
+    def attach(self, emulator: Emulator):
+        super().attach(emulator)
+        emulator.map_fetch(self.address, self)
+
+    def reset(self, emulator: Emulator):
+        super().reset(emulator)
+        self.pending.clear()
+        for cycle, value in self.arrivals:
+            emulator.schedule(cycle, lambda value=value: self.pending.append(value))
+
+    def fetch(self, address: int, cycle: int):
+        self.set(self.pending.popleft() if self.pending else 0)
+
+
+# Parse an address, either a number or a label of the program.
+def parse_address(text: str, labels: Dict[str, int]) -> int:
+    if text in labels:
+        return labels[text]
+    try:
+        return int(text, 0)
+    except ValueError:
+        error(f"unknown address '{text}'", "expected a number or a label of the program")
+
+# Parse a list of (cycle, value) pairs, like 100:0x01,200:0x00.
+def parse_changes(text: str) -> List[Tuple[int, int]]:
+    changes = []
+    for item in text.split(",") if text else []:
+        cycle, _, value = item.partition(":")
+        try:
+            changes.append((int(cycle, 0), int(value, 0)))
+        except ValueError:
+            error(f"invalid change '{item}'", "expected CYCLE:VALUE")
+    return changes
+
+# Parse a register, like r6.
+def parse_register(text: str) -> int:
+    if len(text) != 2 or text[0] != "r" or text[1] not in "0123456":
+        error(f"invalid register '{text}'", "expected r0 to r6")
+    return int(text[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", metavar="INPUT",
+        help="binary image or assembly source to run")
+    parser.add_argument("-n", "--steps", type=int, default=10**7,
+        help="maximum number of instructions to execute")
+    parser.add_argument("--output", action="append", default=[], metavar="REG[=NAME]",
+        help="print the values written to a register")
+    parser.add_argument("--input", action="append", default=[], dest="inputs",
+        metavar="ADDR[=CHANGES]",
+        help="an input at the ldi instruction at ADDR, which changes to the "
+             "values of CHANGES, a list of CYCLE:VALUE")
+    parser.add_argument("--timer", action="append", default=[], metavar="ADDR:PERIOD",
+        help="a timer at the ldi instruction at ADDR, counting up every PERIOD cycles")
+    parser.add_argument("--keys", action="append", default=[], metavar="ADDR=ARRIVALS",
+        help="a queue of inputs at the ldi instruction at ADDR, which arrive at "
+             "ARRIVALS, a list of CYCLE:VALUE")
+    args = parser.parse_args()
+
+    labels = {}
+    if args.input.endswith(".s"):
+        binary, program = assemble_program(args.input)
+        labels = {inst.operands[0].value: inst.address for inst in program
+                  if inst.opcode == Opcode.D_LABEL}
+    else:
+        binary = load_image(args.input)
+
+    emulator = Emulator()
+    emulator.load_binary(binary)
+    for spec in args.output:
+        register, _, name = spec.partition("=")
+        emulator.attach(OutputPort(parse_register(register), name or None, sys.stdout))
+    for spec in args.inputs:
+        address, _, changes = spec.partition("=")
+        emulator.attach(InputPort(parse_address(address, labels), 0, parse_changes(changes)))
+    for spec in args.timer:
+        address, _, period = spec.rpartition(":")
+        if not period.isdigit() or int(period) == 0:
+            error(f"invalid timer '{spec}'", "expected ADDR:PERIOD with a positive PERIOD")
+        emulator.attach(Timer(parse_address(address, labels), int(period)))
+    for spec in args.keys:
+        address, _, arrivals = spec.partition("=")
+        emulator.attach(InputQueue(parse_address(address, labels), parse_changes(arrivals)))
+
+    emulator.run(args.steps)
+    emulator.print_state()
+    if not emulator.halted:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
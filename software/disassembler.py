@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# A disassembler that converts binary images back into `Instruction` objects.
+# It is the inverse of the `InstructionEncoder` in the assembler.
+import argparse
+import sys
+from typing import *
+
+from assembler import (AssemblyPrinter, Instruction, Opcode, Operand,
+                       OperandKind, error)
+
+
+# Decode a register field, which holds the register index plus one. Returns
+# None if the field does not name a register.
+def decode_register(field: int) -> Optional[int]:
+    if field < 1 or field > 7:
+        return None
+    return field - 1
+
+# Decode a single 16 bit instruction word. Words that do not correspond to any
+# instruction are returned as a `.word` directive.
+def decode_instruction(encoding: int, address: Optional[int] = None) -> Instruction:
+    inst = decode_opcode(encoding)
+    inst.address = address
+    inst.encoding = encoding
+    return inst
+
+def decode_opcode(encoding: int) -> Instruction:
+    low = encoding & 0xFF
+    high = encoding >> 8
+    rd = decode_register((encoding >> 4) & 0xF)
+    rs = decode_register(high & 0xF)
+
+    # Pseudo-instructions take precedence over the instructions they are
+    # encoded as.
+    if encoding == 0x0000:
+        return Instruction(Opcode.NOP)
+    if encoding == 0x0009:
+        return Instruction(Opcode.HALT)
+
+    if low & 0xF == 0x8 and rd is not None:
+        return Instruction(Opcode.LDI, [
+            Operand(OperandKind.Reg, rd),
+            Operand(OperandKind.Imm, high),
+        ])
+    if low & 0xF == 0x0 and rd is not None and rs is not None and high >> 4 == 0:
+        return Instruction(Opcode.MV, [
+            Operand(OperandKind.Reg, rd),
+            Operand(OperandKind.Reg, rs),
+        ])
+    if low == 0x02 and rs is not None and rs < 6 and high >> 4 == 0:
+        return Instruction(Opcode.JABSR, [Operand(OperandKind.RegPair, rs)])
+    if low == 0x09:
+        offset = high - 256 if high >= 128 else high
+        return Instruction(Opcode.JRELI, [Operand(OperandKind.Imm, offset)])
+    if low == 0x01 and rs is not None and high >> 4 == 0:
+        return Instruction(Opcode.JRELR, [Operand(OperandKind.Reg, rs)])
+
+    return Instruction(Opcode.D_WORD, [Operand(OperandKind.Imm, encoding)])
+
+# Decode all words of a binary image. Instruction words are stored in little
+# endian byte order, and the address of a word is its index in the image. The
+# words of the `data` ranges of word addresses, like tables and strings, are
+# not decoded but returned as one `.byte` directive per range.
+def disassemble_binary(binary: bytes, start: int = 0,
+                       data: Sequence[Tuple[int, int]] = ()) -> List[Instruction]:
+    if len(binary) % 2 != 0:
+        binary = bytes(binary) + b"\x00"
+    words = memoryview(binary).cast("H")
+    if sys.byteorder != "little":
+        words = [((w & 0xFF) << 8) | (w >> 8) for w in words]
+    program = []
+    index = 0
+    for data_start, data_end in sorted(data):
+        data_start = min(max(data_start - start, index), len(words))
+        data_end = min(max(data_end - start, data_start), len(words))
+        program += [decode_instruction(words[i], start + i) for i in range(index, data_start)]
+        if data_end > data_start:
+            program.append(Instruction(Opcode.D_BYTE, address=start + data_start,
+                                       data=memoryview(binary)[2 * data_start:2 * data_end]))
+        index = max(index, data_end)
+    program += [decode_instruction(words[i], start + i) for i in range(index, len(words))]
+    return program
+
+# Parse a range of word addresses, like 0x100:0x180.
+def parse_range(text: str) -> Tuple[int, int]:
+    start, _, end = text.partition(":")
+    try:
+        return int(start, 0), int(end, 0)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid range '{text}', expected START:END")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", metavar="INPUT",
+        help="binary image to disassemble")
+    parser.add_argument("--start", type=lambda x: int(x, 0), default=0,
+        help="first word address to disassemble")
+    parser.add_argument("--count", type=lambda x: int(x, 0),
+        help="number of words to disassemble")
+    parser.add_argument("--data", type=parse_range, action="append", default=[],
+        metavar="START:END",
+        help="print the words from START up to END as data instead of instructions")
+    args = parser.parse_args()
+
+    try:
+        with open(args.input, "rb") as f:
+            binary = f.read()
+    except OSError as e:
+        error(f"cannot read '{args.input}': {e.strerror}")
+    end = None if args.count is None else 2 * (args.start + args.count)
+    program = disassemble_binary(binary[2 * args.start:end], args.start, args.data)
+    AssemblyPrinter(program).write(sys.stdout)
+
+if __name__ == "__main__":
+    main()
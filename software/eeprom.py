@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# Upload ROM images to the EEPROM programmer over a serial line. Instead of
+# writing a byte at a time and waiting for each acknowledgement, the image is
+# sent in page-sized packets, and up to a window of them are on their way or
+# being written while the next ones are sent. The programmer acknowledges a
+# page with the checksum of what it reads back after writing it, so pages are
+# verified without sending the data back, and pages that fail are sent again.
+# Before uploading, the checksums of all pages are requested, and only the
+# pages that differ are written.
+#
+#   eeprom.py upload microcode/left_rom.bin --port /dev/ttyUSB0
+#
+# `eeprom.py simulate` runs a programmer on a pseudo-terminal, with the page
+# size and write time of an AT28C256, to test uploads without hardware. With
+# `upload --simulate`, an upload runs against a simulated programmer in the
+# same process and the result is compared with the image.
+#
+# Packets are frames delimited by FRAME_END bytes, with FRAME_END and
+# FRAME_ESCAPE bytes inside a frame escaped, and a CRC-16 at the end. A frame
+# is a kind byte followed by little-endian fields:
+#
+#   H                                   host asks for the device parameters
+#   H size:u32 page:u16 buffer:u8       programmer replies
+#   S address:u32 length:u32            host asks for checksums of pages
+#   S address:u32 crc:u16...            programmer replies, one per page
+#   W seq:u8 address:u32 data           host writes data within one page
+#   A seq:u8 address:u32 crc:u16        programmer wrote the page, and read
+#                                       back data with checksum crc
+#
+# Frames with a wrong CRC are dropped, and the host sends them again when
+# their acknowledgement does not arrive in time.
+import argparse
+import asyncio
+import binascii
+import os
+import pty
+import random
+import struct
+import sys
+import termios
+import time
+import tty
+from dataclasses import dataclass
+from typing import *
+
+from assembler import error
+from emulator import load_image
+
+FRAME_END = 0x7E
+FRAME_ESCAPE = 0x7D
+
+HELLO = ord("H")
+SUMS = ord("S")
+WRITE = ord("W")
+ACK = ord("A")
+
+# Parameters of an AT28C256, as used for the ROMs of the CPU
+EEPROM_SIZE = 32768
+PAGE_SIZE = 64
+# Maximum time a page write takes, in seconds
+PAGE_WRITE_TIME = 0.010
+
+
+def checksum(data: bytes) -> int:
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def encode_frame(kind: int, payload: bytes = b"") -> bytes:
+    body = bytes([kind]) + payload
+    body += struct.pack("<H", checksum(body))
+    escaped = body.replace(bytes([FRAME_ESCAPE]), bytes([FRAME_ESCAPE, FRAME_ESCAPE ^ 0x20]))
+    escaped = escaped.replace(bytes([FRAME_END]), bytes([FRAME_ESCAPE, FRAME_END ^ 0x20]))
+    return bytes([FRAME_END]) + escaped + bytes([FRAME_END])
+
+# Splits received bytes into frames, and drops frames with a wrong CRC.
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.dropped = 0
+
+    # Add received bytes, and return the kind and payload of every frame
+    # they complete.
+    def feed(self, data: bytes) -> List[Tuple[int, bytes]]:
+        frames = []
+        self.buffer += data
+        *complete, self.buffer = self.buffer.split(bytes([FRAME_END]))
+        for frame in complete:
+            if not frame:
+                continue
+            body = bytearray()
+            escaped = False
+            for byte in frame:
+                if escaped:
+                    body.append(byte ^ 0x20)
+                    escaped = False
+                elif byte == FRAME_ESCAPE:
+                    escaped = True
+                else:
+                    body.append(byte)
+            if len(body) < 3 or checksum(body[:-2]) != struct.unpack_from("<H", body, len(body) - 2)[0]:
+                self.dropped += 1
+                continue
+            frames.append((body[0], bytes(body[1:-2])))
+        return frames
+
+
+# Open a serial port, or a pseudo-terminal, in raw mode as a stream.
+async def open_serial(path: str, baud: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    except OSError as e:
+        raise UploadError(f"cannot open '{path}': {e.strerror}")
+    tty.setraw(fd)
+    attributes = termios.tcgetattr(fd)
+    speed = getattr(termios, f"B{baud}", None)
+    if speed is None:
+        os.close(fd)
+        raise UploadError(f"unsupported baud rate {baud}")
+    attributes[4] = attributes[5] = speed
+    termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    return await open_stream(fd)
+
+# Make a stream of a file descriptor of a terminal.
+async def open_stream(fd: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                 os.fdopen(fd, "rb", buffering=0))
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+                                                        os.fdopen(os.dup(fd), "wb", buffering=0))
+    return reader, asyncio.StreamWriter(transport, protocol, reader, loop)
+
+# Read from a stream until it ends. A pseudo-terminal whose other side was
+# closed fails to read instead of ending.
+async def read_chunks(reader: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    while True:
+        try:
+            data = await reader.read(4096)
+        except OSError:
+            return
+        if not data:
+            return
+        yield data
+
+
+class UploadError(Exception):
+    pass
+
+@dataclass
+class UploadStatistics:
+    pages: int = 0
+    unchanged: int = 0
+    retries: int = 0
+    bytes_sent: int = 0
+    seconds: float = 0
+
+    def print(self, size: int, file=sys.stdout):
+        rate = size / self.seconds if self.seconds else 0
+        file.write(f"{self.pages} pages written, {self.unchanged} unchanged, "
+                   f"{self.retries} retries, {self.bytes_sent} bytes sent in "
+                   f"{self.seconds:.2f}s ({rate / 1024:.1f} KiB/s of image)\n")
+
+# The host side of the protocol. `window` is the maximum number of writes
+# that are not acknowledged yet, and is limited to the pages the programmer
+# can buffer.
+class Uploader:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 window: int = 8, timeout: float = 1.0, retries: int = 5):
+        self.reader = reader
+        self.writer = writer
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.statistics = UploadStatistics()
+        self.sequence = 0
+        # Futures of the writes not acknowledged yet by sequence number, and
+        # of the replies to other requests by kind
+        self.writes: Dict[int, Tuple[int, asyncio.Future]] = {}
+        self.requests: Dict[int, asyncio.Future] = {}
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    async def receive(self):
+        decoder = FrameDecoder()
+        async for data in read_chunks(self.reader):
+            for kind, payload in decoder.feed(data):
+                if kind == ACK and len(payload) == 7:
+                    seq, address, crc = struct.unpack("<BIH", payload)
+                    if seq in self.writes and self.writes[seq][0] == address:
+                        future = self.writes[seq][1]
+                        if not future.done():
+                            future.set_result(crc)
+                elif kind in self.requests and not self.requests[kind].done():
+                    self.requests[kind].set_result(payload)
+        for future in [future for _, future in self.writes.values()] + list(self.requests.values()):
+            if not future.done():
+                future.set_exception(UploadError("the programmer closed the connection"))
+
+    def close(self):
+        self.receiver.cancel()
+        self.writer.close()
+
+    def send(self, frame: bytes):
+        self.writer.write(frame)
+        self.statistics.bytes_sent += len(frame)
+
+    # Send a request and wait for the reply of the same kind, asking again
+    # when it does not arrive in time.
+    async def request(self, kind: int, payload: bytes = b"") -> bytes:
+        for _ in range(self.retries + 1):
+            future = self.requests[kind] = asyncio.get_running_loop().create_future()
+            self.send(encode_frame(kind, payload))
+            await self.writer.drain()
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self.statistics.retries += 1
+            finally:
+                del self.requests[kind]
+        raise UploadError(f"no reply from the programmer to '{chr(kind)}'")
+
+    # Ask for the size, page size and number of buffered pages of the device.
+    async def hello(self) -> Tuple[int, int, int]:
+        payload = await self.request(HELLO)
+        if len(payload) != 7:
+            raise UploadError("unexpected reply from the programmer")
+        return struct.unpack("<IHB", payload)
+
+    # The checksums of the pages of a range of the device.
+    async def checksums(self, address: int, length: int, page_size: int) -> List[int]:
+        payload = await self.request(SUMS, struct.pack("<II", address, length))
+        count = -(-(address % page_size + length) // page_size)
+        if len(payload) != 4 + 2 * count or struct.unpack_from("<I", payload)[0] != address:
+            raise UploadError("unexpected checksums from the programmer")
+        return list(struct.unpack_from(f"<{count}H", payload, 4))
+
+    # Write data within one page, and wait until the programmer read it
+    # back with the right checksum.
+    async def write_page(self, address: int, data: bytes, window: asyncio.Semaphore):
+        expected = checksum(data)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.statistics.retries += 1
+            async with window:
+                seq = self.sequence
+                self.sequence = (self.sequence + 1) & 0xFF
+                future = asyncio.get_running_loop().create_future()
+                self.writes[seq] = (address, future)
+                self.send(encode_frame(WRITE, struct.pack("<BI", seq, address) + data))
+                try:
+                    await self.writer.drain()
+                    if await asyncio.wait_for(future, self.timeout) == expected:
+                        self.statistics.pages += 1
+                        return
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    del self.writes[seq]
+        raise UploadError(f"page at {address:04X} failed after {self.retries} retries")
+
+    # Upload an image to an address. Unless `full` is set, only pages whose
+    # checksums differ from the device are written.
+    async def upload(self, image: bytes, address: int = 0, full: bool = False) -> UploadStatistics:
+        start = time.perf_counter()
+        size, page_size, buffer = await self.hello()
+        if address + len(image) > size:
+            raise UploadError(f"image of {len(image)} bytes at {address:04X} does not fit "
+                              f"into the {size} bytes of the device")
+        # Split the image at page boundaries
+        pages = []
+        offset = 0
+        while offset < len(image):
+            length = min(page_size - (address + offset) % page_size, len(image) - offset)
+            pages.append((address + offset, image[offset:offset + length]))
+            offset += length
+        if not full and pages:
+            current = await self.checksums(address, len(image), page_size)
+            changed = [(a, data) for (a, data), crc in zip(pages, current) if checksum(data) != crc]
+            self.statistics.unchanged = len(pages) - len(changed)
+            pages = changed
+        window = asyncio.Semaphore(max(1, min(self.window, buffer)))
+        await asyncio.gather(*(self.write_page(a, data, window) for a, data in pages))
+        self.statistics.seconds = time.perf_counter() - start
+        return self.statistics
+
+
+# A simulated programmer with an EEPROM. Received bytes arrive at the speed
+# of a serial line with the given baud rate, and every page write takes the
+# write time of the EEPROM. Writes are buffered for up to `buffer` pages and
+# dropped while the buffer is full. Received bytes are corrupted with the
+# probability `error_rate`, and written pages with the probability
+# `write_error_rate`.
+class Programmer:
+    def __init__(self, size: int = EEPROM_SIZE, page_size: int = PAGE_SIZE,
+                 buffer: int = 8, baud: int = 115200, write_time: float = PAGE_WRITE_TIME,
+                 error_rate: float = 0, write_error_rate: float = 0, seed: int = 0):
+        self.memory = bytearray(b"\xFF" * size)
+        self.page_size = page_size
+        self.buffer = buffer
+        self.baud = baud
+        self.write_time = write_time
+        self.error_rate = error_rate
+        self.write_error_rate = write_error_rate
+        self.rng = random.Random(seed)
+        self.pages_written = 0
+
+    # Serve a host until it closes the connection.
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queue: asyncio.Queue = asyncio.Queue()
+        writing = asyncio.ensure_future(self.write_pages(queue, writer))
+        decoder = FrameDecoder()
+        try:
+            async for data in read_chunks(reader):
+                # A byte takes 10 bits on the line, with start and stop bits
+                await asyncio.sleep(len(data) * 10 / self.baud)
+                if self.error_rate:
+                    data = bytes(byte ^ 1 << self.rng.randrange(8)
+                                 if self.rng.random() < self.error_rate else byte for byte in data)
+                for kind, payload in decoder.feed(data):
+                    self.handle(kind, payload, queue, writer)
+        finally:
+            writing.cancel()
+
+    def handle(self, kind: int, payload: bytes, queue: asyncio.Queue,
+               writer: asyncio.StreamWriter):
+        if kind == HELLO:
+            writer.write(encode_frame(HELLO, struct.pack("<IHB", len(self.memory),
+                                                         self.page_size, self.buffer)))
+        elif kind == SUMS and len(payload) == 8:
+            address, length = struct.unpack("<II", payload)
+            reply = struct.pack("<I", address)
+            end = min(address + length, len(self.memory))
+            while address < end:
+                next_page = min((address // self.page_size + 1) * self.page_size, end)
+                reply += struct.pack("<H", checksum(self.memory[address:next_page]))
+                address = next_page
+            writer.write(encode_frame(SUMS, reply))
+        elif kind == WRITE and len(payload) > 5:
+            address = struct.unpack_from("<I", payload, 1)[0]
+            length = len(payload) - 5
+            in_page = address % self.page_size + length <= self.page_size
+            if in_page and address + length <= len(self.memory) and queue.qsize() < self.buffer:
+                queue.put_nowait(payload)
+
+    async def write_pages(self, queue: asyncio.Queue, writer: asyncio.StreamWriter):
+        while True:
+            payload = await queue.get()
+            seq, address = struct.unpack_from("<BI", payload)
+            data = bytearray(payload[5:])
+            await asyncio.sleep(self.write_time)
+            if self.rng.random() < self.write_error_rate:
+                data[self.rng.randrange(len(data))] ^= 0xFF
+            self.memory[address:address + len(data)] = data
+            self.pages_written += 1
+            crc = checksum(self.memory[address:address + len(data)])
+            writer.write(encode_frame(ACK, struct.pack("<BIH", seq, address, crc)))
+
+# Run a programmer on a new pseudo-terminal. Returns the path of the
+# terminal to connect to, and the task serving it. The terminal stays open
+# for any number of connections until the task is cancelled.
+async def start_simulator(programmer: Programmer) -> Tuple[str, asyncio.Task]:
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    reader, writer = await open_stream(master)
+
+    async def serve():
+        try:
+            await programmer.serve(reader, writer)
+        finally:
+            writer.close()
+            os.close(slave)
+    return path, asyncio.ensure_future(serve())
+
+
+def add_simulator_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--size", type=int, default=EEPROM_SIZE,
+        help="size of the simulated EEPROM in bytes")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE,
+        help="page size of the simulated EEPROM in bytes")
+    parser.add_argument("--buffer", type=int, default=8,
+        help="number of pages the simulated programmer buffers")
+    parser.add_argument("--write-time", type=float, default=PAGE_WRITE_TIME * 1000,
+        help="time a page write takes, in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0,
+        help="probability that a byte sent to the simulated programmer is corrupted")
+    parser.add_argument("--write-error-rate", type=float, default=0,
+        help="probability that a page is written wrong")
+    parser.add_argument("--seed", type=int, default=0,
+        help="seed for the simulated errors")
+    parser.add_argument("--contents", type=str,
+        help="file with the initial contents of the simulated EEPROM")
+
+def make_programmer(args) -> Programmer:
+    programmer = Programmer(args.size, args.page_size, args.buffer, args.baud,
+                            args.write_time / 1000, args.error_rate, args.write_error_rate,
+                            args.seed)
+    if args.contents is not None:
+        contents = load_image(args.contents)[:args.size]
+        programmer.memory[:len(contents)] = contents
+    return programmer
+
+async def upload(args, image: bytes) -> UploadStatistics:
+    programmer = None
+    if args.simulate:
+        programmer = make_programmer(args)
+        port, simulator = await start_simulator(programmer)
+    else:
+        port = args.port
+    reader, writer = await open_serial(port, args.baud)
+    uploader = Uploader(reader, writer, args.window, args.timeout, args.retries)
+    try:
+        statistics = await uploader.upload(image, args.address, args.full)
+    finally:
+        uploader.close()
+    if programmer is not None:
+        simulator.cancel()
+        if programmer.memory[args.address:args.address + len(image)] != image:
+            raise UploadError("the simulated EEPROM differs from the image")
+    return statistics
+
+async def simulate(args):
+    path, simulator = await start_simulator(make_programmer(args))
+    print(f"programmer listening on {path}")
+    sys.stdout.flush()
+    await simulator
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baud", type=int, default=115200,
+        help="baud rate of the serial line")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    upload_parser = subparsers.add_parser("upload",
+        help="write an image to the EEPROM")
+    upload_parser.add_argument("input", metavar="INPUT",
+        help="binary image or assembly source to upload")
+    upload_parser.add_argument("--port", type=str,
+        help="serial port of the programmer")
+    upload_parser.add_argument("--simulate", action="store_true",
+        help="upload to a simulated programmer and check the result")
+    upload_parser.add_argument("--address", type=lambda s: int(s, 0), default=0,
+        help="address of the image in the EEPROM")
+    upload_parser.add_argument("--full", action="store_true",
+        help="write all pages, not only the ones that differ")
+    upload_parser.add_argument("--window", type=int, default=8,
+        help="maximum number of pages sent ahead of their acknowledgement")
+    upload_parser.add_argument("--timeout", type=float, default=1.0,
+        help="seconds to wait for an acknowledgement before sending a page again")
+    upload_parser.add_argument("--retries", type=int, default=5,
+        help="number of times a page is sent again before giving up")
+    add_simulator_arguments(upload_parser)
+
+    simulate_parser = subparsers.add_parser("simulate",
+        help="run a simulated programmer on a pseudo-terminal")
+    add_simulator_arguments(simulate_parser)
+    args = parser.parse_args()
+
+    if args.command == "upload":
+        if (args.port is None) == (not args.simulate):
+            error("expected either --port or --simulate")
+        image = load_image(args.input)
+        try:
+            statistics = asyncio.run(upload(args, image))
+        except UploadError as e:
+            error(str(e))
+        statistics.print(len(image))
+    elif args.command == "simulate":
+        try:
+            asyncio.run(simulate(args))
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+# An instruction level emulator of the CPU. Instruction words are decoded
+# once into a table indexed by the 16 bit encoding, so the step loop only
+# does a table lookup per instruction.
+#
+# Breakpoints are kept in a flag per address and watchpoints in a flag per
+# register slot. They are only checked by a separate step loop, which is
+# used while any of them is set, or while a trace is recorded.
+#
+# Devices (see `devices.py`) receive the writes to a register, or are told
+# when the program jumps to an address, both of which are checked by the
+# separate step loop. Their timed events are kept in a heap ordered by
+# cycle, and the step loops never look at it: a run stops the loop at the
+# cycle of the next event, runs the event and continues.
+#
+# Code coverage is recorded by both step loops as the runs of consecutive
+# instructions between jumps, so it costs nothing for instructions that do
+# not jump.
+#
+# The emulator state can be saved in snapshots, which are cheap because
+# memory is split into copy-on-write pages. Checkpoints are taken
+# automatically while running, and stepping backwards is done by restoring
+# the nearest checkpoint and replaying forward from there.
+import argparse
+import heapq
+import sys
+from array import array
+from dataclasses import dataclass
+from enum import Enum
+from typing import *
+
+from assembler import AssemblyParser, Instruction, build_binary, error
+
+
+# Size of the address space in words. Addresses are word addresses, so the
+# address of a word is half its byte offset in a binary image.
+MEMORY_WORDS = 1 << 16
+PAGE_BITS = 8
+PAGE_WORDS = 1 << PAGE_BITS
+
+# Every instruction takes two steps of the control logic: fetching it into
+# the instruction register, and executing it (see `microcode/microcode.txt`).
+CYCLES_PER_INSTRUCTION = 2
+
+NUM_REGISTERS = 7
+# Register slots that decoded instructions use for register fields that do
+# not name a register: reads of ZERO_SLOT return 0 and writes to SINK_SLOT
+# are discarded. The slot after ZERO_SLOT is zero as well, so that register
+# pairs starting at r6 or at no register read as zero where nothing drives.
+ZERO_SLOT = 7
+SINK_SLOT = 9
+
+# Kinds of decoded instructions
+OP_SKIP = 0
+OP_LOAD = 1      # r[a] = b
+OP_MOVE = 2      # r[a] = r[b]
+OP_JUMP_IMM = 3  # pc += b
+OP_JUMP_REG = 4  # pc += signed r[b]
+OP_JUMP_ABS = 5  # pc = r[b] | r[b + 1] << 8
+
+# Decode the register field of an instruction into a register slot.
+def register_slot(field: int, default: int) -> int:
+    return field - 1 if 1 <= field <= NUM_REGISTERS else default
+
+# Decode an instruction word into a (kind, a, b) tuple. This follows the
+# control signals of the microcode rather than the assembler, so every word
+# decodes to something, including the ones the assembler never emits.
+def decode_word(word: int) -> Tuple[int, int, int]:
+    low = word & 0xFF
+    high = word >> 8
+    mode = low & 0x3
+    immediate = low & 0x8
+    rd = register_slot((low >> 4) & 0xF, SINK_SLOT)
+    rs = register_slot(high & 0xF, ZERO_SLOT)
+    if mode == 0:
+        return (OP_LOAD, rd, high) if immediate else (OP_MOVE, rd, rs)
+    if mode == 1:
+        if immediate:
+            return OP_JUMP_IMM, 0, high - 256 if high >= 128 else high
+        return OP_JUMP_REG, 0, rs
+    if mode == 2 and not immediate:
+        # The pair is selected by its low register
+        return OP_JUMP_ABS, 0, rs
+    return OP_SKIP, 0, 0
+
+_decode_table: Optional[List[Tuple[int, int, int]]] = None
+
+# The decoded form of every possible instruction word.
+def decode_table() -> List[Tuple[int, int, int]]:
+    global _decode_table
+    if _decode_table is None:
+        _decode_table = [decode_word(word) for word in range(1 << 16)]
+    return _decode_table
+
+
+# Record the instructions executed since the last jump, when a step loop
+# stops before reaching the next one. `length` is the number of instructions
+# executed from `entry`, which covers all of memory if it wrapped around.
+def record_partial_block(blocks: Set[Tuple[int, int, int]], entry: int, pc: int, length: int):
+    if length >= MEMORY_WORDS:
+        entry = pc
+    blocks.add((entry, (pc - 1) & 0xFFFF, pc))
+
+
+# Word addressable memory, split into pages. Pages are shared between the
+# memory and its snapshots, and copied on the first write after a snapshot,
+# so a snapshot only costs the pages that are modified afterwards.
+class PagedMemory:
+    # All pages start out as the same zero page
+    ZERO_PAGE = array("H", bytes(2 * PAGE_WORDS))
+
+    def __init__(self):
+        num_pages = MEMORY_WORDS // PAGE_WORDS
+        self.pages: List[array] = [self.ZERO_PAGE] * num_pages
+        # Whether a page is private to this memory and may be written in place
+        self.owned = [False] * num_pages
+
+    def read(self, address: int) -> int:
+        return self.pages[address >> PAGE_BITS][address & (PAGE_WORDS - 1)]
+
+    def write(self, address: int, value: int):
+        index = address >> PAGE_BITS
+        if not self.owned[index]:
+            self.pages[index] = array("H", self.pages[index])
+            self.owned[index] = True
+        self.pages[index][address & (PAGE_WORDS - 1)] = value
+
+    # Load words starting at an address.
+    def load(self, words: Sequence[int], address: int = 0):
+        for offset, word in enumerate(words):
+            self.write((address + offset) % MEMORY_WORDS, word)
+
+    # Load a binary image in little endian byte order to address 0.
+    def load_binary(self, binary: bytes):
+        if len(binary) % 2 != 0:
+            binary = bytes(binary) + b"\x00"
+        words = array("H", binary[:2 * MEMORY_WORDS])
+        if sys.byteorder != "little":
+            words.byteswap()
+        self.load(words)
+
+    def snapshot(self) -> Tuple[array, ...]:
+        self.owned = [False] * len(self.pages)
+        return tuple(self.pages)
+
+    def restore(self, pages: Tuple[array, ...]):
+        self.pages = list(pages)
+        self.owned = [False] * len(self.pages)
+
+    # Number of pages that are not shared with any snapshot
+    def owned_pages(self) -> int:
+        return sum(self.owned)
+
+
+# A saved emulator state.
+@dataclass(frozen=True)
+class Snapshot:
+    registers: Tuple[int, ...]
+    pc: int
+    steps: int
+    halted: bool
+    pages: Tuple[array, ...]
+    # Whether the state was changed by hand at this point. Replaying from an
+    # earlier checkpoint does not reproduce the change, so these checkpoints
+    # are never dropped.
+    edited: bool = False
+
+    @property
+    def cycles(self) -> int:
+        return self.steps * CYCLES_PER_INSTRUCTION
+
+
+class StopReason(Enum):
+    BREAKPOINT = "breakpoint"
+    WATCHPOINT = "watchpoint"
+
+# Why `Emulator.run` stopped before executing all steps, other than halting.
+@dataclass
+class Stop:
+    reason: StopReason
+    # The address of the breakpoint, or of the instruction that wrote a
+    # watched register
+    address: int
+    register: Optional[int] = None
+    old: Optional[int] = None
+    new: Optional[int] = None
+
+    def __str__(self) -> str:
+        if self.reason == StopReason.WATCHPOINT:
+            return (f"watchpoint r{self.register} at {self.address:04X}: "
+                    f"{self.old:02X} -> {self.new:02X}")
+        return f"breakpoint at {self.address:04X}"
+
+
+class Emulator:
+    def __init__(self, checkpoint_interval: int = 100000, max_checkpoints: int = 64):
+        self.memory = PagedMemory()
+        # Register values, followed by the two zero slots and the sink slot
+        self.slots = [0] * (SINK_SLOT + 1)
+        self.pc = 0
+        # Number of instructions executed since reset
+        self.steps = 0
+        # Set when the program jumped to itself, which is how `halt` is
+        # encoded. The program can make no further progress.
+        self.halted = False
+        self.decode = decode_table()
+        # Checkpoints are taken every `checkpoint_interval` steps and kept
+        # sorted by step. When there are too many, every other one is
+        # dropped and the interval doubles.
+        self.checkpoint_interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self.checkpoints: List[Snapshot] = []
+        # A non-zero byte for every address with a breakpoint
+        self.breakpoints = bytearray(MEMORY_WORDS)
+        self.num_breakpoints = 0
+        # Whether each register slot is watched
+        self.watched = [False] * (SINK_SLOT + 1)
+        # Why the last run stopped early, if it hit a breakpoint or watchpoint
+        self.stop: Optional[Stop] = None
+        # A `tracing.TraceBuffer` to record executed instructions into
+        self.trace = None
+        # A `codecoverage.Coverage` to record executed instructions into
+        self.coverage = None
+        # Attached `devices.Device` objects, the device receiving the writes
+        # to each register slot, and the devices told when the program jumps
+        # to an address
+        self.devices: List[Any] = []
+        self.ports: List[Any] = [None] * (SINK_SLOT + 1)
+        self.fetch_hooks = bytearray(MEMORY_WORDS)
+        self.fetch_devices: Dict[int, Any] = {}
+        # Pending device events as (cycle, sequence number, callback)
+        self.events: List[Tuple[int, int, Callable[[], None]]] = []
+        self.num_events = 0
+
+    @property
+    def registers(self) -> List[int]:
+        return self.slots[:NUM_REGISTERS]
+
+    @property
+    def cycles(self) -> int:
+        return self.steps * CYCLES_PER_INSTRUCTION
+
+    # Load a binary image and reset the CPU.
+    def load_binary(self, binary: bytes):
+        self.memory = PagedMemory()
+        self.memory.load_binary(binary)
+        self.reset()
+
+    def reset(self):
+        self.slots = [0] * (SINK_SLOT + 1)
+        self.pc = 0
+        self.steps = 0
+        self.halted = False
+        self.events = []
+        for device in self.devices:
+            device.reset(self)
+        self.checkpoints = [self.snapshot()]
+
+    # Change a register. The checkpoints after the current step no longer
+    # describe where the program goes from here, so they are dropped.
+    def set_register(self, register: int, value: int):
+        self.slots[register] = value & 0xFF
+        self.discard_future()
+
+    def set_pc(self, pc: int):
+        self.pc = pc & 0xFFFF
+        self.halted = False
+        self.discard_future()
+
+    def write_memory(self, address: int, value: int):
+        self.memory.write(address & 0xFFFF, value & 0xFFFF)
+        self.discard_future()
+
+    def add_breakpoint(self, address: int):
+        address &= 0xFFFF
+        if not self.breakpoints[address]:
+            self.breakpoints[address] = 1
+            self.num_breakpoints += 1
+
+    def remove_breakpoint(self, address: int):
+        address &= 0xFFFF
+        if self.breakpoints[address]:
+            self.breakpoints[address] = 0
+            self.num_breakpoints -= 1
+
+    def breakpoint_addresses(self) -> List[int]:
+        return [address for address, flag in enumerate(self.breakpoints) if flag]
+
+    # Stop whenever an instruction changes the value of a register.
+    def add_watchpoint(self, register: int):
+        self.watched[register] = True
+
+    def remove_watchpoint(self, register: int):
+        self.watched[register] = False
+
+    def watched_registers(self) -> List[int]:
+        return [r for r in range(NUM_REGISTERS) if self.watched[r]]
+
+    # Connect a device. The device maps itself to registers and addresses,
+    # and is reset along with the CPU. Devices are not part of snapshots, so
+    # stepping backwards does not undo what they did.
+    def attach(self, device):
+        self.devices.append(device)
+        device.attach(self)
+        device.reset(self)
+
+    # Send every write of a register to a device.
+    def map_register(self, register: int, device):
+        self.ports[register] = device
+
+    # Tell a device whenever the program jumps to an address.
+    def map_fetch(self, address: int, device):
+        self.fetch_hooks[address & 0xFFFF] = 1
+        self.fetch_devices[address & 0xFFFF] = device
+
+    # Call `callback` once the CPU reaches `cycle`, before the instruction
+    # starting at that cycle executes. Events of the same cycle run in the
+    # order they were scheduled.
+    def schedule(self, cycle: int, callback: Callable[[], None]):
+        heapq.heappush(self.events, (cycle, self.num_events, callback))
+        self.num_events += 1
+
+    # Run the events that are due at the current cycle.
+    def run_events(self):
+        events = self.events
+        while events and events[0][0] <= self.cycles:
+            heapq.heappop(events)[2]()
+
+    def discard_future(self):
+        while self.checkpoints and self.checkpoints[-1].steps >= self.steps:
+            self.checkpoints.pop()
+        self.checkpoints.append(self.snapshot(edited=True))
+
+    def snapshot(self, edited: bool = False) -> Snapshot:
+        return Snapshot(tuple(self.slots[:NUM_REGISTERS]), self.pc, self.steps,
+                        self.halted, self.memory.snapshot(), edited)
+
+    def restore(self, snapshot: Snapshot):
+        self.slots[:NUM_REGISTERS] = snapshot.registers
+        self.pc = snapshot.pc
+        self.steps = snapshot.steps
+        self.halted = snapshot.halted
+        self.memory.restore(snapshot.pages)
+
+    # Take a checkpoint of the current state, unless one exists already.
+    def checkpoint(self):
+        if self.checkpoints and self.checkpoints[-1].steps >= self.steps:
+            return
+        self.checkpoints.append(self.snapshot())
+        if sum(not c.edited for c in self.checkpoints) > self.max_checkpoints:
+            # Always keep the reset state
+            self.checkpoints = [c for i, c in enumerate(self.checkpoints)
+                                if i % 2 == 0 or c.edited]
+            self.checkpoint_interval *= 2
+
+    # Run until the program halts, hits a breakpoint or watchpoint, or
+    # `max_steps` instructions have been executed, taking checkpoints along
+    # the way. A breakpoint at the pc the run starts at is ignored, so that
+    # runs can continue from a breakpoint. Returns the number of
+    # instructions executed.
+    def run(self, max_steps: int) -> int:
+        self.stop = None
+        checked = (self.num_breakpoints > 0 or any(self.watched) or
+                   self.trace is not None or any(self.ports) or bool(self.fetch_devices))
+        executed = 0
+        while executed < max_steps and not self.halted and self.stop is None:
+            until_checkpoint = self.checkpoint_interval - self.steps % self.checkpoint_interval
+            count = min(max_steps - executed, until_checkpoint)
+            if self.events:
+                self.run_events()
+                if self.events:
+                    until_event = -(-(self.events[0][0] - self.cycles) // CYCLES_PER_INSTRUCTION)
+                    count = min(count, until_event)
+            if checked:
+                executed += self.execute_checked(count, executed == 0)
+            else:
+                executed += self.execute(count)
+            if self.steps % self.checkpoint_interval == 0:
+                self.checkpoint()
+        return executed
+
+    def step(self) -> bool:
+        return self.run(1) == 1
+
+    # The step loop. Executes up to `count` instructions without taking
+    # checkpoints, and returns the number of instructions executed.
+    def execute(self, count: int) -> int:
+        slots = self.slots
+        pages = self.memory.pages
+        decode = self.decode
+        blocks = self.coverage.blocks if self.coverage is not None else None
+        pc = self.pc
+        entry = pc
+        entered = executed = 0
+        while executed < count:
+            kind, a, b = decode[pages[pc >> PAGE_BITS][pc & (PAGE_WORDS - 1)]]
+            executed += 1
+            if kind == OP_LOAD:
+                slots[a] = b
+                pc = (pc + 1) & 0xFFFF
+            elif kind == OP_MOVE:
+                slots[a] = slots[b]
+                pc = (pc + 1) & 0xFFFF
+            elif kind == OP_SKIP:
+                pc = (pc + 1) & 0xFFFF
+            else:
+                if kind == OP_JUMP_IMM:
+                    target = (pc + b) & 0xFFFF
+                elif kind == OP_JUMP_REG:
+                    offset = slots[b]
+                    target = (pc + offset - 256 if offset >= 128 else pc + offset) & 0xFFFF
+                else:
+                    target = slots[b] | slots[b + 1] << 8
+                if blocks is not None:
+                    blocks.add((entry, pc, target))
+                    entry, entered = target, executed
+                if target == pc:
+                    self.halted = True
+                    break
+                pc = target
+        if blocks is not None and executed > entered:
+            record_partial_block(blocks, entry, pc, executed - entered)
+        self.pc = pc
+        self.steps += executed
+        return executed
+
+    # The step loop used while breakpoints or watchpoints are set, a trace is
+    # recorded, or devices are mapped to registers or addresses. Watched and
+    # mapped registers are only checked by instructions that write a
+    # register, and mapped addresses only at jumps. The loop stops early when
+    # a device schedules an event before the end of the loop.
+    def execute_checked(self, count: int, skip_breakpoint: bool = False) -> int:
+        slots = self.slots
+        pages = self.memory.pages
+        decode = self.decode
+        breakpoints = self.breakpoints
+        watched = self.watched
+        trace = self.trace
+        tracing = trace is not None
+        if tracing:
+            trace_pcs, trace_encodings = trace.pcs, trace.encodings
+            trace_registers, trace_values = trace.registers, trace.values
+            capacity = trace.capacity
+            position = trace.position
+        blocks = self.coverage.blocks if self.coverage is not None else None
+        ports = self.ports
+        fetch_hooks = self.fetch_hooks
+        events = self.events
+        steps = self.steps
+        deadline = (steps + count) * CYCLES_PER_INSTRUCTION
+        pc = self.pc
+        entry = pc
+        entered = executed = 0
+        while executed < count:
+            if breakpoints[pc] and not (skip_breakpoint and executed == 0):
+                self.stop = Stop(StopReason.BREAKPOINT, pc)
+                break
+            word = pages[pc >> PAGE_BITS][pc & (PAGE_WORDS - 1)]
+            kind, a, b = decode[word]
+            executed += 1
+            if tracing:
+                slot = position
+                trace_pcs[slot] = pc
+                trace_encodings[slot] = word
+                trace_registers[slot] = -1
+                trace_values[slot] = 0
+                position = slot + 1 if slot + 1 < capacity else 0
+            if kind == OP_LOAD or kind == OP_MOVE:
+                value = b if kind == OP_LOAD else slots[b]
+                old = slots[a]
+                slots[a] = value
+                if tracing and a < NUM_REGISTERS:
+                    trace_registers[slot] = a
+                    trace_values[slot] = value
+                if watched[a] and value != old:
+                    self.stop = Stop(StopReason.WATCHPOINT, pc, a, old, value)
+                    pc = (pc + 1) & 0xFFFF
+                    break
+                pc = (pc + 1) & 0xFFFF
+                if ports[a] is not None:
+                    ports[a].write(a, value, (steps + executed) * CYCLES_PER_INSTRUCTION)
+                    if events and events[0][0] < deadline:
+                        break
+            elif kind == OP_SKIP:
+                pc = (pc + 1) & 0xFFFF
+            else:
+                if kind == OP_JUMP_IMM:
+                    target = (pc + b) & 0xFFFF
+                elif kind == OP_JUMP_REG:
+                    offset = slots[b]
+                    target = (pc + offset - 256 if offset >= 128 else pc + offset) & 0xFFFF
+                else:
+                    target = slots[b] | slots[b + 1] << 8
+                if blocks is not None:
+                    blocks.add((entry, pc, target))
+                    entry, entered = target, executed
+                if target == pc:
+                    self.halted = True
+                    break
+                pc = target
+                if fetch_hooks[target]:
+                    self.fetch_devices[target].fetch(target, (steps + executed) * CYCLES_PER_INSTRUCTION)
+                    if events and events[0][0] < deadline:
+                        break
+        if tracing:
+            trace.position = position
+            trace.count += executed
+        if blocks is not None and executed > entered:
+            record_partial_block(blocks, entry, pc, executed - entered)
+        self.pc = pc
+        self.steps += executed
+        return executed
+
+    # Go back to the state after `steps` instructions, by restoring the
+    # nearest checkpoint before it and replaying forward.
+    def run_to(self, steps: int):
+        if steps < 0:
+            raise ValueError("cannot run back past reset")
+        if steps < self.steps:
+            self.restore(max((c for c in self.checkpoints if c.steps <= steps),
+                             key=lambda c: c.steps))
+        while self.steps < steps and not self.halted:
+            self.execute(steps - self.steps)
+
+    def reverse_step(self, count: int = 1):
+        self.run_to(max(self.steps - count, 0))
+
+    # Go back to the last instruction that wrote a register, so the pc points
+    # at that instruction and the register holds its old value. Returns
+    # False and leaves the state unchanged if the register was not written
+    # since reset.
+    def run_back_to_write(self, register: int) -> bool:
+        start = end = self.steps
+        for checkpoint in reversed([c for c in self.checkpoints if c.steps < end]):
+            self.restore(checkpoint)
+            last_write = None
+            while self.steps < end:
+                kind, a, _ = self.decode[self.memory.read(self.pc)]
+                if a == register and (kind == OP_LOAD or kind == OP_MOVE):
+                    last_write = self.steps
+                self.execute(1)
+            if last_write is not None:
+                self.run_to(last_write)
+                return True
+            end = checkpoint.steps
+        self.run_to(start)
+        return False
+
+    def print_state(self, file=sys.stdout):
+        registers = " ".join(f"r{i}={v:02X}" for i, v in enumerate(self.registers))
+        state = " (halted)" if self.halted else ""
+        file.write(f"pc={self.pc:04X} {registers} steps={self.steps} "
+                   f"cycles={self.cycles}{state}\n")
+
+
+# Assemble a source file into a binary image, placed the same way as by the
+# assembler. Returns the image and the program with the address and encoding
+# of every instruction filled in.
+def assemble_program(path: str) -> Tuple[bytes, List[Instruction]]:
+    parser = AssemblyParser()
+    parser.parse_file(path)
+    return build_binary(parser.program, path), parser.program
+
+# Read a binary image, or assemble it if the file is an assembly source.
+def load_image(path: str) -> bytes:
+    if path.endswith(".s"):
+        return assemble_program(path)[0]
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError as e:
+        error(f"cannot read '{path}': {e.strerror}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", metavar="INPUT",
+        help="binary image or assembly source to run")
+    parser.add_argument("-n", "--steps", type=int, default=10**7,
+        help="maximum number of instructions to execute")
+    parser.add_argument("--checkpoint-interval", type=int, default=100000,
+        help="number of instructions between automatic checkpoints")
+    args = parser.parse_args()
+
+    emulator = Emulator(args.checkpoint_interval)
+    emulator.load_binary(load_image(args.input))
+    emulator.run(args.steps)
+    emulator.print_state()
+    if not emulator.halted:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
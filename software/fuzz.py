@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# A fuzzer that checks that the parser, layouter, encoder, printer and
+# disassembler agree with each other. It generates random valid and
+# near-valid programs, assembles them in-process, decodes the binary again,
+# and compares the results against a simple model of the assembler. Failing
+# programs are shrunk to a minimal reproducer. Batches of programs are
+# checked in parallel by a pool of worker processes.
+import argparse
+import io
+import multiprocessing
+import os
+import random
+import sys
+import time
+from contextlib import redirect_stderr
+from dataclasses import dataclass, field
+from typing import *
+
+import assembler
+from assembler import (AssemblyParser, AssemblyPrinter, Opcode, Operand,
+                       OperandKind, build_binary)
+from disassembler import decode_instruction
+
+
+# A generated line of assembly.
+@dataclass
+class Line:
+    text: str
+    # Whether the line produces an instruction or directive
+    produces: bool = True
+    # Number of words the line occupies in the binary
+    words: int = 1
+    # The target address of an `.org` directive
+    org: Optional[int] = None
+    # The alignment of a `.section` directive
+    section: Optional[int] = None
+    # The names of a label defined and a label referenced by the line
+    label: Optional[str] = None
+    reference: Optional[str] = None
+    # The bytes a data directive puts into the binary
+    data: Optional[bytes] = None
+    # Whether the assembler should accept the line on its own
+    valid: bool = True
+
+# The position in a program being generated or checked. Every `.org` and
+# `.section` starts a new region. Addresses in a `.section` are relative to
+# its start, as the linker decides where it goes.
+@dataclass
+class Position:
+    address: int = 0
+    region: int = 0
+    # The labels defined so far, as (name, region, address)
+    labels: List[Tuple[str, int, int]] = field(default_factory=list)
+
+    def advance(self, line: Line):
+        if not line.produces:
+            return
+        if line.label is not None:
+            self.labels.append((line.label, self.region, self.address))
+        if line.org is not None or line.section is not None:
+            self.address = line.org if line.org is not None else 0
+            self.region += 1
+        else:
+            self.address += line.words
+
+
+# Format an immediate in one of the notations accepted by the assembler.
+def format_immediate(rng: random.Random, value: int) -> str:
+    sign = "-" if value < 0 else rng.choice(["", "", "+"])
+    value = abs(value)
+    text = rng.choice([f"{value}", f"0x{value:x}", f"0x{value:X}", f"0o{value:o}",
+                       f"0b{value:b}"])
+    if len(text) > 3 and rng.random() < 0.1:
+        text = text[:3] + "_" + text[3:]
+    return sign + text
+
+# Printable characters and escape sequences of `.ascii` strings, with the
+# bytes they stand for
+ASCII_PIECES = [(chr(c), bytes([c])) for c in range(0x20, 0x7F) if chr(c) not in '"\\'] + [
+    ("\\n", b"\n"), ("\\t", b"\t"), ("\\\\", b"\\"), ('\\"', b'"'), ("\\x00", b"\0"),
+    ("\\xff", b"\xff"),
+]
+
+# Generate a random data directive, with the bytes it must put into the
+# binary.
+def generate_data_line(rng: random.Random) -> Line:
+    sep = lambda: rng.choice([", ", ",", " , ", " /* c */, "])
+    choice = rng.randrange(4)
+    if choice == 0:
+        values = [rng.randint(-128, 255) for _ in range(rng.randint(1, 9))]
+        data = bytes(v & 0xFF for v in values) + b"\0" * (len(values) % 2)
+        text = sep().join(format_immediate(rng, v) for v in values)
+        return Line(f".byte {text}", words=len(data) // 2, data=data)
+    if choice == 1:
+        values = [rng.randint(-2**15, 2**16 - 1) for _ in range(rng.randint(2, 6))]
+        data = b"".join((v & 0xFFFF).to_bytes(2, "little") for v in values)
+        text = sep().join(format_immediate(rng, v) for v in values)
+        return Line(f".word {text}", words=len(values), data=data)
+    if choice == 2:
+        pieces = [rng.choice(ASCII_PIECES) for _ in range(rng.randint(0, 12))]
+        data = b"".join(piece[1] for piece in pieces)
+        data += b"\0" * (len(data) % 2)
+        return Line(f'.ascii "{"".join(piece[0] for piece in pieces)}"',
+                    words=len(data) // 2, data=data)
+    count = rng.choice([0, 1, rng.randint(2, 40)])
+    value = rng.choice([None, rng.randint(-2**15, 2**16 - 1)])
+    text = f".fill {format_immediate(rng, count)}"
+    if value is not None:
+        text += f", {format_immediate(rng, value)}"
+    return Line(text, words=count, data=((value or 0) & 0xFFFF).to_bytes(2, "little") * count)
+
+# Generate a random line that the assembler must accept. Programs use either
+# `.org` or `.section`, such that the model does not need to place sections
+# around fixed addresses.
+def generate_valid_line(rng: random.Random, position: Position, sections: bool) -> Line:
+    reg = lambda: f"r{rng.randint(0, 6)}"
+    sep = rng.choice([", ", ",", " , "])
+    address = position.address
+    choice = rng.randrange(16)
+    if choice < 3:
+        return Line(f"ldi {reg()}{sep}{format_immediate(rng, rng.randint(-128, 255))}")
+    if choice < 5:
+        return Line(f"mv {reg()}{sep}{reg()}")
+    if choice == 5:
+        return Line(f"jreli {format_immediate(rng, rng.randint(-128, 127))}")
+    if choice == 6:
+        return Line(f"jrelr {reg()}")
+    if choice == 7:
+        lo = rng.randint(0, 5)
+        return Line(f"jabsr r{lo}r{lo + 1}")
+    if choice == 8:
+        return Line(rng.choice(["nop", "halt"]))
+    if choice == 9:
+        return Line(f".word {format_immediate(rng, rng.randint(-2**15, 2**16 - 1))}")
+    if choice == 10 and sections:
+        align = rng.choice([None, 1, 2, 4, 16])
+        return Line(".section" if align is None else f".section {align}", words=0,
+                    section=align or 1)
+    if choice == 10:
+        org = address + rng.choice([0, 1, rng.randint(2, 300)])
+        return Line(f".org {format_immediate(rng, org)}", words=0, org=org)
+    if choice == 11:
+        return Line(f"l{len(position.labels)}:", words=0, label=f"l{len(position.labels)}")
+    if choice == 12 and position.labels:
+        # Relative jumps only go back to labels in reach in the same region
+        # and may end up as a `halt`; the other references go anywhere
+        near = [name for name, region, label_address in position.labels
+                if region == position.region and address - label_address <= 128]
+        if near and rng.random() < 0.5:
+            name = rng.choice(near)
+            return Line(f"jreli {name}", reference=name)
+        name = rng.choice(position.labels)[0]
+        return Line(f"ldi {reg()}{sep}{rng.choice(['lo', 'hi'])}({name})", reference=name)
+    if choice in (13, 14):
+        return generate_data_line(rng)
+    return Line(rng.choice(["# comment", "// comment", "/* comment */",
+                            "/* multi\n   line */", ""]), produces=False)
+
+# Generate a random line that is close to valid, but must be rejected by the
+# assembler.
+def generate_invalid_line(rng: random.Random, address: int) -> Line:
+    return Line(rng.choice([
+        f"ldi r0, {rng.choice([256, 1000, -129])}",
+        f"jreli {rng.choice([128, 255, -129])}",
+        f".word {rng.choice([65536, -32769])}",
+        f"mv r7, r0",
+        f"mv r0, r7",
+        f"ldi r1 5",
+        f"ldi r1, 0x",
+        f"jabsr r6r7",
+        f"jabsr r1r3",
+        f"jabsr r2",
+        f"jrelr 5",
+        f"mov r1, r2",
+        f".byte {rng.choice([256, -129])}",
+        f".byte 1, 2,",
+        f".word 1, {rng.choice([65536, -32769])}",
+        f".fill {rng.choice([-1, 65537])}",
+        f".fill 2, 65536",
+        f'.ascii "\\x4"',
+        f".ascii unquoted",
+        f".section {rng.choice([0, 3, 6])}",
+    ]), valid=False)
+
+# Generate a random program. A fraction of the programs contain a single
+# invalid line.
+def generate_case(rng: random.Random, num_lines: int, invalid_rate: float) -> List[Line]:
+    lines = []
+    position = Position()
+    sections = rng.random() < 0.3
+    for _ in range(num_lines):
+        line = generate_valid_line(rng, position, sections)
+        position.advance(line)
+        lines.append(line)
+    if rng.random() < invalid_rate:
+        index = rng.randrange(len(lines) + 1)
+        lines.insert(index, generate_invalid_line(rng, position.address))
+    # Sometimes put a comment on the same line as an instruction
+    for line in lines:
+        if line.produces and rng.random() < 0.05:
+            line.text += rng.choice(["  # trailing", " // trailing"])
+    return lines
+
+def case_source(lines: List[Line], final_newline: bool = True) -> str:
+    return "\n".join(line.text for line in lines) + ("\n" if final_newline else "")
+
+
+# Assemble source text in-process. Returns the program and the binary, or the
+# error message if the assembler rejected the program.
+def assemble(source: str) -> Union[Tuple[list, bytes], str]:
+    assembler.parse_cache.clear()
+    stderr = io.StringIO()
+    try:
+        with redirect_stderr(stderr):
+            parser = AssemblyParser()
+            parser.parse_source(source)
+            binary = build_binary(parser.program, "<input>")
+    except SystemExit:
+        return stderr.getvalue().split("\n")[0] or "error"
+    return parser.program, binary
+
+# The values of an instruction's operands, normalized to what the encoding
+# can represent.
+def canonical(inst) -> Tuple[Opcode, Tuple[Any, ...]]:
+    values = [op.value for op in inst.operands]
+    if inst.opcode == Opcode.LDI:
+        values[1] &= 0xFF
+    if inst.opcode == Opcode.JRELI and values[0] == 0:
+        return Opcode.HALT, ()
+    return inst.opcode, tuple(values)
+
+# An instruction with its label reference replaced by the value it must be
+# encoded with, given the address of every label.
+def resolved(inst, labels: Dict[str, int]):
+    if inst.symbol is None:
+        return inst
+    kind, name = inst.symbol
+    address = labels[name]
+    if kind == "rel":
+        value = address - inst.address
+    else:
+        value = address >> 8 if kind == "hi" else address & 0xFF
+    return inst.replace(operands=inst.operands[:-1] + [Operand(OperandKind.Imm, value)])
+
+def format_inst(inst) -> str:
+    return AssemblyPrinter([inst], False, False).print().strip()
+
+# Check a single program. Returns a description of the first disagreement
+# found, or None if everything agrees.
+def check_case(lines: List[Line], final_newline: bool = True) -> Optional[str]:
+    # Compute the expected addresses and validity with a simple model, as
+    # (line, region, address) of every instruction. A label must be defined
+    # for the program to be valid.
+    expected = []
+    valid = True
+    position = Position()
+    for line in lines:
+        valid = valid and line.valid
+        if not line.produces:
+            continue
+        if line.org is not None:
+            valid = valid and line.org >= position.address
+        position.advance(line)
+        expected.append((line, position.region, position.address - line.words
+                         if line.org is None and line.section is None else position.address))
+    defined = {name for name, _, _ in position.labels}
+    valid = valid and all(line.reference in defined for line in lines
+                          if line.reference is not None)
+
+    result = assemble(case_source(lines, final_newline))
+    if isinstance(result, str):
+        return None if not valid else f"rejected valid program: {result}"
+    if not valid:
+        return "accepted invalid program"
+    program, binary = result
+
+    if len(program) != len(expected):
+        return f"parsed {len(program)} instructions; expected {len(expected)}"
+    words = memoryview(binary[:len(binary) & ~1]).cast("H")
+    labels = {inst.operands[0].value: inst.address for inst in program
+              if inst.opcode == Opcode.D_LABEL}
+    # Every instruction of a region is moved by the same amount. Sections
+    # may be placed anywhere at their alignment, while code at an `.org` and
+    # at the start of the program stays where it is.
+    regions: Dict[int, int] = {}
+    alignments = {region: line.section for line, region, _ in expected if line.section}
+    for (line, region, address), inst in zip(expected, program):
+        delta = regions.setdefault(region, inst.address - address)
+        if (inst.address - address != delta or delta % alignments.get(region, 1) != 0 or
+                delta != 0 and (line.org is not None or region == 0 and line.words)):
+            return (f"layout mismatch: '{format_inst(inst)}' at {inst.address}; expected "
+                    f"{address} in region {region} placed at {delta}")
+        if line.data is not None:
+            found = binary[2 * inst.address:2 * inst.address + len(line.data)]
+            if found != line.data:
+                return (f"data mismatch: '{line.text}' at {inst.address} holds "
+                        f"{found.hex()}; expected {line.data.hex()}")
+            continue
+        if inst.encoding is None:
+            continue
+        inst = resolved(inst, labels)
+        if inst.address >= len(words) or words[inst.address] != inst.encoding:
+            found = words[inst.address] if inst.address < len(words) else None
+            return (f"image mismatch: '{format_inst(inst)}' encoded as "
+                    f"{inst.encoding:04X}, but image holds {found} at {inst.address}")
+        if inst.opcode == Opcode.D_WORD:
+            continue
+        decoded = decode_instruction(inst.encoding, inst.address)
+        if canonical(decoded) != canonical(inst):
+            return (f"decode mismatch: '{format_inst(inst)}' encoded as "
+                    f"{inst.encoding:04X} decodes as '{format_inst(decoded)}'")
+
+    # The printed program must assemble to the same binary
+    printed = AssemblyPrinter(program, False, False).print()
+    reassembled = assemble(printed)
+    if isinstance(reassembled, str):
+        return f"printed program rejected: {reassembled}"
+    if reassembled[1] != binary:
+        return "printed program assembles to a different binary"
+    return None
+
+
+# Shrink a failing program by repeatedly removing chunks of lines, as long as
+# the program still fails in the same way.
+def shrink(lines: List[Line], message: str, final_newline: bool) -> Tuple[List[Line], str]:
+    kind = message.split(":")[0]
+    def fails(candidate):
+        result = check_case(candidate, final_newline)
+        return result if result is not None and result.split(":")[0] == kind else None
+    chunk = len(lines) // 2
+    while chunk >= 1:
+        index = 0
+        while index < len(lines):
+            candidate = lines[:index] + lines[index + chunk:]
+            if candidate and (result := fails(candidate)):
+                lines, message = candidate, result
+            else:
+                index += chunk
+        chunk //= 2
+    return lines, message
+
+
+# The result of checking a batch of programs.
+@dataclass
+class BatchResult:
+    cases: int
+    instructions: int
+    failures: List[Tuple[str, str]]
+
+# Check a batch of random programs. Runs in a worker process.
+def run_batch(task: Tuple[int, int, int, float]) -> BatchResult:
+    seed, cases, num_lines, invalid_rate = task
+    rng = random.Random(seed)
+    result = BatchResult(cases, 0, [])
+    for _ in range(cases):
+        lines = generate_case(rng, rng.randint(1, num_lines), invalid_rate)
+        final_newline = rng.random() < 0.9
+        result.instructions += sum(line.produces for line in lines)
+        if (message := check_case(lines, final_newline)) is not None:
+            lines, message = shrink(lines, message, final_newline)
+            result.failures.append((message, case_source(lines, final_newline)))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+        help="number of worker processes")
+    parser.add_argument("-t", "--duration", type=float, default=60,
+        help="seconds to fuzz for")
+    parser.add_argument("--seed", type=int, default=int(time.time()),
+        help="seed of the first batch")
+    parser.add_argument("--batch", type=int, default=200,
+        help="number of programs per batch")
+    parser.add_argument("--lines", type=int, default=50,
+        help="maximum number of lines per program")
+    parser.add_argument("--invalid-rate", type=float, default=0.1,
+        help="fraction of programs containing an invalid line")
+    parser.add_argument("-o", "--output-dir", type=str,
+        help="directory to write failing programs to")
+    args = parser.parse_args()
+
+    def tasks():
+        seed = args.seed
+        while True:
+            yield seed, args.batch, args.lines, args.invalid_rate
+            seed += 1
+
+    start = time.perf_counter()
+    cases = instructions = 0
+    failures = {}
+    with multiprocessing.Pool(args.jobs) as pool:
+        for result in pool.imap_unordered(run_batch, tasks()):
+            cases += result.cases
+            instructions += result.instructions
+            for message, source in result.failures:
+                # Only keep the smallest reproducer of each kind of failure
+                kind = message.split(":")[0]
+                if kind not in failures or len(source) < len(failures[kind][1]):
+                    failures[kind] = (message, source)
+            elapsed = time.perf_counter() - start
+            sys.stderr.write(
+                f"\r{cases} programs, {instructions} instructions "
+                f"({instructions / elapsed * 60:.0f}/min), "
+                f"{len(failures)} failures")
+            if elapsed >= args.duration:
+                pool.terminate()
+                break
+    sys.stderr.write("\n")
+
+    for i, (kind, (message, source)) in enumerate(sorted(failures.items())):
+        print(f"failure: {message}")
+        print("".join(f"    {line}\n" for line in source.split("\n")))
+        if args.output_dir:
+            with open(os.path.join(args.output_dir, f"fuzz-failure-{i}.s"), "w") as f:
+                f.write(source)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
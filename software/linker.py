@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# A linker for the object files written by `assembler.py -c`. Sections with a
+# fixed origin are placed at their address, and the other sections are packed
+# into the gaps between them, at their alignment and within reach of the
+# relative jumps between sections. Labels are then resolved across all files
+# and the relocations are applied to the encoded words.
+import argparse
+import sys
+from array import array
+from typing import *
+
+from assembler import error, print_binary_hexdump
+from objfile import ObjectFile, read_object
+
+# Size of the address space in words
+ADDRESS_SPACE = 1 << 16
+
+
+# Find the section and offset of every label, as (file index, section index,
+# offset) by name.
+def collect_definitions(objects: List[ObjectFile], paths: List[str]) -> Dict[str, Tuple[int, int, int]]:
+    definitions: Dict[str, Tuple[int, int, int]] = {}
+    for i, obj in enumerate(objects):
+        for symbol in obj.symbols:
+            if symbol.section is None:
+                continue
+            if symbol.name in definitions:
+                error(f"label '{symbol.name}' is defined in both "
+                      f"'{paths[definitions[symbol.name][0]]}' and '{paths[i]}'")
+            definitions[symbol.name] = (i, symbol.section, symbol.offset)
+    return definitions
+
+# The relative jumps between sections, which limit how far apart the sections
+# can be placed. Every jump is listed under both of its sections, as (section
+# of the jump, offset of the jump, section of the label, offset of the label)
+# with sections keyed by (file index, section index).
+def jump_limits(objects: List[ObjectFile],
+                definitions: Dict[str, Tuple[int, int, int]]) -> Dict[Tuple[int, int], List[tuple]]:
+    limits: Dict[Tuple[int, int], List[tuple]] = {}
+    for i, obj in enumerate(objects):
+        for reloc in obj.relocations:
+            name = obj.symbols[reloc.symbol].name
+            if reloc.kind != "rel" or name not in definitions:
+                continue
+            label_file, label_section, label_offset = definitions[name]
+            limit = ((i, reloc.section), reloc.offset, (label_file, label_section), label_offset)
+            limits.setdefault(limit[0], []).append(limit)
+            limits.setdefault(limit[2], []).append(limit)
+    return limits
+
+# The lowest and highest address a section can be placed at, such that its
+# relative jumps to and from the sections placed so far stay in range.
+def allowed_range(key: Tuple[int, int], size: int, limits: List[tuple],
+                  addresses: Dict[Tuple[int, int], int]) -> Tuple[int, int]:
+    low, high = 0, ADDRESS_SPACE - size
+    for jump_section, jump_offset, label_section, label_offset in limits:
+        if jump_section == key and label_section in addresses:
+            target = addresses[label_section] + label_offset
+            low = max(low, target - jump_offset - 127)
+            high = min(high, target - jump_offset + 128)
+        elif label_section == key and jump_section in addresses:
+            source = addresses[jump_section] + jump_offset
+            low = max(low, source - label_offset - 128)
+            high = min(high, source - label_offset + 127)
+    return low, high
+
+# Compute the address of every section, keyed by (file index, section index).
+#
+# Sections with a fixed origin are placed first. The first section of the
+# first file holds the entry point, so it goes to address 0 unless a fixed
+# section is there. The other sections are packed into the gaps largest
+# first, each into the gap it fills best. The sections a section has relative
+# jumps with are placed right after it, and only where the jumps reach.
+def place_sections(objects: List[ObjectFile], paths: List[str],
+                   definitions: Dict[str, Tuple[int, int, int]]) -> Dict[Tuple[int, int], int]:
+    addresses = {}
+    used = []
+    for i, obj in enumerate(objects):
+        for j, section in enumerate(obj.sections):
+            if section.origin is None:
+                continue
+            start, end = section.origin, section.origin + len(section.words)
+            addresses[i, j] = start
+            if not section.words:
+                continue
+            if end > ADDRESS_SPACE:
+                error(f"section {j} of '{paths[i]}' at 0x{start:04X} does not fit "
+                      f"into the address space")
+            for other_start, other_end, other in used:
+                if start < other_end and other_start < end:
+                    error(f"section {j} of '{paths[i]}' at 0x{start:04X}-0x{end:04X} "
+                          f"overlaps {other} at 0x{other_start:04X}-0x{other_end:04X}")
+            used.append((start, end, f"section {j} of '{paths[i]}'"))
+
+    # Gaps between the fixed sections, as [start, end) ranges
+    gaps = []
+    position = 0
+    for start, end, _ in sorted(used):
+        if start > position:
+            gaps.append([position, start])
+        position = max(position, end)
+    gaps.append([position, ADDRESS_SPACE])
+
+    limits = jump_limits(objects, definitions)
+    def place(i: int, j: int, entry: bool = False):
+        section = objects[i].sections[j]
+        size, align = len(section.words), section.align
+        low, high = allowed_range((i, j), size, limits.get((i, j), []), addresses)
+        best = None
+        for gap in gaps:
+            start = -(-max(gap[0], low) // align) * align
+            if start + size > gap[1] or start > high or (entry and start != 0):
+                continue
+            waste = gap[1] - start - size
+            if best is None or waste < best[0]:
+                best = (waste, start, gap)
+        if best is None:
+            where = ""
+            if entry:
+                where = " at address 0 for the entry point"
+            elif low > 0 or high < ADDRESS_SPACE - size:
+                where = " within reach of its relative jumps"
+            error(f"no space left for section {j} of '{paths[i]}' with {size} words{where}")
+        _, start, gap = best
+        index = gaps.index(gap)
+        gaps[index:index + 1] = [g for g in ([gap[0], start], [start + size, gap[1]])
+                                 if g[1] > g[0]]
+        addresses[i, j] = start
+
+    if objects and objects[0].sections and objects[0].sections[0].origin is None:
+        if objects[0].sections[0].words and gaps[0][0] == 0:
+            place(0, 0, entry=True)
+
+    sizes = {(i, j): len(section.words)
+             for i, obj in enumerate(objects) for j, section in enumerate(obj.sections)}
+    pending = [key for key in sorted(sizes, key=lambda key: (sizes[key], -key[0], -key[1]))
+               if key not in addresses]
+    while pending:
+        key = pending.pop()
+        if key in addresses:
+            continue
+        place(*key)
+        # The sections this one has relative jumps with go next, largest first
+        neighbours = {limit[0] for limit in limits.get(key, [])}
+        neighbours |= {limit[2] for limit in limits.get(key, [])}
+        pending += sorted((other for other in neighbours if other not in addresses),
+                          key=lambda other: (sizes[other], -other[0], -other[1]))
+    return addresses
+
+# Link object files into a binary image.
+def link(objects: List[ObjectFile], paths: List[str],
+         output_size: Optional[int] = None) -> Tuple[bytes, Dict[Tuple[int, int], int], Dict[str, int]]:
+    definitions = collect_definitions(objects, paths)
+    addresses = place_sections(objects, paths, definitions)
+    symbols = {name: addresses[i, j] + offset for name, (i, j, offset) in definitions.items()}
+
+    size = max([address + len(objects[i].sections[j].words)
+                for (i, j), address in addresses.items()] + [0])
+    image = array("H", bytes(2 * size))
+    for (i, j), address in addresses.items():
+        words = objects[i].sections[j].words
+        image[address:address + len(words)] = array("H", words)
+
+    # Patch the immediate byte of every instruction referring to a label
+    for i, obj in enumerate(objects):
+        for reloc in obj.relocations:
+            name = obj.symbols[reloc.symbol].name
+            address = addresses[i, reloc.section] + reloc.offset
+            if name not in symbols:
+                error(f"undefined label '{name}'",
+                      f"referenced from '{paths[i]}' at 0x{address:04X}")
+            target = symbols[name]
+            if reloc.kind == "rel":
+                value = target - address
+                if not -128 <= value < 128:
+                    error(f"label '{name}' is out of range of a relative jump, {value} words away",
+                          f"referenced from '{paths[i]}' at 0x{address:04X}")
+            else:
+                value = target >> 8 if reloc.kind == "hi" else target
+            image[address] = (image[address] & 0xFF) | (value & 0xFF) << 8
+
+    if sys.byteorder != "little":
+        image.byteswap()
+    binary = image.tobytes()
+    if output_size is not None:
+        if len(binary) > output_size:
+            error(f"linked binary has {len(binary)} bytes, more than the output size "
+                  f"of {output_size} bytes")
+        binary += bytes(output_size - len(binary))
+    return binary, addresses, symbols
+
+# Print a memory map with the used and free ranges of the address space, and
+# the address of every label.
+def print_map(objects: List[ObjectFile], paths: List[str],
+              addresses: Dict[Tuple[int, int], int], symbols: Dict[str, int],
+              file: TextIO = sys.stdout):
+    ranges = []
+    for (i, j), address in addresses.items():
+        section = objects[i].sections[j]
+        if not section.words:
+            continue
+        placement = "fixed" if section.origin is not None else f"placed, align {section.align}"
+        ranges.append((address, address + len(section.words), f"{paths[i]} section {j} ({placement})"))
+    ranges.sort()
+    used = sum(end - start for start, end, _ in ranges)
+
+    file.write("memory map:\n")
+    position = 0
+    free_ranges = []
+    for start, end, description in ranges + [(ADDRESS_SPACE, ADDRESS_SPACE, None)]:
+        if start > position:
+            free_ranges.append(start - position)
+            file.write(f"  0x{position:04X}-0x{start:04X}  {start - position:>5d} words  free\n")
+        if description is not None:
+            file.write(f"  0x{start:04X}-0x{end:04X}  {end - start:>5d} words  {description}\n")
+        position = end
+    file.write(f"{used} words used in {len(ranges)} sections, "
+               f"{ADDRESS_SPACE - used} words free in {len(free_ranges)} ranges\n")
+    file.write("labels:\n")
+    for name, address in sorted(symbols.items(), key=lambda item: item[1]):
+        file.write(f"  0x{address:04X}  {name}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", metavar="INPUT", nargs="+",
+        help="object files to link")
+    parser.add_argument("-o", "--output", type = str,
+        help="output file")
+    parser.add_argument("-s", "--size", type = int,
+        help="size of the output binary")
+    parser.add_argument("-m", "--map", action="store_true",
+        help="print a memory map with the used and free ranges and every label")
+    args = parser.parse_args()
+
+    objects = [read_object(path) for path in args.inputs]
+    binary, addresses, symbols = link(objects, args.inputs, args.size)
+    if args.map:
+        print_map(objects, args.inputs, addresses, symbols)
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(binary)
+    else:
+        print_binary_hexdump(binary)
+
+if __name__ == "__main__":
+    main()
@@ -47,7 +47,7 @@
     ldi r6, 0x00
     jabsr r5r6 # 0x00
 
-.org 0x20
+.org 0x10
     ldi r0, 0xF0
     ldi r1, 0x55
     ldi r2, 0xAA
@@ -150,11 +150,8 @@ program = array.array('h', [
 
 rom = bytearray(null * 32768)
 proglength = len(program)
-print("rom begin")
-for i in range (0, proglength):
-    rom[i] = program[i]
-    print(hex(rom[i]))
-print("rom end")
+rom[0:proglength] = bytes(program.tolist())
+print(f"rom: {proglength} bytes of program")
 print("-14 :")
 print(bin(-14 & 0xFF))
 print(hex(-14 & 0xFF))
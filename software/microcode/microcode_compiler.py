@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# Compiler for the control ROMs of the CPU. Reads a table that maps
+# combinations of instruction opcode, step counter and flags to named control
+# signals, checks that no two drivers are enabled on a bus at the same time,
+# and fills the entire address space of all ROMs at once with NumPy.
+import argparse
+import os
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from termcolor import colored
+from typing import *
+
+import numpy as np
+
+
+# Report an error and exit with an error code
+def error(message, *args):
+    sys.stderr.write(
+        colored("error:", "red", attrs=["bold"]) + " " +
+        colored(message, attrs=["bold"]) + "\n")
+    for arg in args:
+        sys.stderr.write(arg + "\n")
+    sys.exit(1)
+
+
+# A group of address lines of the control ROMs, like the step counter.
+@dataclass
+class AddressField:
+    name: str
+    offset: int
+    width: int
+
+# A control line, driven by one bit of one of the ROMs.
+@dataclass
+class Signal:
+    name: str
+    bit: int
+    # The bus this signal enables a driver on, if any
+    bus: Optional[str] = None
+    active_low: bool = False
+
+# A row of the table. Every address whose fields match all conditions enables
+# the row's signals. Conditions are stored as (care mask, value) pairs.
+@dataclass
+class Row:
+    line: int
+    conditions: Dict[str, Tuple[int, int]]
+    signals: int
+
+# A parsed control signal table.
+@dataclass
+class MicrocodeTable:
+    fields: Dict[str, AddressField] = field(default_factory=dict)
+    roms: List[str] = field(default_factory=list)
+    signals: Dict[str, Signal] = field(default_factory=dict)
+    rows: List[Row] = field(default_factory=list)
+
+    def address_bits(self) -> int:
+        return sum(f.width for f in self.fields.values())
+
+    # Bits of all signals driving each bus
+    def bus_masks(self) -> Dict[str, int]:
+        masks = {}
+        for signal in self.signals.values():
+            if signal.bus is not None:
+                masks[signal.bus] = masks.get(signal.bus, 0) | 1 << signal.bit
+        return masks
+
+    def active_low_mask(self) -> int:
+        return sum(1 << s.bit for s in self.signals.values() if s.active_low)
+
+    # Names of the signals set in a control word
+    def signal_names(self, word: int) -> List[str]:
+        return [s.name for s in self.signals.values() if word >> s.bit & 1]
+
+
+# Parse a control signal table from a file.
+def parse_table(file: str) -> MicrocodeTable:
+    table = MicrocodeTable()
+    with open(file, "r") as f:
+        lines = f.read().split("\n")
+    for line_num, line in enumerate(lines, 1):
+        def fail(message):
+            error(message, f"{file}:{line_num}", "", f"  {line}")
+        def parse_int(text: str, what: str) -> int:
+            if not text.isdigit():
+                fail(f"invalid {what} '{text}'; expected a decimal number")
+            return int(text)
+        words = line.split("#")[0].split()
+        if not words:
+            continue
+
+        if words[0] == "address":
+            if len(words) != 4:
+                fail("expected `address NAME OFFSET WIDTH`")
+            name = words[1]
+            offset, width = parse_int(words[2], "offset"), parse_int(words[3], "width")
+            for other in table.fields.values():
+                if offset < other.offset + other.width and other.offset < offset + width:
+                    fail(f"address field '{name}' overlaps '{other.name}'")
+            table.fields[name] = AddressField(name, offset, width)
+            continue
+
+        if words[0] == "rom":
+            if len(words) != 2:
+                fail("expected `rom NAME`")
+            table.roms.append(words[1])
+            continue
+
+        if words[0] == "signal":
+            if len(words) < 4:
+                fail("expected `signal NAME ROM BIT [drives BUS] [active-low]`")
+            name, rom, bit = words[1], words[2], parse_int(words[3], "bit")
+            if rom not in table.roms:
+                fail(f"unknown rom '{rom}'")
+            if bit not in range(8):
+                fail(f"bit {bit} out of range; expected 0 to 7")
+            signal = Signal(name, table.roms.index(rom) * 8 + bit)
+            options = words[4:]
+            while options:
+                if options[0] == "drives" and len(options) > 1:
+                    signal.bus = options[1]
+                    options = options[2:]
+                elif options[0] == "active-low":
+                    signal.active_low = True
+                    options = options[1:]
+                else:
+                    fail(f"unknown signal option '{options[0]}'")
+            for other in table.signals.values():
+                if other.bit == signal.bit:
+                    fail(f"signal '{name}' uses the same ROM bit as '{other.name}'")
+            table.signals[name] = signal
+            continue
+
+        if ":" not in words:
+            fail("expected `FIELD=VALUE ... : SIGNALS`")
+        split = words.index(":")
+        conditions = {}
+        for condition in words[:split]:
+            m = re.fullmatch(r'(\w+)=(0b[01x]+|0x[0-9a-fA-F]+|\d+)', condition)
+            if not m:
+                fail(f"invalid condition '{condition}'")
+            if m[1] not in table.fields:
+                fail(f"unknown address field '{m[1]}'")
+            width = table.fields[m[1]].width
+            try:
+                pattern = parse_pattern(m[2], width)
+            except ValueError:
+                fail(f"invalid value '{m[2]}'")
+            if pattern is None:
+                fail(f"value '{m[2]}' does not fit into {width} bit field '{m[1]}'")
+            conditions[m[1]] = pattern
+        signals = 0
+        for name in words[split + 1:]:
+            if name not in table.signals:
+                fail(f"unknown signal '{name}'")
+            signals |= 1 << table.signals[name].bit
+        table.rows.append(Row(line_num, conditions, signals))
+    return table
+
+# Parse the value of a condition into a (care mask, value) pair. Bit patterns
+# like `0bxx01` must have exactly one digit per bit of the field; `x` digits
+# are ignored. Returns None if the value does not fit the field.
+def parse_pattern(text: str, width: int) -> Optional[Tuple[int, int]]:
+    if text.startswith("0b"):
+        bits = text[2:]
+        if len(bits) != width:
+            return None
+        care = int(bits.replace("0", "1").replace("x", "0"), 2)
+        return care, int(bits.replace("x", "0"), 2)
+    value = int(text, 0)
+    if value >= 1 << width:
+        return None
+    return (1 << width) - 1, value
+
+
+# Compute the control word for every address of the control ROMs. Returns one
+# image per ROM.
+def compile_table(table: MicrocodeTable) -> Dict[str, bytes]:
+    size = 1 << table.address_bits()
+    address = np.arange(size, dtype=np.uint32)
+    fields = {
+        f.name: (address >> f.offset) & ((1 << f.width) - 1)
+        for f in table.fields.values()
+    }
+    words = np.zeros(size, dtype=np.uint32)
+    for row in table.rows:
+        match = np.ones(size, dtype=bool)
+        for name, (care, value) in row.conditions.items():
+            match &= (fields[name] & care) == value
+        words[match] |= row.signals
+
+    # A bus has conflicting drivers if more than one of its bits is set
+    for bus, mask in table.bus_masks().items():
+        driven = words & mask
+        conflicts = np.flatnonzero(driven & (driven - 1))
+        if len(conflicts) > 0:
+            addr = int(conflicts[0])
+            location = " ".join(f"{name}={int(values[addr])}"
+                                for name, values in fields.items())
+            names = table.signal_names(int(driven[addr]))
+            lines = [str(row.line) for row in table.rows if row.signals & mask and all(
+                (int(fields[name][addr]) & care) == value
+                for name, (care, value) in row.conditions.items())]
+            error(f"conflicting drivers on bus '{bus}': {', '.join(names)}",
+                  f"at address 0x{addr:04X} ({location}), "
+                  f"{len(conflicts)} addresses affected",
+                  f"enabled by table rows on lines {', '.join(lines)} of the table")
+
+    words ^= table.active_low_mask()
+    return {
+        rom: ((words >> (8 * i)) & 0xFF).astype(np.uint8).tobytes()
+        for i, rom in enumerate(table.roms)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", metavar="TABLE",
+        help="control signal table to compile")
+    parser.add_argument("-o", "--output-dir", type = str,
+        help="directory to write the ROM images to (default: next to the table)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="print the compile time and the size of each image")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table = parse_table(args.input)
+    images = compile_table(table)
+    elapsed = time.perf_counter() - start
+
+    output_dir = args.output_dir or os.path.dirname(args.input)
+    for rom, image in images.items():
+        path = os.path.join(output_dir, f"microcode_{rom}.bin")
+        try:
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(image)
+        except OSError as e:
+            error(f"cannot write '{path}': {e.strerror}")
+        if args.verbose:
+            print(f"{path}: {len(image)} bytes")
+    if args.verbose:
+        print(f"compiled {len(table.rows)} rows in {elapsed*1000:.2f}ms")
+
+if __name__ == "__main__":
+    main()
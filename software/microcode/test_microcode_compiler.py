@@ -0,0 +1,65 @@
+# Tests of the microcode compiler. Run with `python -m pytest` in this
+# directory or the one above.
+import os
+import re
+import sys
+
+import pytest
+
+import microcode_compiler
+from microcode_compiler import compile_table, parse_table
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+TABLE = os.path.join(DIRECTORY, "microcode.txt")
+
+# A table with two drivers on one bus
+HEADER = """
+address step 0 3
+rom left
+signal A_OUT left 0 drives bus
+signal B_OUT left 1 drives bus
+signal LOAD  left 2
+"""
+
+
+def compile_text(tmp_path, text: str):
+    (tmp_path / "table.txt").write_text(text)
+    return compile_table(parse_table(str(tmp_path / "table.txt")))
+
+def reported_error(capsys) -> str:
+    return re.sub(r'\x1b\[[0-9;]*m', "", capsys.readouterr().err)
+
+
+def test_compile_is_deterministic(tmp_path, monkeypatch):
+    for name in ("a", "b/c"):
+        monkeypatch.setattr(sys, "argv", ["microcode_compiler.py", TABLE,
+                                          "-o", str(tmp_path / name)])
+        microcode_compiler.main()
+    for rom in ("left", "right"):
+        image = (tmp_path / "a" / f"microcode_{rom}.bin").read_bytes()
+        assert len(image) == 1 << 15
+        assert (tmp_path / "b" / "c" / f"microcode_{rom}.bin").read_bytes() == image
+
+def test_rows_combine(tmp_path):
+    image = compile_text(tmp_path, HEADER + "step=0b00x : A_OUT\nstep=1 : LOAD\n")["left"]
+    assert list(image) == [0b001, 0b101, 0, 0, 0, 0, 0, 0]
+
+def test_conflicting_drivers(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        compile_text(tmp_path, HEADER + "step=0b00x : A_OUT\nstep=1 : B_OUT LOAD\n")
+    output = reported_error(capsys)
+    assert "conflicting drivers on bus 'bus': A_OUT, B_OUT" in output
+    assert "lines 7, 8 of the table" in output
+
+@pytest.mark.parametrize("line, message", [
+    ("address flags 3 x", "invalid width 'x'"),
+    ("signal C_OUT left z", "invalid bit 'z'"),
+    ("step=010 : LOAD", "invalid value '010'"),
+    ("step=8 : LOAD", "does not fit into 3 bit field 'step'"),
+])
+def test_malformed_table(tmp_path, capsys, line, message):
+    with pytest.raises(SystemExit):
+        compile_text(tmp_path, HEADER + line + "\n")
+    output = reported_error(capsys)
+    assert message in output
+    assert "table.txt:7" in output
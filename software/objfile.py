@@ -0,0 +1,144 @@
+# Relocatable object files, written by `assembler.py -c` and read by
+# `linker.py`.
+#
+# An object file holds the encoded words of each section of a source file,
+# its labels, and the relocations of the immediates that refer to labels
+# whose address is only known after linking. The first section of a file
+# starts at its beginning and may be placed anywhere, as may every section
+# started by `.section`; every `.org` starts a section at a fixed address.
+#
+# All tables have fixed size records, so a file can be memory-mapped and its
+# words used without copying:
+#
+#   header       "TTO2", section count (u16), symbol count (u32),
+#                relocation count (u32), string table size (u32)
+#   sections     origin (i32, -1 if relocatable), first word (u32), word count (u32),
+#                alignment (u32)
+#   symbols      name offset (u32), section (i32, -1 if undefined), word offset (u32)
+#   relocations  section (u16), kind (u8), word offset (u32), symbol (u32)
+#   strings      NUL terminated UTF-8 names, padded to an even size
+#   words        u16 words of all sections, little endian
+import mmap
+import struct
+import sys
+from array import array
+from dataclasses import dataclass, field
+from typing import *
+
+from assembler import error
+
+OBJECT_MAGIC = b"TTO2"
+HEADER = struct.Struct("<4sHxxIII")
+SECTION = struct.Struct("<iIII")
+SYMBOL = struct.Struct("<IiI")
+RELOCATION = struct.Struct("<HBxII")
+
+# Relocation kinds, patching the high byte of the instruction word with the
+# low or high byte of a label address, or the offset from the instruction to
+# the label
+RELOCATION_KINDS = ["lo", "hi", "rel"]
+
+
+@dataclass
+class Section:
+    # None if the section may be placed anywhere
+    origin: Optional[int]
+    words: Sequence[int]
+    # Relocatable sections are placed at a multiple of this
+    align: int = 1
+
+@dataclass
+class Symbol:
+    name: str
+    # None for labels defined in another object file
+    section: Optional[int]
+    offset: int = 0
+
+@dataclass
+class Relocation:
+    section: int
+    offset: int
+    kind: str
+    symbol: int
+
+@dataclass
+class ObjectFile:
+    sections: List[Section] = field(default_factory=list)
+    symbols: List[Symbol] = field(default_factory=list)
+    relocations: List[Relocation] = field(default_factory=list)
+
+    def write(self, path: str):
+        strings = bytearray()
+        name_offsets = []
+        for symbol in self.symbols:
+            name_offsets.append(len(strings))
+            strings += symbol.name.encode() + b"\0"
+        if len(strings) % 2 != 0:
+            strings.append(0)
+
+        output = bytearray(HEADER.pack(OBJECT_MAGIC, len(self.sections), len(self.symbols),
+                                       len(self.relocations), len(strings)))
+        first = 0
+        for section in self.sections:
+            origin = -1 if section.origin is None else section.origin
+            output += SECTION.pack(origin, first, len(section.words), section.align)
+            first += len(section.words)
+        for symbol, name_offset in zip(self.symbols, name_offsets):
+            section = -1 if symbol.section is None else symbol.section
+            output += SYMBOL.pack(name_offset, section, symbol.offset)
+        for reloc in self.relocations:
+            output += RELOCATION.pack(reloc.section, RELOCATION_KINDS.index(reloc.kind),
+                                      reloc.offset, reloc.symbol)
+        output += strings
+        for section in self.sections:
+            words = array("H", section.words)
+            if sys.byteorder != "little":
+                words.byteswap()
+            output += words.tobytes()
+        with open(path, "wb") as f:
+            f.write(output)
+
+# Read an object file. The words of the sections are views of the mapped file.
+def read_object(path: str) -> ObjectFile:
+    try:
+        with open(path, "rb") as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError) as e:
+        error(f"cannot read object file '{path}': {e}")
+    if len(data) < HEADER.size or data[:4] != OBJECT_MAGIC:
+        error(f"'{path}' is not an object file")
+    _, num_sections, num_symbols, num_relocations, strings_size = HEADER.unpack_from(data)
+    position = HEADER.size
+    def table(record: struct.Struct, count: int) -> List[tuple]:
+        nonlocal position
+        end = position + record.size * count
+        if end > len(data):
+            error(f"object file '{path}' is truncated")
+        rows = list(record.iter_unpack(data[position:end]))
+        position = end
+        return rows
+
+    sections = table(SECTION, num_sections)
+    symbols = table(SYMBOL, num_symbols)
+    relocations = table(RELOCATION, num_relocations)
+    strings = bytes(data[position:position + strings_size])
+    words = data[position + strings_size:]
+    if len(words) % 2 != 0:
+        error(f"object file '{path}' is truncated")
+    words = words.cast("H")
+    if sys.byteorder != "little":
+        words = array("H", words)
+        words.byteswap()
+
+    obj = ObjectFile()
+    for origin, first, count, align in sections:
+        if first + count > len(words):
+            error(f"object file '{path}' is truncated")
+        obj.sections.append(Section(None if origin < 0 else origin, words[first:first + count],
+                                    align))
+    for name_offset, section, offset in symbols:
+        name = strings[name_offset:strings.index(b"\0", name_offset)].decode()
+        obj.symbols.append(Symbol(name, None if section < 0 else section, offset))
+    for section, kind, offset, symbol in relocations:
+        obj.relocations.append(Relocation(section, offset, RELOCATION_KINDS[kind], symbol))
+    return obj
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# A test runner for ROM programs. A test is an assembly source whose leading
+# comment block states the expected state of the CPU after the program
+# halted:
+#
+#   # expect: r0=5 r1=0x09 pc=0x12
+#   # max-steps: 1000
+#
+# Tests are assembled in-process and run in the emulator by a pool of worker
+# processes. Assembled images are cached by the hash of their sources, so
+# only changed tests are assembled again.
+#
+# With `--coverage`, the code coverage of every test is recorded and the
+# coverage of all tests is merged into one file, for `codecoverage.py report`.
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from contextlib import redirect_stderr
+from dataclasses import dataclass, field
+from typing import *
+
+from assembler import AssemblyParser, Instruction, Opcode, build_binary, error
+from codecoverage import Coverage, SourceCoverage, file_hash
+from emulator import NUM_REGISTERS, Emulator
+
+
+# The expectations of a test, read from its header.
+@dataclass
+class TestCase:
+    path: str
+    # Expected values by name: `r0` to `r6` and `pc`
+    expected: Dict[str, int] = field(default_factory=dict)
+    max_steps: Optional[int] = None
+
+@dataclass
+class TestResult:
+    path: str
+    passed: bool
+    message: str = ""
+    steps: int = 0
+    cycles: int = 0
+    seconds: float = 0
+    cached: bool = False
+    coverage: Optional[SourceCoverage] = None
+
+
+STATE_NAMES = [f"r{i}" for i in range(NUM_REGISTERS)] + ["pc"]
+
+# Read the header of a source file. Returns None if the file is not a test.
+def parse_test(path: str) -> Optional[TestCase]:
+    test = TestCase(path)
+    is_test = False
+    with open(path, "r") as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            def fail(message, *hints):
+                error(message, f"{path}:{line_num}", "", f"  {line}", *hints)
+            def parse_number(text: str) -> int:
+                try:
+                    return int(text, 0)
+                except ValueError:
+                    fail(f"invalid number '{text}'")
+            if not line:
+                continue
+            m = re.match(r'(#|//)\s*(expect|max-steps):(.*)', line)
+            if not m:
+                if line.startswith("#") or line.startswith("//"):
+                    continue
+                break
+            is_test = True
+            if m[2] == "max-steps":
+                test.max_steps = parse_number(m[3].strip())
+                continue
+            for item in m[3].split():
+                name, _, value = item.partition("=")
+                if name not in STATE_NAMES or not value:
+                    fail(f"invalid expectation '{item}'",
+                         f"expected NAME=VALUE with NAME one of {', '.join(STATE_NAMES)}")
+                test.expected[name] = parse_number(value)
+    return test if is_test else None
+
+# Find the tests in a list of files and directories.
+def discover_tests(paths: List[str]) -> List[TestCase]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+                files += [os.path.join(root, n) for n in sorted(names) if n.endswith(".s")]
+        else:
+            files.append(path)
+    return [test for test in map(parse_test, files) if test is not None]
+
+
+# Assemble a source file. Returns the binary, its instructions and the files
+# it depends on, or the error message of the assembler.
+def assemble(path: str) -> Union[Tuple[bytes, List[Instruction], List[str]], str]:
+    stderr = io.StringIO()
+    try:
+        with redirect_stderr(stderr):
+            parser = AssemblyParser()
+            parser.parse_file(path)
+            binary = build_binary(parser.program, path)
+    except SystemExit:
+        return stderr.getvalue().strip() or "error"
+    depends = set(parser.included)
+    depends.update(inst.operands[0].value for inst in parser.program
+                   if inst.opcode == Opcode.D_INCBIN)
+    depends.discard(os.path.realpath(path))
+    return binary, parser.program, sorted(depends)
+
+# Assemble a source file, or load its image from the cache. The cache holds
+# the image of each source file by the hash of its contents, next to the
+# hashes of the files it includes. Returns the binary or the error message
+# and whether the cache was used.
+def cached_assemble(path: str, cache_dir: Optional[str]) -> Tuple[Union[bytes, str], bool]:
+    if cache_dir is None:
+        result = assemble(path)
+        return (result if isinstance(result, str) else result[0]), False
+    key = file_hash(path)
+    image_path = os.path.join(cache_dir, f"{key}.bin")
+    depends_path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(depends_path, "r") as f:
+            depends = json.load(f)
+        if all(os.path.exists(p) and file_hash(p) == h for p, h in depends.items()):
+            with open(image_path, "rb") as f:
+                return f.read(), True
+    except (OSError, ValueError):
+        pass
+
+    result = assemble(path)
+    if isinstance(result, str):
+        return result, False
+    binary, _, depends = result
+    os.makedirs(cache_dir, exist_ok=True)
+    # Several workers may write the same entry, so every file is written to
+    # a temporary name and then renamed
+    suffix = f".{os.getpid()}.tmp"
+    with open(image_path + suffix, "wb") as f:
+        f.write(binary)
+    with open(depends_path + suffix, "w") as f:
+        json.dump({p: file_hash(p) for p in depends}, f)
+    os.replace(image_path + suffix, image_path)
+    os.replace(depends_path + suffix, depends_path)
+    return binary, False
+
+
+# Run a single test. Runs in a worker process.
+def run_test(task: Tuple[TestCase, Optional[str], int, bool]) -> TestResult:
+    test, cache_dir, default_max_steps, coverage = task
+    start = time.perf_counter()
+    if coverage:
+        # Coverage needs the instructions of the test, which are not cached
+        assembled = assemble(test.path)
+        if isinstance(assembled, str):
+            return TestResult(test.path, False, f"assembly failed: {assembled}")
+        binary, program, _ = assembled
+        cached = False
+    else:
+        binary, cached = cached_assemble(test.path, cache_dir)
+    if isinstance(binary, str):
+        return TestResult(test.path, False, f"assembly failed: {binary}")
+
+    emulator = Emulator()
+    emulator.load_binary(binary)
+    if coverage:
+        emulator.coverage = Coverage()
+    max_steps = test.max_steps if test.max_steps is not None else default_max_steps
+    emulator.run(max_steps)
+    result = TestResult(test.path, True, "", emulator.steps, emulator.cycles, 0, cached)
+    if coverage:
+        result.coverage = SourceCoverage()
+        result.coverage.add_run(program, emulator.coverage)
+    state = dict(zip(STATE_NAMES, emulator.registers + [emulator.pc]))
+    mismatches = [
+        f"{name} = 0x{state[name]:02X}, expected 0x{value:02X}"
+        for name, value in test.expected.items() if state[name] != value
+    ]
+    if not emulator.halted:
+        result.passed = False
+        result.message = f"did not halt within {max_steps} steps"
+    elif mismatches:
+        result.passed = False
+        result.message = "; ".join(mismatches)
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", metavar="PATH", nargs="*", default=["."],
+        help="test files, or directories to search for tests (default: .)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+        help="number of worker processes")
+    parser.add_argument("--max-steps", type=int, default=10**6,
+        help="step limit of tests that do not set their own")
+    parser.add_argument("--cache-dir", type=str, default=".romtest_cache",
+        help="directory to cache assembled images in")
+    parser.add_argument("--no-cache", action="store_true",
+        help="always assemble the tests")
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="also list the tests that passed")
+    parser.add_argument("--coverage", type=str, metavar="FILE",
+        help="record the code coverage of all tests into FILE")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    tests = discover_tests(args.paths)
+    if not tests:
+        error("no tests found")
+    cache_dir = None if args.no_cache else args.cache_dir
+    tasks = [(test, cache_dir, args.max_steps, args.coverage is not None) for test in tests]
+    failed = 0
+    coverage = SourceCoverage()
+    with multiprocessing.Pool(min(args.jobs, len(tests))) as pool:
+        for result in pool.imap(run_test, tasks):
+            if result.coverage is not None:
+                coverage.merge(result.coverage)
+            if not result.passed:
+                failed += 1
+            if result.passed and not args.verbose:
+                continue
+            status = "PASS" if result.passed else "FAIL"
+            cached = " (cached)" if result.cached else ""
+            print(f"{status} {result.path}: {result.steps} steps, {result.cycles} cycles, "
+                  f"{result.seconds*1000:.1f}ms{cached}")
+            for line in result.message.split("\n") if result.message else []:
+                print(f"    {line}")
+    if args.coverage is not None:
+        coverage.write(args.coverage)
+    elapsed = time.perf_counter() - start
+    print(f"{len(tests) - failed} passed, {failed} failed in {elapsed:.2f}s")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
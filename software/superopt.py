@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# A superoptimizer for straight-line `ldi` and `mv` code. Given a sequence of
+# instructions, it finds the shortest sequence that leaves the same values in
+# the live registers, by trying all shorter sequences. Every instruction
+# takes the same number of cycles, so shorter is faster.
+#
+# Candidates are built from `ldi` of the immediates of the target and `mv`
+# between its registers, plus dead registers as scratch space. Scratch
+# registers are interchangeable, so only candidates that use them in order of
+# their number are tried. Batches of candidates are run at once on many
+# random register states with NumPy, and the few that match the target on
+# all of them are checked exactly: without arithmetic, every register ends
+# up holding either an immediate or the initial value of a register.
+#
+# Results are cached by the canonical form of the target (see
+# `canonical_sequence` in the assembler). `superopt.py table` searches all
+# sequences up to a length and writes the ones that can be shortened as a
+# rewrite table for `assembler.py --rewrite`.
+import argparse
+import itertools
+import json
+import os
+import sys
+from typing import *
+
+import numpy as np
+
+from assembler import (AssemblyParser, Opcode, canonical_sequence, error,
+                       parse_sequence_text)
+from emulator import NUM_REGISTERS, OP_LOAD, OP_MOVE
+
+
+# An instruction as (mnemonic, operand, operand), with register numbers and
+# the immediate of `ldi`
+Step = Tuple[str, int, int]
+
+# Number of random register states candidates are run on
+NUM_STATES = 64
+# Number of candidates run at once
+BATCH_SIZE = 4096
+
+ALL_REGISTERS = frozenset(range(NUM_REGISTERS))
+
+
+# Run batches of sequences on register states. `sequences` has the shape
+# (candidates, length, 3), with (kind, a, b) as in the emulator's decoded
+# instructions, and `states` the shape (states, registers). Returns the final
+# states of every candidate, with the shape (candidates, states, registers).
+def run_sequences(sequences: np.ndarray, states: np.ndarray) -> np.ndarray:
+    count = len(sequences)
+    result = np.repeat(states[np.newaxis], count, axis=0)
+    rows = np.arange(count)
+    for i in range(sequences.shape[1]):
+        kind, a, b = sequences[:, i, 0], sequences[:, i, 1], sequences[:, i, 2]
+        moved = result[rows, :, np.where(kind == OP_MOVE, b, 0)]
+        result[rows, :, a] = np.where((kind == OP_LOAD)[:, np.newaxis],
+                                      b[:, np.newaxis].astype(np.uint8), moved)
+    return result
+
+def encode_steps(sequence: Sequence[Step]) -> List[Tuple[int, int, int]]:
+    return [(OP_LOAD if mnemonic == "ldi" else OP_MOVE, a, b) for mnemonic, a, b in sequence]
+
+# The final contents of every register, as ("imm", value) or ("reg", the
+# register whose initial value it holds).
+def symbolic_effect(sequence: Sequence[Step]) -> List[Tuple[str, int]]:
+    registers = [("reg", r) for r in range(NUM_REGISTERS)]
+    for mnemonic, a, b in sequence:
+        registers[a] = ("imm", b) if mnemonic == "ldi" else registers[b]
+    return registers
+
+def equivalent(first: Sequence[Step], second: Sequence[Step], live: AbstractSet[int]) -> bool:
+    first_effect, second_effect = symbolic_effect(first), symbolic_effect(second)
+    return all(first_effect[r] == second_effect[r] for r in live)
+
+
+# The candidate sequences of a given length, which write only the `changed`
+# registers and scratch registers, and read the registers of the target.
+# Writing any other register would need a copy of its value to restore it
+# from, and so can never be shorter. Instructions that write a register the
+# next instruction writes again without reading it are never useful, and
+# neither are moves of a register to itself.
+def candidates(length: int, registers: List[int], changed: List[int], immediates: List[int],
+               scratch: List[int]) -> Iterator[List[Step]]:
+    written = changed + scratch[:length]
+    read = registers + scratch[:length]
+    alphabet = [("ldi", r, imm) for r in written for imm in immediates]
+    alphabet += [("mv", rd, rs) for rd in written for rs in read if rd != rs]
+    for sequence in itertools.product(alphabet, repeat=length):
+        if any(first[1] == second[1] and (second[0] == "ldi" or second[2] != first[1])
+               for first, second in zip(sequence, sequence[1:])):
+            continue
+        # Scratch registers are used in order of their number
+        used = [r for step in sequence for r in step[1:1 + (step[0] == "mv") + 1]
+                if r in scratch]
+        order = list(dict.fromkeys(used))
+        if order != scratch[:len(order)]:
+            continue
+        yield list(sequence)
+
+# Find the shortest sequence that leaves the same values in the `live`
+# registers as `target`. Registers that are neither live nor used by the
+# target serve as scratch registers.
+def search(target: Sequence[Step], live: AbstractSet[int], seed: int = 0) -> List[Step]:
+    registers = sorted({r for mnemonic, a, b in target
+                        for r in ((a,) if mnemonic == "ldi" else (a, b))})
+    scratch = sorted(ALL_REGISTERS - set(registers) - set(live))
+    # Every live register that ends up with another value needs at least one
+    # instruction, and only the immediates that end up in one are needed
+    effect = symbolic_effect(target)
+    changed = [r for r in sorted(live) if effect[r] != ("reg", r)]
+    immediates = sorted({effect[r][1] for r in changed if effect[r][0] == "imm"})
+    if len(changed) >= len(target):
+        return list(target)
+
+    rng = np.random.default_rng(seed)
+    states = rng.integers(0, 256, (NUM_STATES, NUM_REGISTERS), dtype=np.uint8)
+    expected = run_sequences(np.array([encode_steps(target)]).reshape(1, len(target), 3),
+                             states)[0]
+    live_columns = sorted(live)
+    for length in range(len(changed), len(target)):
+        if length == 0:
+            return []
+        batches = iter(candidates(length, registers, changed, immediates, scratch))
+        while batch := list(itertools.islice(batches, BATCH_SIZE)):
+            result = run_sequences(np.array([encode_steps(c) for c in batch]), states)
+            matches = (result[:, :, live_columns] == expected[:, live_columns]).all(axis=(1, 2))
+            for index in np.flatnonzero(matches):
+                if equivalent(target, batch[index], live):
+                    return batch[index]
+    return list(target)
+
+
+# Optimal sequences by the canonical form of the target and its live and
+# scratch registers, stored as JSON.
+class Cache:
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.entries: Dict[str, str] = {}
+        self.changed = False
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                error(f"cannot read cache '{path}': {e}")
+
+    # Find the shortest sequence for a target, from the cache if possible.
+    def optimize(self, target: Sequence[Step], live: AbstractSet[int]) -> List[Step]:
+        pattern, registers, immediates = canonical_sequence(target)
+        renamed = {r: i for i, r in enumerate(registers)}
+        canonical_live = sorted(renamed[r] for r in live if r in renamed)
+        num_scratch = len(ALL_REGISTERS - set(registers) - set(live))
+        key = f"{pattern} | live {canonical_live} | scratch {num_scratch}"
+        if (text := self.entries.get(key)) is None:
+            canonical = parse_sequence_text(pattern)
+            # Scratch registers are numbered after the registers of the
+            # target, and the other registers after them must stay the same
+            others = range(len(registers) + num_scratch, NUM_REGISTERS)
+            result = search(canonical, set(canonical_live) | set(others))
+            text = self.entries[key] = "; ".join(format_step(step) for step in result)
+            self.changed = True
+        scratch = sorted(ALL_REGISTERS - set(registers) - set(live))
+        registers = registers + scratch
+        return [(mnemonic, registers[a], immediates[b] if mnemonic == "ldi" else registers[b])
+                for mnemonic, a, b in parse_sequence_text(text)]
+
+    def save(self):
+        if self.path is not None and self.changed:
+            with open(self.path, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            self.changed = False
+
+
+def format_step(step: Step) -> str:
+    mnemonic, a, b = step
+    return f"ldi r{a}, {b}" if mnemonic == "ldi" else f"mv r{a}, r{b}"
+
+# Parse a target sequence of assembly instructions, separated by newlines or
+# semicolons.
+def parse_target(text: str) -> List[Step]:
+    parser = AssemblyParser()
+    parser.parse_source(text.replace(";", "\n"), "<target>")
+    sequence = []
+    for inst in parser.program:
+        if inst.opcode == Opcode.LDI and inst.symbol is None:
+            sequence.append(("ldi", inst.operands[0].value, inst.operands[1].value & 0xFF))
+        elif inst.opcode == Opcode.MV:
+            sequence.append(("mv", inst.operands[0].value, inst.operands[1].value))
+        else:
+            error("the target may only contain ldi and mv instructions", inst)
+    return sequence
+
+def parse_registers(text: str) -> Set[int]:
+    registers = set()
+    for name in filter(None, text.split(",")):
+        if len(name) != 2 or name[0] != "r" or not name[1].isdigit() or int(name[1]) >= NUM_REGISTERS:
+            error(f"invalid register '{name}'", f"expected r0 to r{NUM_REGISTERS - 1}")
+        registers.add(int(name[1]))
+    return registers
+
+# All canonical sequences of a given length: each instruction uses the
+# registers and immediates seen before, or the next new one.
+def canonical_sequences(length: int, num_registers: int = 0,
+                        num_immediates: int = 0) -> Iterator[List[Step]]:
+    if length == 0:
+        yield []
+        return
+    registers = range(min(num_registers + 1, NUM_REGISTERS))
+    steps = [("ldi", rd, imm) for rd in registers for imm in range(num_immediates + 1)]
+    steps += [("mv", rd, rs) for rd in registers
+              for rs in range(min(max(num_registers, rd + 1) + 1, NUM_REGISTERS)) if rd != rs]
+    for step in steps:
+        _, a, b = step
+        used_registers = max(num_registers, a + 1, b + 1 if step[0] == "mv" else 0)
+        used_immediates = max(num_immediates, b + 1) if step[0] == "ldi" else num_immediates
+        for rest in canonical_sequences(length - 1, used_registers, used_immediates):
+            yield [step] + rest
+
+# Search every sequence up to `max_length` instructions that leaves all
+# registers as they are, and return the ones that can be shortened.
+def build_table(max_length: int, cache: Cache, verbose: bool = False) -> Dict[str, str]:
+    rewrites = {}
+    for length in range(2, max_length + 1):
+        count = 0
+        for sequence in canonical_sequences(length):
+            count += 1
+            result = cache.optimize(sequence, ALL_REGISTERS)
+            if len(result) < len(sequence):
+                pattern = "; ".join(map(format_step, sequence))
+                rewrites[pattern] = "; ".join(map(format_step, result))
+        if verbose:
+            sys.stderr.write(f"length {length}: {count} sequences, "
+                             f"{len(rewrites)} rewrites so far\n")
+    return rewrites
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cache", type=str, default=".superopt_cache.json",
+        help="file to cache search results in")
+    parser.add_argument("--no-cache", action="store_true",
+        help="do not read or write the cache")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    search_parser = subparsers.add_parser("search",
+        help="find the shortest sequence equivalent to a target sequence")
+    search_parser.add_argument("target", metavar="TARGET",
+        help="instructions separated by semicolons, like 'ldi r0, 5; mv r1, r0'")
+    search_parser.add_argument("--live", type=str,
+        help="comma separated registers whose values are used afterwards "
+             "(default: all registers)")
+
+    table_parser = subparsers.add_parser("table",
+        help="write a rewrite table for assembler.py --rewrite")
+    table_parser.add_argument("-o", "--output", type=str, required=True,
+        help="rewrite table to write")
+    table_parser.add_argument("-n", "--length", type=int, default=3,
+        help="length of the longest sequence to search")
+    args = parser.parse_args()
+
+    cache = Cache(None if args.no_cache else args.cache)
+    if args.command == "search":
+        target = parse_target(args.target)
+        live = ALL_REGISTERS if args.live is None else parse_registers(args.live)
+        result = cache.optimize(target, live)
+        for step in result:
+            print(f"    {format_step(step)}")
+        print(f"# {len(target)} -> {len(result)} instructions, "
+              f"{2 * (len(target) - len(result))} cycles saved")
+    elif args.command == "table":
+        rewrites = build_table(args.length, cache, verbose=True)
+        with open(args.output, "w") as f:
+            json.dump({"rewrites": rewrites}, f, indent=1)
+        print(f"{len(rewrites)} rewrites written to {args.output}")
+    cache.save()
+
+if __name__ == "__main__":
+    main()
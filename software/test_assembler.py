@@ -0,0 +1,104 @@
+# Tests of the assembler. Run with `python -m pytest` in this directory.
+import re
+
+import pytest
+
+from assembler import AssemblyParser, CompactProgram, Instruction, Opcode, build_binary
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+
+# Assemble source text into a binary. Errors exit the assembler, which
+# raises SystemExit with the message on stderr.
+def assemble(source: str, file: str = "test.s") -> bytes:
+    parser = AssemblyParser()
+    parser.parse_source(source, file)
+    return build_binary(parser.program, file)
+
+def assemble_file(path) -> bytes:
+    parser = AssemblyParser()
+    parser.parse_file(str(path))
+    return build_binary(parser.program, str(path))
+
+# The first lines of the error reported by the assembler.
+def reported_error(capsys) -> str:
+    return ANSI_ESCAPE.sub("", capsys.readouterr().err)
+
+
+def test_include_inserts_file_at_directive(tmp_path):
+    (tmp_path / "lib.s").write_text("ldi r1, 2\n")
+    (tmp_path / "main.s").write_text('ldi r0, 1\n.include "lib.s"\nhalt\n')
+    assert assemble_file(tmp_path / "main.s") == assemble("ldi r0, 1\nldi r1, 2\nhalt\n")
+
+def test_include_twice_is_parsed_once(tmp_path):
+    (tmp_path / "lib.s").write_text("nop\n")
+    (tmp_path / "main.s").write_text('.include "lib.s"\n.include "lib.s"\nhalt\n')
+    assert assemble_file(tmp_path / "main.s") == assemble("nop\nhalt\n")
+
+def test_missing_include_is_reported_at_directive(tmp_path, capsys):
+    (tmp_path / "main.s").write_text('.include "nope.s"\nnop\n')
+    with pytest.raises(SystemExit):
+        assemble_file(tmp_path / "main.s")
+    output = reported_error(capsys)
+    assert "cannot find include file" in output
+    assert "main.s:1:1" in output
+
+def test_incbin_range(tmp_path):
+    (tmp_path / "data.bin").write_bytes(bytes(range(8)))
+    (tmp_path / "main.s").write_text('.incbin "data.bin", 2, 4\n')
+    assert assemble_file(tmp_path / "main.s") == bytes([2, 3, 4, 5])
+
+# Run the assembler as from the command line.
+def run_assembler(monkeypatch, *args):
+    import assembler
+    monkeypatch.setattr("sys.argv", ["assembler.py", *map(str, args)])
+    assembler.main()
+
+def test_stream_resolves_forward_references(tmp_path, monkeypatch):
+    source = tmp_path / "test.s"
+    source.write_text("""
+        ldi r0, lo(data)
+        ldi r1, hi(data)
+        jreli body
+    skipped:
+        halt
+    body:
+        jreli skipped
+    data:
+        .fill 3, 7
+    """)
+    run_assembler(monkeypatch, source, "-o", tmp_path / "test.bin")
+    run_assembler(monkeypatch, "--stream", source, "-o", tmp_path / "stream.bin")
+    assert (tmp_path / "stream.bin").read_bytes() == (tmp_path / "test.bin").read_bytes()
+
+def test_stream_reports_undefined_label(tmp_path, monkeypatch, capsys):
+    (tmp_path / "test.s").write_text("nop\njreli nowhere\nnop\n")
+    with pytest.raises(SystemExit):
+        run_assembler(monkeypatch, "--stream", tmp_path / "test.s", "-o", tmp_path / "test.bin")
+    output = reported_error(capsys)
+    assert "undefined label 'nowhere'" in output
+    assert "test.s:2:1" in output
+
+def test_integer_lists():
+    assert assemble(".byte 1, 2, /* three */ 3\n.word 0x1234, -1\n") == \
+           bytes([1, 2, 3, 0, 0x34, 0x12, 0xFF, 0xFF])
+
+def test_integer_list_ends_at_line_end(capsys):
+    with pytest.raises(SystemExit):
+        assemble(".byte 1, 2,\n3\n")
+    output = reported_error(capsys)
+    assert "a list must end on the line it starts" in output
+    assert "test.s:1:" in output
+
+def test_compact_program_keeps_instructions_without_file():
+    parser = AssemblyParser()
+    parser.parse_source("nop\nhalt\n", "test.s")
+    generated = Instruction(Opcode.NOP, [])
+    program = CompactProgram()
+    program.extend([generated] + parser.program)
+    assert [inst.file for inst in program] == [None, "test.s", "test.s"]
+    # Copying the columns of another compact program keeps them apart too
+    copy = CompactProgram().extend([Instruction(Opcode.HALT, [], file="other.s")])
+    copy.extend(program)
+    assert [inst.file for inst in copy] == ["other.s", None, "test.s", "test.s"]
+    assert [inst.file for inst in copy[1:3]] == [None, "test.s"]
@@ -0,0 +1,121 @@
+# Tests of the language server. Run with `python -m pytest` in this
+# directory.
+import io
+
+import pytest
+
+import assembler_server
+from assembler_server import Document, Server, read_message
+
+URI = "file:///tmp/test.s"
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # Small chunks, such that the documents below have several
+    monkeypatch.setattr(assembler_server, "CHUNK_LINES", 4)
+
+class Client:
+    def __init__(self):
+        self.output = io.BytesIO()
+        self.server = Server(self.output)
+        self.version = 0
+        self.text = ""
+
+    # Send a message, and return the messages the server sent back.
+    def send(self, method: str, params: dict, id=None) -> list:
+        message = {"jsonrpc": "2.0", "method": method, "params": params}
+        if id is not None:
+            message["id"] = id
+        start = self.output.tell()
+        self.server.handle(message)
+        self.output.seek(start)
+        replies = []
+        while (reply := read_message(self.output)) is not None:
+            replies.append(reply)
+        return replies
+
+    def open(self, text: str) -> list:
+        self.text = text
+        replies = self.send("textDocument/didOpen", {"textDocument": {
+            "uri": URI, "languageId": "asm", "version": self.version, "text": text}})
+        return diagnostics(replies)
+
+    # Replace the text from one (line, character) to another.
+    def change(self, start, end, text: str) -> list:
+        self.version += 1
+        lines = self.text.split("\n")
+        first = sum(len(line) + 1 for line in lines[:start[0]]) + start[1]
+        last = sum(len(line) + 1 for line in lines[:end[0]]) + end[1]
+        self.text = self.text[:first] + text + self.text[last:]
+        change = {"range": {"start": {"line": start[0], "character": start[1]},
+                            "end": {"line": end[0], "character": end[1]}},
+                  "text": text}
+        replies = self.send("textDocument/didChange", {
+            "textDocument": {"uri": URI, "version": self.version}, "contentChanges": [change]})
+        result = diagnostics(replies)
+        # An edit gives the same diagnostics as opening the edited text
+        assert result == diagnostics_of(self.text)
+        return result
+
+    def hover(self, line: int, character: int):
+        replies = self.send("textDocument/hover", {"textDocument": {"uri": URI},
+                            "position": {"line": line, "character": character}}, id=1)
+        return replies[0]["result"] and replies[0]["result"]["contents"]["value"]
+
+# The (line, message) of the published diagnostics.
+def diagnostics(replies: list) -> list:
+    params, = [reply["params"] for reply in replies
+               if reply.get("method") == "textDocument/publishDiagnostics"]
+    return [(d["range"]["start"]["line"], d["message"]) for d in params["diagnostics"]]
+
+def diagnostics_of(text: str) -> list:
+    return [(d["range"]["start"]["line"], d["message"]) for d in Document(URI, text).diagnostics]
+
+
+def test_undefined_label():
+    client = Client()
+    assert client.open("start:\n    ldi r0, lo(nowhere)\n    halt\n") == \
+        [(1, "undefined label 'nowhere'")]
+    assert client.change((2, 4), (2, 8), "nowhere:\n    halt") == []
+    assert client.change((2, 0), (3, 0), "") == [(1, "undefined label 'nowhere'")]
+
+def test_edit_across_chunks():
+    lines = ["start:"] + ["    nop"] * 12 + ["    jreli start", "    jreli end"]
+    client = Client()
+    assert client.open("\n".join(lines) + "\n") == [(14, "undefined label 'end'")]
+    # Replace lines 2 to 10, which span three chunks
+    assert client.change((2, 0), (10, 7), "end:\n" + "    nop\n" * 150 + "    nop") == \
+        [(156, "label 'start' is out of range of a relative jump, -154 words away"),
+         (157, "label 'end' is out of range of a relative jump, -154 words away")]
+    assert client.change((3, 0), (100, 0), "") == []
+
+def test_block_comment_opened_and_closed():
+    lines = ["start:", "    nop", "    nop", "target:", "    nop", "    nop", "    nop",
+             "    jreli target", "    halt"]
+    client = Client()
+    assert client.open("\n".join(lines)) == []
+    # An open comment hides the rest of the document
+    assert client.change((3, 0), (3, 0), "/* ") == []
+    assert client.change((3, 10), (3, 10), " */") == [(7, "undefined label 'target'")]
+    assert client.change((3, 0), (3, 3), "") == [(3, "unknown instruction")]
+    assert client.change((3, 0), (3, 10), "target:") == []
+
+def test_duplicate_labels_and_org():
+    client = Client()
+    result = client.open("a:\n    nop\n.org 0x10\n    nop\n    nop\n    nop\na:\n.org 2\n")
+    assert sorted(line for line, _ in result) == [6, 7]
+
+def test_hover():
+    client = Client()
+    client.open("start:\n    ldi r0, lo(data)\n    jreli start\ndata:\n    .byte 1, 2\n")
+    assert "0001:   FF09      jreli  start" in client.hover(2, 6)
+    assert "`start` = 0x0000" in client.hover(2, 6)
+    assert "`data` = 0x0002" in client.hover(1, 4)
+    assert "2 bytes" in client.hover(4, 8)
+    assert "0000:         start:" in client.hover(0, 0)
+    assert client.hover(10, 0) is None
+
+def test_unknown_request():
+    replies = Client().send("textDocument/definition", {}, id=3)
+    assert replies[0]["error"]["code"] == assembler_server.METHOD_NOT_FOUND
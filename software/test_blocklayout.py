@@ -0,0 +1,73 @@
+# Tests of profile-guided code layout. Run with `python -m pytest` in this
+# directory.
+import re
+
+import pytest
+
+import blocklayout
+from emulator import Emulator, assemble_program
+from test_assembler import reported_error
+
+# The jump from `middle` back to `end` crosses the cold code. After layout,
+# `end` follows `middle`, and the jump and the loads of its registers, which
+# `end` overwrites, are left out.
+PROGRAM = """
+start:
+    ldi r0, 1
+    ldi r5, lo(middle)
+    ldi r6, hi(middle)
+    jabsr r5r6
+end:
+    ldi r5, 0
+    ldi r6, 0
+    mv r2, r0
+    halt
+cold:
+    ldi r3, 9
+    .fill 600, 0
+middle:
+    ldi r5, 2
+    ldi r6, 3
+    ldi r1, 4
+    ldi r5, lo(end)
+    ldi r6, hi(end)
+    jabsr r5r6
+"""
+
+
+def run_blocklayout(monkeypatch, capsys, *args) -> str:
+    monkeypatch.setattr("sys.argv", ["blocklayout.py", *map(str, args)])
+    blocklayout.main()
+    return capsys.readouterr().out
+
+def run(path) -> Emulator:
+    emulator = Emulator()
+    emulator.load_binary(assemble_program(str(path))[0])
+    emulator.run(1000)
+    return emulator
+
+
+def test_layout_saves_far_jump(tmp_path, monkeypatch, capsys):
+    source, profile, output = tmp_path / "test.s", tmp_path / "test.json", tmp_path / "fast.s"
+    source.write_text(PROGRAM)
+    run_blocklayout(monkeypatch, capsys, "profile", source, "-o", profile)
+    report = run_blocklayout(monkeypatch, capsys, "layout", source, "--profile", profile,
+                             "-o", output)
+
+    before, after = run(source), run(output)
+    assert before.halted and after.halted
+    assert after.registers == before.registers
+    estimated = int(re.search(r"estimated from the profile: (\d+) cycles saved", report)[1])
+    measured = re.search(r"measured: (\d+) -> (\d+) cycles, (\d+) cycles", report)
+    assert [int(n) for n in measured.groups()] == \
+        [before.cycles, after.cycles, before.cycles - after.cycles]
+    assert estimated == before.cycles - after.cycles > 0
+
+def test_profile_of_changed_source_is_rejected(tmp_path, monkeypatch, capsys):
+    source, profile = tmp_path / "test.s", tmp_path / "test.json"
+    source.write_text(PROGRAM)
+    run_blocklayout(monkeypatch, capsys, "profile", source, "-o", profile)
+    source.write_text(PROGRAM + "    nop\n")
+    with pytest.raises(SystemExit):
+        blocklayout.SourceProfile.read(str(profile))
+    assert "was recorded from another version" in reported_error(capsys)
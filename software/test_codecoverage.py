@@ -0,0 +1,70 @@
+# Tests of code coverage. Run with `python -m pytest` in this directory.
+import io
+
+import pytest
+
+from codecoverage import Coverage, SourceCoverage, load_program, print_report
+from emulator import Emulator
+from test_assembler import assemble
+from tracing import TraceBuffer
+
+# A loop with a register jump, and code that never runs
+PROGRAM = """
+    ldi r0, 3
+loop:
+    mv r1, r0
+    jrelr r0
+cold:
+    ldi r2, 9
+    halt
+    ldi r3, 1
+    jreli loop
+"""
+
+
+# Run a binary with coverage, and optionally a trace or a breakpoint that
+# is never hit, which use the checked step loop.
+def run_coverage(binary: bytes, steps: int, trace: bool = False,
+                 breakpoint: bool = False) -> Coverage:
+    emulator = Emulator()
+    emulator.load_binary(binary)
+    emulator.coverage = Coverage()
+    if trace:
+        emulator.trace = TraceBuffer(4)
+    if breakpoint:
+        emulator.add_breakpoint(0xFFFF)
+    emulator.run(steps)
+    return emulator.coverage
+
+
+def test_hits_only_executed_instructions():
+    hits = run_coverage(assemble(PROGRAM), 101).hits()
+    assert list(hits[:7]) == [1, 1, 1, 0, 0, 1, 1]
+    assert not any(hits[7:])
+
+@pytest.mark.parametrize("steps", [1, 2, 3, 10, 101])
+@pytest.mark.parametrize("trace, breakpoint", [(True, False), (False, True), (True, True)])
+def test_checked_loop_records_same_blocks(steps, trace, breakpoint):
+    binary = assemble(PROGRAM)
+    expected = run_coverage(binary, steps).blocks
+    assert run_coverage(binary, steps, trace, breakpoint).blocks == expected
+
+def test_register_jump_targets():
+    coverage = run_coverage(assemble(PROGRAM), 101)
+    assert coverage.targets()[2] == {5}
+    assert coverage.targets()[6] == {1}
+
+def test_source_coverage(tmp_path):
+    path = tmp_path / "program.s"
+    path.write_text(PROGRAM)
+    binary, program = load_program(str(path))
+    coverage = SourceCoverage()
+    coverage.add_run(program, run_coverage(binary, 101))
+    # Coverage survives writing and reading it back
+    coverage.write(str(tmp_path / "coverage.json"))
+    coverage = SourceCoverage.read(str(tmp_path / "coverage.json"))
+    report = io.StringIO()
+    print_report(coverage, file=report)
+    lines = report.getvalue().splitlines()
+    assert [line[:5] for line in lines if "ldi" in line] == ["    +", "#####", "    +"]
+    assert "instructions      5/7" in lines[-1]
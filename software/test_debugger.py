@@ -0,0 +1,35 @@
+# Tests of the debugger. Run with `python -m pytest` in this directory.
+import io
+
+from debugger import Debugger
+from test_emulator import LOOP, load
+
+
+# Run debugger commands and return their output.
+def run_commands(debugger: Debugger, *lines: str) -> str:
+    debugger.stdout = io.StringIO()
+    for line in lines:
+        assert not debugger.onecmd(line)
+    return debugger.stdout.getvalue()
+
+def test_goto_before_reset_is_reported():
+    debugger = Debugger(load(LOOP))
+    output = run_commands(debugger, "step 5", "goto -1")
+    assert "error: cannot go back past reset" in output
+    assert debugger.emulator.steps == 5
+
+def test_unclosed_quotation_is_reported():
+    debugger = Debugger(load(LOOP))
+    assert "error: no closing quotation" in run_commands(debugger, 'break "abc')
+    assert debugger.emulator.breakpoint_addresses() == []
+
+def test_goto_and_breakpoints():
+    debugger = Debugger(load(LOOP))
+    output = run_commands(debugger, "break 6", "continue", "goto 2", "regs")
+    assert "stopped at" in output
+    assert debugger.emulator.steps == 2
+    assert "error" not in output
+
+def test_unknown_command():
+    assert "error: unknown command 'frobnicate'" in \
+        run_commands(Debugger(load(LOOP)), "frobnicate 1")
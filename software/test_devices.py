@@ -0,0 +1,92 @@
+# Tests of the devices of the emulator. Run with `python -m pytest` in this
+# directory.
+import pytest
+
+from devices import InputPort, InputQueue, OutputPort, Timer
+from emulator import Emulator
+from test_assembler import assemble, reported_error
+
+# A loop that calls the input at `read` and writes the value to r4. An
+# iteration takes 9 instructions, or 18 cycles.
+PROGRAM = """
+loop:
+    ldi r5, lo(back)
+    ldi r6, hi(back)
+    ldi r2, lo(read)
+    ldi r3, hi(read)
+    jabsr r2r3
+back:
+    mv r4, r0
+    jreli loop
+read:
+    ldi r0, 0
+    jabsr r5r6
+"""
+READ = 7
+ITERATION_CYCLES = 18
+# Cycle at which the first `mv r4, r0` has written r4, and at which the
+# first `ldi r0` in `read` starts
+FIRST_WRITE = 16
+FIRST_READ = 10
+
+
+# An emulator running PROGRAM with an output port on r4 and another device.
+def attach(device) -> (Emulator, OutputPort):
+    emulator = Emulator()
+    emulator.load_binary(assemble(PROGRAM))
+    output = OutputPort(4)
+    emulator.attach(output)
+    emulator.attach(device)
+    return emulator, output
+
+def write_cycles(count: int):
+    return [FIRST_WRITE + i * ITERATION_CYCLES for i in range(count)]
+
+
+def test_output_port_records_writes():
+    emulator, output = attach(InputPort(READ, 0x42))
+    emulator.run(9 * 5)
+    assert output.writes == [(cycle, 0x42) for cycle in write_cycles(5)]
+    assert output.value == 0x42
+
+def test_input_port_changes():
+    emulator, output = attach(InputPort(READ, 1, [(30, 2), (60, 3)]))
+    emulator.run(9 * 5)
+    # The reads start at cycles 10, 28, 46, 64 and 82
+    assert [value for _, value in output.writes] == [1, 1, 2, 3, 3]
+
+def test_timer_ticks_across_runs():
+    period = 10
+    emulator, output = attach(Timer(READ, period))
+    for steps in (3, 10, 1, 31):
+        emulator.run(steps)
+    reads = [FIRST_READ + i * ITERATION_CYCLES for i in range(5)]
+    # Ticks due at the cycle an instruction starts happen before it
+    assert output.writes == list(zip(write_cycles(5), (cycle // period for cycle in reads)))
+
+def test_input_queue_pops_on_fetch():
+    emulator, output = attach(InputQueue(READ, [(0, 5), (0, 6), (50, 7)]))
+    emulator.run(9 * 6)
+    assert [value for _, value in output.writes] == [5, 6, 0, 7, 0, 0]
+
+@pytest.mark.parametrize("device", [
+    lambda: Timer(READ, 10),
+    lambda: InputQueue(READ, [(0, 5), (0, 6), (50, 7)]),
+    lambda: InputPort(READ, 1, [(30, 2), (60, 3)]),
+])
+def test_events_after_reset(device):
+    emulator, output = attach(device())
+    emulator.run(9 * 6)
+    expected = list(output.writes)
+    emulator.run(17)
+    emulator.reset()
+    assert output.writes == []
+    emulator.run(9 * 6)
+    assert output.writes == expected
+
+def test_input_needs_ldi(capsys):
+    emulator = Emulator()
+    emulator.load_binary(assemble(PROGRAM))
+    with pytest.raises(SystemExit):
+        emulator.attach(InputPort(READ - 2))
+    assert "device at 0005 needs an ldi instruction there" in reported_error(capsys)
@@ -0,0 +1,56 @@
+# Tests of the disassembler. Run with `python -m pytest` in this directory.
+from array import array
+
+import pytest
+
+import disassembler
+from assembler import AssemblyPrinter, Opcode
+from disassembler import decode_instruction, disassemble_binary
+from test_assembler import assemble, reported_error
+
+SOURCE = """
+    ldi r0, 0x12
+    ldi r6, 255
+    mv r1, r2
+    mv r6, r0
+    jabsr r0r1
+    jabsr r5r6
+    jreli -128
+    jreli 127
+    jrelr r3
+    nop
+    halt
+"""
+
+
+# Disassemble a binary and assemble the printed result again.
+def round_trip(binary: bytes, data=()) -> bytes:
+    program = disassemble_binary(binary, data=data)
+    return assemble(AssemblyPrinter(program, False, False).print())
+
+def test_instructions_round_trip():
+    binary = assemble(SOURCE)
+    assert round_trip(binary) == binary
+
+def test_every_word_round_trips():
+    binary = array("H", range(1 << 16)).tobytes()
+    assert round_trip(binary) == binary
+
+def test_unknown_words_become_data():
+    inst = decode_instruction(0xFFFF, 4)
+    assert inst.opcode == Opcode.D_WORD
+    assert inst.operands[0].value == 0xFFFF
+    assert inst.address == 4
+
+def test_data_ranges():
+    binary = assemble(SOURCE + '.ascii "hello!"\nhalt\n')
+    program = disassemble_binary(binary, data=[(11, 14)])
+    assert [inst.opcode for inst in program[-2:]] == [Opcode.D_BYTE, Opcode.HALT]
+    assert bytes(program[-2].data) == b"hello!"
+    assert round_trip(binary, [(11, 14)]) == binary
+
+def test_missing_input_is_reported(monkeypatch, capsys, tmp_path):
+    monkeypatch.setattr("sys.argv", ["disassembler.py", str(tmp_path / "missing.bin")])
+    with pytest.raises(SystemExit):
+        disassembler.main()
+    assert "cannot read" in reported_error(capsys)
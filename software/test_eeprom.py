@@ -0,0 +1,69 @@
+# Tests of the EEPROM upload protocol. Run with `python -m pytest` in this
+# directory.
+import argparse
+import asyncio
+import random
+
+import pytest
+
+import eeprom
+from eeprom import FRAME_END, FRAME_ESCAPE, WRITE, FrameDecoder, UploadError, encode_frame
+
+
+# Arguments of an upload to a small simulated programmer.
+def upload_arguments(**options) -> argparse.Namespace:
+    args = argparse.Namespace(simulate=True, port=None, baud=115200, address=0, full=False,
+                              window=8, timeout=0.2, retries=5, size=1024, page_size=64,
+                              buffer=4, write_time=1, error_rate=0, write_error_rate=0,
+                              seed=1, contents=None)
+    vars(args).update(options)
+    return args
+
+def image(size: int, seed: int = 0) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+
+def test_frame_round_trip():
+    payload = bytes([FRAME_END, FRAME_ESCAPE, 0, FRAME_END ^ 0x20, FRAME_ESCAPE ^ 0x20])
+    frame = encode_frame(WRITE, payload)
+    # Only the delimiters are frame end bytes
+    assert frame.count(FRAME_END) == 2
+    assert FrameDecoder().feed(frame) == [(WRITE, payload)]
+
+def test_frames_split_across_reads():
+    data = encode_frame(WRITE, b"abc") + encode_frame(WRITE, bytes([FRAME_END] * 3))
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(len(data)):
+        frames += decoder.feed(data[i:i + 1])
+    assert frames == [(WRITE, b"abc"), (WRITE, bytes([FRAME_END] * 3))]
+
+def test_corrupted_frame_is_dropped():
+    frame = bytearray(encode_frame(WRITE, b"page data"))
+    frame[4] ^= 0x01
+    decoder = FrameDecoder()
+    assert decoder.feed(bytes(frame) + encode_frame(WRITE, b"next")) == [(WRITE, b"next")]
+    assert decoder.dropped == 1
+
+def test_upload_writes_only_changed_pages():
+    data = image(256)
+    statistics = asyncio.run(eeprom.upload(upload_arguments(), data))
+    assert statistics.pages == 4
+    # The simulated programmer starts erased, so pages of 0xFF are unchanged
+    data = data[:128] + b"\xFF" * 64 + data[192:]
+    statistics = asyncio.run(eeprom.upload(upload_arguments(), data))
+    assert (statistics.pages, statistics.unchanged) == (3, 1)
+
+def test_upload_retries_after_errors():
+    args = upload_arguments(address=10, error_rate=0.001, write_error_rate=0.2, seed=3)
+    statistics = asyncio.run(eeprom.upload(args, image(600)))
+    assert statistics.retries > 0
+
+def test_upload_gives_up():
+    args = upload_arguments(write_error_rate=1, retries=1, timeout=0.05)
+    with pytest.raises(UploadError):
+        asyncio.run(eeprom.upload(args, image(64)))
+
+def test_upload_too_large():
+    with pytest.raises(UploadError):
+        asyncio.run(eeprom.upload(upload_arguments(), image(2048)))
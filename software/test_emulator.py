@@ -0,0 +1,94 @@
+# Tests of the emulator. Run with `python -m pytest` in this directory.
+import pytest
+
+from emulator import Emulator
+from test_assembler import assemble
+
+# A loop that moves values through the registers, so every step leaves a
+# different state than the one before
+LOOP = """
+start:
+    ldi r0, 1
+    mv r1, r0
+    ldi r0, 2
+    mv r2, r1
+    mv r1, r0
+    ldi r0, 3
+    mv r3, r2
+    jreli start
+"""
+
+
+def load(source: str, **options) -> Emulator:
+    emulator = Emulator(**options)
+    emulator.load_binary(assemble(source))
+    return emulator
+
+def state(emulator: Emulator):
+    return emulator.pc, emulator.registers, emulator.steps, emulator.halted
+
+# The state after every step of a run, from reset.
+def states(source: str, steps: int):
+    emulator = load(source)
+    result = [state(emulator)]
+    for _ in range(steps):
+        emulator.step()
+        result.append(state(emulator))
+    return result
+
+
+def test_halt():
+    emulator = load("ldi r0, 5\nhalt\n")
+    emulator.run(100)
+    assert emulator.halted
+    assert state(emulator) == (1, [5, 0, 0, 0, 0, 0, 0], 2, True)
+
+def test_reverse_step_restores_every_state():
+    expected = states(LOOP, 60)
+    emulator = load(LOOP, checkpoint_interval=7)
+    emulator.run(60)
+    for steps in reversed(range(60)):
+        emulator.reverse_step()
+        assert state(emulator) == expected[steps]
+
+def test_run_to_after_checkpoints_are_thinned():
+    expected = states(LOOP, 500)
+    emulator = load(LOOP, checkpoint_interval=3, max_checkpoints=4)
+    emulator.run(500)
+    assert emulator.checkpoint_interval > 3
+    assert sum(not c.edited for c in emulator.checkpoints) <= 4
+    for steps in (0, 1, 17, 250, 499, 123):
+        emulator.run_to(steps)
+        assert state(emulator) == expected[steps]
+
+def test_snapshot_keeps_memory_written_later():
+    emulator = load(LOOP)
+    before = emulator.memory.read(1)
+    snapshot = emulator.snapshot()
+    emulator.write_memory(1, 0x1234)
+    assert emulator.memory.read(1) == 0x1234
+    emulator.restore(snapshot)
+    assert emulator.memory.read(1) == before
+    assert snapshot.pages[0][1] == before
+
+def test_edited_state_is_not_replayed_away():
+    emulator = load(LOOP, checkpoint_interval=4)
+    emulator.run(10)
+    emulator.set_register(5, 0x42)
+    emulator.run(10)
+    emulator.reverse_step(5)
+    assert emulator.registers[5] == 0x42
+
+def test_run_back_to_write():
+    emulator = load(LOOP, checkpoint_interval=5)
+    emulator.run(30)
+    assert emulator.run_back_to_write(3)
+    # The pc is at the `mv r3, r2` that wrote r3 last
+    assert emulator.pc == 6
+    assert emulator.steps == 22
+    assert not emulator.run_back_to_write(4)
+    assert emulator.steps == 22
+
+def test_run_to_before_reset_fails():
+    with pytest.raises(ValueError):
+        load(LOOP).run_to(-1)
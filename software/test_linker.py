@@ -0,0 +1,163 @@
+# Tests of object files and the linker. Run with `python -m pytest` in this
+# directory.
+import pytest
+
+from assembler import AssemblyParser, InstructionEncoder, Layouter, build_object
+from emulator import Emulator, assemble_program, load_image
+from linker import link
+from objfile import ObjectFile, read_object
+from test_assembler import reported_error, run_assembler
+
+MAIN = """
+start:
+    ldi r0, lo(function)
+    ldi r1, hi(function)
+    jabsr r0r1
+back:
+    halt
+"""
+
+LIBRARY = """
+.section 4
+function:
+    ldi r5, 0x55
+    ldi r0, lo(back)
+    ldi r1, hi(back)
+    jabsr r0r1
+"""
+
+
+# Compile source text into an object file, like `assembler.py -c`.
+def compile_object(source: str, file: str = "test.s") -> ObjectFile:
+    parser = AssemblyParser()
+    parser.parse_source(source, file)
+    layouter = Layouter(relocatable=True)
+    layouter.layout_program(parser.program)
+    encoder = InstructionEncoder(layouter.symbols, layouter.symbol_sections, relocatable=True)
+    encoder.encode_program(parser.program)
+    return build_object(parser.program, encoder.relocations)
+
+def run(binary: bytes) -> Emulator:
+    emulator = Emulator()
+    emulator.load_binary(binary)
+    emulator.run(1000)
+    return emulator
+
+
+def test_object_file_round_trip(tmp_path):
+    obj = compile_object(MAIN + LIBRARY)
+    obj.write(str(tmp_path / "test.o"))
+    read = read_object(str(tmp_path / "test.o"))
+    assert [(s.origin, list(s.words), s.align) for s in read.sections] == \
+           [(s.origin, list(s.words), s.align) for s in obj.sections]
+    assert read.symbols == obj.symbols
+    assert read.relocations == obj.relocations
+
+def test_read_invalid_object_file(tmp_path, capsys):
+    (tmp_path / "test.o").write_bytes(b"TTO1" + bytes(20))
+    with pytest.raises(SystemExit):
+        read_object(str(tmp_path / "test.o"))
+    assert "is not an object file" in reported_error(capsys)
+
+def test_read_truncated_object_file(tmp_path, capsys):
+    compile_object(MAIN).write(str(tmp_path / "test.o"))
+    data = (tmp_path / "test.o").read_bytes()
+    (tmp_path / "test.o").write_bytes(data[:-2])
+    with pytest.raises(SystemExit):
+        read_object(str(tmp_path / "test.o"))
+    assert "is truncated" in reported_error(capsys)
+
+def test_link_resolves_labels_across_files():
+    binary, addresses, symbols = link([compile_object(MAIN, "main.s"),
+                                       compile_object(LIBRARY, "lib.s")], ["main.s", "lib.s"])
+    assert symbols["start"] == 0
+    assert symbols["function"] % 4 == 0
+    emulator = run(binary)
+    assert emulator.halted
+    assert emulator.pc == symbols["back"]
+    assert emulator.registers[5] == 0x55
+
+def test_link_undefined_label(capsys):
+    with pytest.raises(SystemExit):
+        link([compile_object(MAIN, "main.s")], ["main.s"])
+    assert "undefined label 'function'" in reported_error(capsys)
+
+def test_link_duplicate_label(capsys):
+    with pytest.raises(SystemExit):
+        link([compile_object(MAIN, "a.s"), compile_object(MAIN + LIBRARY, "b.s")],
+             ["a.s", "b.s"])
+    assert "is defined in both 'a.s' and 'b.s'" in reported_error(capsys)
+
+def test_link_output_size(capsys):
+    obj = compile_object(MAIN + LIBRARY)
+    binary, _, _ = link([obj], ["test.s"], 64)
+    assert len(binary) == 64
+    with pytest.raises(SystemExit):
+        link([obj], ["test.s"], 4)
+    assert "more than the output size" in reported_error(capsys)
+
+# The address of every label after linking a single source.
+def link_symbols(source: str):
+    return link([compile_object(source)], ["test.s"])[2]
+
+def test_entry_section_goes_to_address_zero():
+    symbols = link_symbols("start:\n    halt\n.section 1\nbig:\n" + "    nop\n" * 8)
+    assert symbols["start"] == 0
+    assert symbols["big"] == 1
+
+def test_section_alignment():
+    symbols = link_symbols("halt\n.section 16\naligned:\n    nop\n.section 1\nsingle:\n    nop\n")
+    assert symbols["aligned"] % 16 == 0
+    assert symbols["single"] == 1
+
+def test_section_fills_best_gap():
+    symbols = link_symbols("""
+    .org 0
+        halt
+    .org 3
+        nop
+    .org 100
+        nop
+    .section 1
+    pair:
+        nop
+        nop
+    """)
+    # The gap between 1 and 3 fits the section exactly
+    assert symbols["pair"] == 1
+
+def test_section_placed_within_reach():
+    symbols = link_symbols("""
+    .org 0
+        halt
+    .org 1000
+        jreli far
+    .org 1002
+        nop
+    .section 1
+    far:
+        nop
+        nop
+        nop
+        nop
+    """)
+    # The best fitting gap starts at 1, out of reach of the jump
+    assert -128 <= symbols["far"] - 1000 <= 127
+
+def test_section_out_of_reach(capsys):
+    with pytest.raises(SystemExit):
+        link_symbols(".org 0\njreli far\n.org 1\n.fill 400, 0\n.section 2\nfar:\n    halt\n")
+    assert "within reach of its relative jumps" in reported_error(capsys)
+
+def test_fixed_sections_overlap(capsys):
+    with pytest.raises(SystemExit):
+        link_symbols(".org 0\nnop\nnop\n.org 1\nnop\n")
+    assert "overlaps section" in reported_error(capsys)
+
+def test_tools_build_same_image(tmp_path, monkeypatch):
+    (tmp_path / "test.s").write_text(MAIN + LIBRARY + ".section 16\n.ascii \"data\"\n")
+    run_assembler(monkeypatch, tmp_path / "test.s", "-o", tmp_path / "test.bin")
+    binary = (tmp_path / "test.bin").read_bytes()
+    assert load_image(str(tmp_path / "test.s")) == binary
+    assert assemble_program(str(tmp_path / "test.s"))[0] == binary
+    assert run(binary).registers[5] == 0x55
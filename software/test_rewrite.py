@@ -0,0 +1,98 @@
+# Tests of the rewrite pass and the rewrite tables of the superoptimizer.
+# Run with `python -m pytest` in this directory.
+import json
+
+import pytest
+
+from assembler import (AssemblyParser, RewriteTable, build_binary, parse_register_list,
+                       rewrite_instructions)
+from emulator import Emulator
+from superopt import Cache, build_table
+from test_assembler import assemble, reported_error
+
+
+@pytest.fixture(scope="module")
+def table(tmp_path_factory) -> RewriteTable:
+    path = tmp_path_factory.mktemp("rewrite") / "table.json"
+    with open(path, "w") as f:
+        json.dump({"rewrites": build_table(2, Cache(None))}, f)
+    return RewriteTable.read(str(path))
+
+# Rewrite source text and return the binary.
+def rewrite(source: str, table: RewriteTable) -> bytes:
+    parser = AssemblyParser()
+    parser.parse_source(source, "test.s")
+    return build_binary(list(rewrite_instructions(parser.program, table)), "test.s")
+
+def run(binary: bytes) -> Emulator:
+    emulator = Emulator()
+    emulator.load_binary(binary)
+    emulator.run(1000)
+    assert emulator.halted
+    return emulator
+
+
+def test_table_from_superoptimizer():
+    assert build_table(2, Cache(None))["mv r0, r1; mv r0, r1"] == "mv r0, r1"
+
+def test_read_invalid_table(tmp_path, capsys):
+    (tmp_path / "table.json").write_text('{"rewrites": {"mv r0, r1": "add r0, r1"}}')
+    with pytest.raises(SystemExit):
+        RewriteTable.read(str(tmp_path / "table.json"))
+    assert "cannot read rewrite table" in reported_error(capsys)
+
+def test_rewrite_shortens_sequences(table):
+    source = "ldi r4, 7\nmv r3, r4\nmv r3, r4\nldi r2, 1\nldi r2, 9\nhalt\n"
+    binary = rewrite(source, table)
+    assert binary == assemble("ldi r4, 7\nmv r3, r4\nldi r2, 9\nhalt\n")
+    assert run(binary).registers == run(assemble(source)).registers
+
+def test_rewrite_stops_at_labels(table):
+    source = "ldi r2, 1\nhere:\nldi r2, 9\nhalt\n"
+    assert rewrite(source, table) == assemble(source)
+
+def test_rewrite_keeps_jumps_to_labels(table):
+    source = """
+        ldi r0, lo(target)
+        ldi r1, hi(target)
+        jabsr r0r1
+    target:
+        mv r2, r3
+        mv r2, r3
+        jreli end
+    end:
+        halt
+    """
+    binary = rewrite(source, table)
+    assert len(binary) == len(assemble(source)) - 2
+    assert run(binary).halted
+
+@pytest.mark.parametrize("source", [
+    "ldi r0, 4\nldi r1, 0\njabsr r0r1\n",
+    "ldi r0, lo(a)\nldi r1, hi(b)\njabsr r0r1\na:\nb:\nhalt\n",
+    "ldi r0, lo(a)\nldi r1, hi(a)\nldi r1, 0\njabsr r0r1\na:\nhalt\n",
+    "ldi r0, 2\njrelr r0\n",
+    "jreli 2\nnop\nhalt\n",
+])
+def test_rewrite_refuses_jumps_not_to_labels(source, table, capsys):
+    with pytest.raises(SystemExit):
+        rewrite(source, table)
+    assert "cannot rewrite a program with" in reported_error(capsys)
+
+def test_rewrite_follows_moved_label_halves(table):
+    source = "ldi r2, lo(a)\nldi r3, hi(a)\nmv r0, r2\nmv r1, r3\njabsr r0r1\na:\nhalt\n"
+    assert run(rewrite(source, table)).halted
+
+def test_rewrite_keeps_writes_to_kept_registers(table):
+    source = "ldi r4, 1\nldi r4, 2\nmv r3, r4\nmv r3, r4\nhalt\n"
+    parser = AssemblyParser()
+    parser.parse_source(source, "test.s")
+    binary = build_binary(list(rewrite_instructions(parser.program, table, {4})), "test.s")
+    assert binary == assemble("ldi r4, 1\nldi r4, 2\nmv r3, r4\nhalt\n")
+
+def test_parse_register_list(capsys):
+    assert parse_register_list("r5, r6") == {5, 6}
+    assert parse_register_list("") == set()
+    with pytest.raises(SystemExit):
+        parse_register_list("r7")
+    assert "invalid register 'r7'" in reported_error(capsys)
@@ -0,0 +1,29 @@
+# Tests of the ROM test runner. Run with `python -m pytest` in this directory.
+import pytest
+
+from romtest import parse_test
+from test_assembler import reported_error
+
+
+def test_parse_header(tmp_path):
+    (tmp_path / "test.s").write_text("# expect: r0=5 pc=0x12\n// max-steps: 0x100\nhalt\n")
+    test = parse_test(str(tmp_path / "test.s"))
+    assert test.expected == {"r0": 5, "pc": 0x12}
+    assert test.max_steps == 0x100
+
+def test_source_without_header(tmp_path):
+    (tmp_path / "test.s").write_text("# a comment\nhalt\n# expect: r0=5\n")
+    assert parse_test(str(tmp_path / "test.s")) is None
+
+@pytest.mark.parametrize("header, message", [
+    ("# expect: r0=5 r1=zz", "invalid number 'zz'"),
+    ("# max-steps: 1o0", "invalid number '1o0'"),
+    ("# expect: r9=1", "invalid expectation 'r9=1'"),
+])
+def test_invalid_header(tmp_path, capsys, header, message):
+    (tmp_path / "test.s").write_text(f"# a test\n{header}\nhalt\n")
+    with pytest.raises(SystemExit):
+        parse_test(str(tmp_path / "test.s"))
+    output = reported_error(capsys)
+    assert message in output
+    assert "test.s:2" in output
@@ -0,0 +1,60 @@
+# Tests of execution traces. Run with `python -m pytest` in this directory.
+import io
+
+import pytest
+
+from test_assembler import reported_error
+from test_emulator import LOOP, load, states
+from tracing import TraceBuffer, TraceFile
+
+
+# Run LOOP with a trace of the given capacity, and return the trace file.
+def record(tmp_path, capacity: int, steps: int) -> TraceFile:
+    emulator = load(LOOP)
+    emulator.trace = TraceBuffer(capacity)
+    emulator.run(steps)
+    emulator.trace.dump(str(tmp_path / "test.trace"), emulator.steps)
+    return TraceFile(str(tmp_path / "test.trace"))
+
+
+def test_capacity_must_be_positive():
+    with pytest.raises(ValueError):
+        TraceBuffer(0)
+
+@pytest.mark.parametrize("capacity, steps", [(1, 5), (8, 5), (8, 8), (8, 21), (7, 100)])
+def test_ring_keeps_last_instructions(tmp_path, capacity, steps):
+    trace = record(tmp_path, capacity, steps)
+    expected = states(LOOP, steps)
+    assert len(trace) == min(capacity, steps)
+    assert trace.first_step == steps - len(trace)
+    assert list(trace.pcs) == [expected[trace.first_step + i][0] for i in range(len(trace))]
+
+def test_writes_and_values(tmp_path):
+    trace = record(tmp_path, 16, 20)
+    expected = states(LOOP, 20)
+    # Every instruction of LOOP but the jump writes a register
+    assert len(trace.writes(3)) == 2
+    for register in range(4):
+        for i in trace.writes(register):
+            step = trace.first_step + i
+            assert expected[step + 1][1][register] == trace.values[i]
+    assert trace.writes(5) == []
+
+def test_jumps_taken(tmp_path):
+    trace = record(tmp_path, 16, 20)
+    # The jump at address 7 is the 8th and 16th instruction
+    assert [trace.first_step + i for i in trace.jumps()] == [7, 15]
+    assert trace.at(7) == trace.jumps()
+
+def test_print(tmp_path):
+    trace = record(tmp_path, 4, 10)
+    output = io.StringIO()
+    trace.print(trace.writes(1), file=output)
+    assert output.getvalue().split() == ["9", "0001:", "0120", "mv", "r1,", "r0",
+                                         "#", "r1", "=", "01"]
+
+def test_read_invalid_trace(tmp_path, capsys):
+    (tmp_path / "test.trace").write_bytes(b"TRC1" + bytes(20))
+    with pytest.raises(SystemExit):
+        TraceFile(str(tmp_path / "test.trace"))
+    assert "is not a trace file" in reported_error(capsys)
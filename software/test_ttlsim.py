@@ -0,0 +1,66 @@
+# Tests of the TTL simulator against the emulator. Run with `python -m pytest`
+# in this directory.
+import os
+import subprocess
+import sys
+
+import pytest
+
+import ttlsim
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+PROGRAMS = {
+    "moves": """
+        ldi r0, 0x12
+        mv r1, r0
+        ldi r6, 0xFF
+        mv r2, r6
+        halt
+    """,
+    "absolute jump": """
+        ldi r0, lo(function)
+        ldi r1, hi(function)
+        jabsr r0r1
+        ldi r3, 9
+    function:
+        mv r2, r0
+        ldi r4, 0xAB
+        jreli 2
+        ldi r5, 1
+        halt
+    """,
+    "relative jumps": """
+        ldi r3, 2
+        jreli forward
+    back:
+        ldi r5, 7
+        jrelr r3
+        ldi r4, 1
+        halt
+    forward:
+        ldi r6, 0x80
+        jreli back
+    """,
+}
+
+
+# The control ROM images compiled from the table of the repository.
+@pytest.fixture(scope="module")
+def microcode_dir(tmp_path_factory) -> str:
+    path = tmp_path_factory.mktemp("microcode")
+    subprocess.run([sys.executable, os.path.join(DIRECTORY, "microcode", "microcode_compiler.py"),
+                    os.path.join(DIRECTORY, "microcode", "microcode.txt"), "-o", str(path)],
+                   check=True)
+    return str(path)
+
+@pytest.mark.parametrize("name", PROGRAMS)
+def test_netlist_matches_emulator(name, microcode_dir, tmp_path, monkeypatch, capsys):
+    (tmp_path / "program.s").write_text(PROGRAMS[name])
+    monkeypatch.setattr("sys.argv", ["ttlsim.py", str(tmp_path / "program.s"), "--compare",
+                                     "--microcode-dir", microcode_dir])
+    ttlsim.main()
+    output = capsys.readouterr().out
+    assert "matches the emulator" in output
+    assert "(halted)" in output
+    assert "bus conflict" not in output
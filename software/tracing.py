@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# Execution traces of the emulator. While a `TraceBuffer` is attached to an
+# emulator, every executed instruction is recorded into preallocated arrays
+# that are used as a ring buffer, so only the last instructions are kept.
+#
+# Traces are saved in a compact binary file that is memory-mapped again for
+# queries:
+#
+#   header   "TRC1", entry count (u32), step of the first entry (u64)
+#   pcs      u16 per entry
+#   words    u16 per entry, the instruction encodings
+#   regs     i8 per entry, the register written or -1
+#   values   u8 per entry, the value written to the register
+#
+# Entries are stored oldest first and all values are little endian.
+import argparse
+import mmap
+import struct
+import sys
+from array import array
+from typing import *
+
+from assembler import AssemblyPrinter, error
+from disassembler import decode_instruction
+from emulator import (NUM_REGISTERS, OP_JUMP_ABS, OP_JUMP_IMM, OP_JUMP_REG,
+                      Emulator, decode_table, load_image)
+
+TRACE_MAGIC = b"TRC1"
+TRACE_HEADER = struct.Struct("<4sIQ")
+
+
+# A ring buffer of the last `capacity` executed instructions.
+class TraceBuffer:
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("a trace needs room for at least one instruction")
+        self.capacity = capacity
+        self.pcs = array("H", bytes(2 * capacity))
+        self.encodings = array("H", bytes(2 * capacity))
+        self.registers = array("b", bytes(capacity))
+        self.values = array("B", bytes(capacity))
+        # Index of the next entry to write
+        self.position = 0
+        # Number of instructions recorded, including the overwritten ones
+        self.count = 0
+
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+
+    # A column of the buffer with the entries in order, oldest first.
+    def ordered(self, column: array) -> array:
+        if self.count < self.capacity:
+            return column[:self.count]
+        return column[self.position:] + column[:self.position]
+
+    # Save the buffer to a file. `end_step` is the number of instructions the
+    # emulator has executed after the last entry.
+    def dump(self, path: str, end_step: int):
+        columns = [self.ordered(column)
+                   for column in (self.pcs, self.encodings, self.registers, self.values)]
+        if sys.byteorder != "little":
+            for column in columns:
+                column.byteswap()
+        with open(path, "wb") as f:
+            f.write(TRACE_HEADER.pack(TRACE_MAGIC, len(self), end_step - len(self)))
+            for column in columns:
+                column.tofile(f)
+
+
+# A trace file, memory-mapped for queries. The columns are memoryviews of
+# the mapped file.
+class TraceFile:
+    def __init__(self, path: str):
+        try:
+            with open(path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            error(f"cannot read trace '{path}': {e}")
+        if len(self.map) < TRACE_HEADER.size:
+            error(f"'{path}' is not a trace file")
+        magic, count, self.first_step = TRACE_HEADER.unpack_from(self.map)
+        if magic != TRACE_MAGIC or len(self.map) != TRACE_HEADER.size + 6 * count:
+            error(f"'{path}' is not a trace file")
+        view = memoryview(self.map)[TRACE_HEADER.size:]
+        self.pcs = self.column(view[0:2 * count], "H")
+        self.encodings = self.column(view[2 * count:4 * count], "H")
+        self.registers = self.column(view[4 * count:5 * count], "b")
+        self.values = self.column(view[5 * count:6 * count], "B")
+
+    @staticmethod
+    def column(view: memoryview, typecode: str) -> Sequence[int]:
+        if sys.byteorder != "little" and typecode == "H":
+            words = array("H", view)
+            words.byteswap()
+            return words
+        return view.cast(typecode)
+
+    def __len__(self) -> int:
+        return len(self.pcs)
+
+    # Indices of the entries that wrote a register.
+    def writes(self, register: int) -> List[int]:
+        registers = self.registers
+        return [i for i in range(len(registers)) if registers[i] == register]
+
+    # Indices of the entries that jumped.
+    def jumps(self) -> List[int]:
+        decode = decode_table()
+        kinds = (OP_JUMP_IMM, OP_JUMP_REG, OP_JUMP_ABS)
+        encodings = self.encodings
+        return [i for i in range(len(encodings)) if decode[encodings[i]][0] in kinds]
+
+    # Indices of the entries that executed an instruction at an address.
+    def at(self, address: int) -> List[int]:
+        pcs = self.pcs
+        return [i for i in range(len(pcs)) if pcs[i] == address]
+
+    # Print entries as assembly, with the step of each entry and the
+    # register value it wrote.
+    def print(self, indices: Iterable[int], file=sys.stdout):
+        indices = list(indices)
+        program = [decode_instruction(self.encodings[i], self.pcs[i]) for i in indices]
+        lines = AssemblyPrinter(program).print().split("\n")
+        for i, line in zip(indices, lines):
+            write = ""
+            if self.registers[i] >= 0:
+                write = f"  # r{self.registers[i]} = {self.values[i]:02X}"
+            file.write(f"{self.first_step + i:>10d}  {line.rstrip()}{write}\n")
+
+
+def parse_register(text: str) -> int:
+    if len(text) != 2 or text[0] != "r" or not text[1].isdigit() or int(text[1]) >= NUM_REGISTERS:
+        raise argparse.ArgumentTypeError(f"expected a register r0 to r{NUM_REGISTERS - 1}")
+    return int(text[1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record",
+        help="run a program and save the last executed instructions")
+    record.add_argument("input", metavar="INPUT",
+        help="binary image or assembly source to run")
+    record.add_argument("-o", "--output", type=str, required=True,
+        help="trace file to write")
+    record.add_argument("-n", "--steps", type=int, default=10**7,
+        help="maximum number of instructions to execute")
+    record.add_argument("--size", type=int, default=65536,
+        help="number of instructions to keep")
+
+    query = commands.add_parser("query", help="print instructions of a trace")
+    query.add_argument("trace", metavar="TRACE",
+        help="trace file to read")
+    query.add_argument("--writes", type=parse_register, metavar="REG",
+        help="only print instructions that wrote REG")
+    query.add_argument("--jumps", action="store_true",
+        help="only print jumps")
+    query.add_argument("--at", type=lambda x: int(x, 0), metavar="ADDRESS",
+        help="only print instructions executed at ADDRESS")
+    query.add_argument("--last", type=int,
+        help="only print the last LAST matching instructions")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        if args.size < 1:
+            error(f"invalid trace size {args.size}", "expected at least 1 instruction")
+        emulator = Emulator()
+        emulator.load_binary(load_image(args.input))
+        emulator.trace = TraceBuffer(args.size)
+        emulator.run(args.steps)
+        emulator.trace.dump(args.output, emulator.steps)
+        emulator.print_state()
+
+    if args.command == "query":
+        trace = TraceFile(args.trace)
+        indices = range(len(trace))
+        if args.writes is not None:
+            indices = trace.writes(args.writes)
+        if args.jumps:
+            indices = sorted(set(indices) & set(trace.jumps()))
+        if args.at is not None:
+            indices = sorted(set(indices) & set(trace.at(args.at)))
+        if args.last is not None:
+            indices = indices[len(indices) - min(args.last, len(indices)):]
+        trace.print(indices)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+# An event-driven simulator of the CPU at the level of its TTL chips. The
+# chips and their connections are read from a netlist (see `cpu.net`).
+#
+# Signals are grouped into nets of up to 16 bits, and the value of a net is
+# a single integer, so a chip drives or samples a whole bus in one
+# operation. When the value driven onto a net changes, the chips connected
+# to it are evaluated again, and the outputs they change are scheduled after
+# the chip's propagation delay on a timing wheel.
+#
+# With `--compare`, the simulated CPU runs next to the instruction level
+# emulator, and the registers and pc are compared after every instruction.
+import argparse
+import heapq
+import os
+import re
+import sys
+import time
+from typing import *
+
+from assembler import error
+from emulator import NUM_REGISTERS, Emulator, load_image
+
+
+# A bus or a single signal. Bits that no chip drives read as 0.
+class Net:
+    __slots__ = ("name", "width", "value", "drivers", "fanout")
+
+    def __init__(self, name: str, width: int):
+        self.name = name
+        self.width = width
+        self.value = 0
+        self.drivers: List[Output] = []
+        # Chips with an input connected to this net
+        self.fanout: List[Chip] = []
+
+    def resolve(self) -> int:
+        value = 0
+        for driver in self.drivers:
+            if driver.value is not None:
+                value |= (driver.value & driver.mask) << driver.lo
+        return value
+
+    # Drivers that are enabled at the same time and overlap
+    def conflicts(self) -> List["Output"]:
+        enabled = [d for d in self.drivers if d.value is not None]
+        used = 0
+        for driver in enabled:
+            if used & (driver.mask << driver.lo):
+                return enabled
+            used |= driver.mask << driver.lo
+        return []
+
+# An output of a chip, connected to a range of bits of a net. A value of
+# None means the output is not driven (high impedance).
+class Output:
+    __slots__ = ("chip", "net", "lo", "mask", "value", "scheduled")
+
+    def __init__(self, chip: Optional["Chip"], net: Net, lo: int, width: int):
+        self.chip = chip
+        self.net = net
+        self.lo = lo
+        self.mask = (1 << width) - 1
+        self.value: Optional[int] = None
+        # The value of the latest scheduled change
+        self.scheduled: Optional[int] = None
+
+
+# A group of identical chips, like four 74161 counters cascaded into a 16 bit
+# counter. The ports of a group are as wide as all of its chips together.
+class Chip:
+    # Propagation delay in ns
+    DELAY = 10
+
+    def __init__(self, name: str, width: int, params: Dict[str, str]):
+        self.name = name
+        self.width = width
+        self.params = params
+        # For every input, the pieces it is made of as
+        # (net, low bit, mask, constant, shift) tuples
+        self.inputs: Dict[str, List[Tuple[Optional[Net], int, int, int, int]]] = {}
+        self.outputs: Dict[str, Output] = {}
+        self.sim: Optional[Simulator] = None
+
+    # Names and widths of the inputs and outputs.
+    def input_ports(self) -> Dict[str, int]:
+        return {}
+
+    def output_ports(self) -> Dict[str, int]:
+        return {}
+
+    def read(self, port: str) -> int:
+        value = 0
+        for net, lo, mask, const, shift in self.inputs[port]:
+            value |= (const if net is None else (net.value >> lo) & mask) << shift
+        return value
+
+    def drive(self, port: str, value: Optional[int]):
+        self.sim.drive(self.outputs[port], value, self.DELAY)
+
+    def evaluate(self):
+        pass
+
+# A clocked chip that samples its inputs on the rising edge of `clk`.
+class ClockedChip(Chip):
+    def __init__(self, name: str, width: int, params: Dict[str, str]):
+        super().__init__(name, width, params)
+        self.state = 0
+        self.last_clock = 0
+
+    def rising_edge(self) -> bool:
+        clock = self.read("clk")
+        rising = clock and not self.last_clock
+        self.last_clock = clock
+        return rising
+
+
+# Synchronous 4 bit binary counters. The 74161 clears asynchronously and the
+# 74163 on the next clock edge. Loading and counting both happen on the
+# clock edge; `en` stands for both count enable inputs.
+class Counter74161(ClockedChip):
+    DELAY = 20
+    SYNC_CLEAR = False
+
+    def input_ports(self):
+        return {"clk": 1, "clr_n": 1, "load_n": 1, "en": 1, "d": self.width}
+
+    def output_ports(self):
+        return {"q": self.width}
+
+    def evaluate(self):
+        rising = self.rising_edge()
+        if not self.read("clr_n") and not self.SYNC_CLEAR:
+            self.state = 0
+        elif rising:
+            if not self.read("clr_n"):
+                self.state = 0
+            elif not self.read("load_n"):
+                self.state = self.read("d")
+            elif self.read("en"):
+                self.state = (self.state + 1) & ((1 << self.width) - 1)
+        self.drive("q", self.state)
+
+class Counter74163(Counter74161):
+    SYNC_CLEAR = True
+
+# Octal D flip-flops with an active-low clock enable.
+class Register74377(ClockedChip):
+    DELAY = 17
+
+    def input_ports(self):
+        return {"clk": 1, "en_n": 1, "d": self.width}
+
+    def output_ports(self):
+        return {"q": self.width}
+
+    def evaluate(self):
+        if self.rising_edge() and not self.read("en_n"):
+            self.state = self.read("d")
+        self.drive("q", self.state)
+
+# Octal bus transceivers, wired to always drive from A to B.
+class Transceiver74245(Chip):
+    DELAY = 8
+
+    def input_ports(self):
+        return {"a": self.width, "oe_n": 1}
+
+    def output_ports(self):
+        return {"b": self.width}
+
+    def evaluate(self):
+        self.drive("b", None if self.read("oe_n") else self.read("a"))
+
+# 3 to 8 line decoder with active-low outputs.
+class Decoder74138(Chip):
+    DELAY = 15
+
+    def input_ports(self):
+        return {"a": 3, "g1": 1, "g2a_n": 1, "g2b_n": 1}
+
+    def output_ports(self):
+        return {"y_n": 8}
+
+    def evaluate(self):
+        enabled = self.read("g1") and not self.read("g2a_n") and not self.read("g2b_n")
+        self.drive("y_n", 0xFF ^ (1 << self.read("a")) if enabled else 0xFF)
+
+class Inverter7404(Chip):
+    DELAY = 8
+
+    def input_ports(self):
+        return {"a": self.width}
+
+    def output_ports(self):
+        return {"y": self.width}
+
+    def evaluate(self):
+        self.drive("y", ~self.read("a") & ((1 << self.width) - 1))
+
+class Nor7402(Chip):
+    DELAY = 8
+
+    def input_ports(self):
+        return {"a": self.width, "b": self.width}
+
+    def output_ports(self):
+        return {"y": self.width}
+
+    def evaluate(self):
+        self.drive("y", ~(self.read("a") | self.read("b")) & ((1 << self.width) - 1))
+
+# 2 to 1 line multiplexers. Selects `b` if `s` is high.
+class Mux74157(Chip):
+    DELAY = 12
+
+    def input_ports(self):
+        return {"a": self.width, "b": self.width, "s": 1}
+
+    def output_ports(self):
+        return {"y": self.width}
+
+    def evaluate(self):
+        self.drive("y", self.read("b") if self.read("s") else self.read("a"))
+
+# 4 bit full adders. The carry ripples through the chips of a group, so the
+# delay grows with the width.
+class Adder74283(Chip):
+    def __init__(self, name: str, width: int, params: Dict[str, str]):
+        super().__init__(name, width, params)
+        self.DELAY = 16 + 8 * (width // 4 - 1)
+
+    def input_ports(self):
+        return {"a": self.width, "b": self.width, "cin": 1}
+
+    def output_ports(self):
+        return {"s": self.width, "cout": 1}
+
+    def evaluate(self):
+        total = self.read("a") + self.read("b") + self.read("cin")
+        self.drive("s", total & ((1 << self.width) - 1))
+        self.drive("cout", total >> self.width)
+
+# 32K x 8 EEPROM with its outputs always enabled. The contents are given by
+# the `image` parameter, which names one of the images passed to the
+# simulator.
+class Eeprom28C256(Chip):
+    DELAY = 150
+
+    def input_ports(self):
+        return {"a": 15}
+
+    def output_ports(self):
+        return {"d": 8}
+
+    def evaluate(self):
+        address = self.read("a")
+        self.drive("d", self.data[address] if address < len(self.data) else 0xFF)
+
+
+CHIP_TYPES: Dict[str, Type[Chip]] = {
+    "74161": Counter74161,
+    "74163": Counter74163,
+    "74377": Register74377,
+    "74245": Transceiver74245,
+    "74138": Decoder74138,
+    "7404": Inverter7404,
+    "7402": Nor7402,
+    "74157": Mux74157,
+    "74283": Adder74283,
+    "28C256": Eeprom28C256,
+}
+
+
+# A square wave on a net, starting low.
+class Clock:
+    def __init__(self, net: Net, period: int):
+        self.output = Output(None, net, 0, 1)
+        self.half_period = period // 2
+        net.drivers.append(self.output)
+
+
+# A parsed netlist.
+class Netlist:
+    def __init__(self):
+        self.nets: Dict[str, Net] = {}
+        self.chips: List[Chip] = []
+        self.clock: Optional[Clock] = None
+
+# Parse a netlist file. `images` holds the contents of the EEPROMs by name.
+def parse_netlist(file: str, images: Dict[str, bytes]) -> Netlist:
+    netlist = Netlist()
+    with open(file, "r") as f:
+        lines = f.read().split("\n")
+    for line_num, line in enumerate(lines, 1):
+        def fail(message):
+            error(message, f"{file}:{line_num}", "", f"  {line}")
+        words = line.split("#")[0].split()
+        if not words:
+            continue
+
+        if words[0] == "net":
+            if len(words) != 3 or not words[2].isdigit() or not 1 <= int(words[2]) <= 64:
+                fail("expected `net NAME WIDTH`")
+            if words[1] in netlist.nets:
+                fail(f"net '{words[1]}' is already defined")
+            netlist.nets[words[1]] = Net(words[1], int(words[2]))
+            continue
+
+        if words[0] == "clock":
+            if len(words) != 3 or words[1] not in netlist.nets or not words[2].isdigit():
+                fail("expected `clock NET PERIOD`")
+            netlist.clock = Clock(netlist.nets[words[1]], int(words[2]))
+            continue
+
+        if words[0] != "chip" or len(words) < 3:
+            fail("expected `net`, `clock` or `chip`")
+        name, type_name = words[1], words[2]
+        if type_name not in CHIP_TYPES:
+            fail(f"unknown chip type '{type_name}'")
+        params = {}
+        bindings = {}
+        for word in words[3:]:
+            key, _, value = word.partition("=")
+            if not value:
+                fail(f"expected PORT=NETS or PARAMETER=VALUE, found '{word}'")
+            (params if key in ("width", "image") else bindings)[key] = value
+        chip = CHIP_TYPES[type_name](name, int(params.get("width", 8)), params)
+        if isinstance(chip, Eeprom28C256):
+            if params.get("image") not in images:
+                fail(f"unknown image '{params.get('image')}'; "
+                     f"expected one of {', '.join(sorted(images))}")
+            chip.data = images[params["image"]]
+
+        inputs, outputs = chip.input_ports(), chip.output_ports()
+        for port in list(inputs) + list(outputs):
+            if port not in bindings:
+                fail(f"port '{port}' of chip '{name}' is not connected")
+        for port, text in bindings.items():
+            if port in inputs:
+                pieces = parse_input_binding(netlist, text, fail)
+                width = sum(piece[2].bit_length() for piece in pieces)
+                if width != inputs[port]:
+                    fail(f"port '{port}' is {inputs[port]} bits wide, but connected to {width} bits")
+                shift = 0
+                for net, lo, mask, const in pieces:
+                    chip.inputs.setdefault(port, []).append((net, lo, mask, const, shift))
+                    shift += mask.bit_length()
+                    if net is not None and chip not in net.fanout:
+                        net.fanout.append(chip)
+            elif port in outputs:
+                net, lo, width = parse_output_binding(netlist, text, fail)
+                if width != outputs[port]:
+                    fail(f"port '{port}' is {outputs[port]} bits wide, but connected to {width} bits")
+                output = Output(chip, net, lo, width)
+                net.drivers.append(output)
+                chip.outputs[port] = output
+            else:
+                fail(f"chip type '{type_name}' has no port '{port}'")
+        netlist.chips.append(chip)
+    if netlist.clock is None:
+        error(f"no clock defined in '{file}'")
+    return netlist
+
+# Parse a net reference like `bus`, `bus[3]` or `bus[0:8]`. Returns the net,
+# the low bit and the width.
+def parse_net_slice(netlist: Netlist, text: str, fail) -> Tuple[Net, int, int]:
+    m = re.fullmatch(r'(\w+)(?:\[(\d+)(?::(\d+))?\])?', text)
+    if not m or m[1] not in netlist.nets:
+        fail(f"unknown net '{text}'")
+    net = netlist.nets[m[1]]
+    lo = int(m[2]) if m[2] else 0
+    hi = int(m[3]) if m[3] else lo + 1 if m[2] else net.width
+    if not lo < hi <= net.width:
+        fail(f"bits of '{text}' out of range; net '{net.name}' is {net.width} bits wide")
+    return net, lo, hi - lo
+
+# Parse the nets connected to an input: a comma separated list of net
+# references and the constants 0 and 1, lowest bits first. Any element can be
+# repeated with `*N`, as in `data[7]*8` to sign extend a bus.
+def parse_input_binding(netlist: Netlist, text: str, fail) -> List[Tuple[Optional[Net], int, int, int]]:
+    pieces = []
+    for element in text.split(","):
+        element, _, count = element.partition("*")
+        for _ in range(int(count) if count.isdigit() else 1):
+            if element in ("0", "1"):
+                pieces.append((None, 0, 1, int(element)))
+            else:
+                net, lo, width = parse_net_slice(netlist, element, fail)
+                pieces.append((net, lo, (1 << width) - 1, 0))
+    return pieces
+
+def parse_output_binding(netlist: Netlist, text: str, fail) -> Tuple[Net, int, int]:
+    return parse_net_slice(netlist, text, fail)
+
+
+# The event-driven simulator. Events are changes of outputs, kept in a timing
+# wheel with one slot per ns. Slots are reused as time advances, which is
+# safe as long as no event is scheduled further ahead than the size of the
+# wheel. A heap holds the times of the occupied slots, so empty slots are
+# skipped without visiting them.
+class Simulator:
+    def __init__(self, netlist: Netlist):
+        self.netlist = netlist
+        self.clock = netlist.clock
+        longest = max([self.clock.half_period] + [chip.DELAY for chip in netlist.chips])
+        self.wheel_size = 1 << longest.bit_length()
+        self.wheel: List[List[Tuple[Output, Optional[int]]]] = [[] for _ in range(self.wheel_size)]
+        self.times: List[int] = []
+        self.now = 0
+        self.events = 0
+        # Number of rising clock edges so far
+        self.cycles = 0
+        # Functions called on every rising clock edge, before the clocked
+        # chips sample their inputs
+        self.on_clock: List[Callable[["Simulator"], None]] = []
+        # Buses with more than one enabled driver at a rising clock edge,
+        # as (cycle, net name, chip names) tuples
+        self.conflicts: List[Tuple[int, str, List[str]]] = []
+        self.shared_nets = [net for net in netlist.nets.values() if len(net.drivers) > 1]
+
+        for chip in netlist.chips:
+            chip.sim = self
+            chip.evaluate()
+        self.schedule(self.clock.half_period, self.clock.output, 1)
+
+    def net(self, name: str) -> int:
+        return self.netlist.nets[name].value
+
+    def schedule(self, when: int, output: Output, value: Optional[int]):
+        slot = self.wheel[when & (self.wheel_size - 1)]
+        if not slot:
+            heapq.heappush(self.times, when)
+        slot.append((output, value))
+
+    def drive(self, output: Output, value: Optional[int], delay: int):
+        if value == output.scheduled:
+            return
+        output.scheduled = value
+        self.schedule(self.now + delay, output, value)
+
+    # Process all events up to and including the time `end`.
+    def run_until(self, end: int):
+        wheel = self.wheel
+        mask = self.wheel_size - 1
+        times = self.times
+        clock = self.clock.output
+        while times and times[0] <= end:
+            self.now = now = heapq.heappop(times)
+            events = wheel[now & mask]
+            wheel[now & mask] = []
+            self.events += len(events)
+            dirty = []
+            for output, value in events:
+                if output is clock:
+                    self.schedule(now + self.clock.half_period, clock, 1 - value)
+                    if value:
+                        self.clock_edge()
+                output.value = value
+                net = output.net
+                new = net.resolve() if len(net.drivers) > 1 else (
+                    0 if value is None else value & output.mask) << output.lo
+                if new != net.value:
+                    net.value = new
+                    dirty += net.fanout
+            for chip in dict.fromkeys(dirty):
+                chip.evaluate()
+
+    def clock_edge(self):
+        for callback in self.on_clock:
+            callback(self)
+        for net in self.shared_nets:
+            if enabled := net.conflicts():
+                self.conflicts.append((self.cycles, net.name, [d.chip.name for d in enabled]))
+        self.cycles += 1
+
+    # Run for a number of clock cycles.
+    def run_cycles(self, cycles: int):
+        target = self.cycles + cycles
+        while self.cycles < target and self.times:
+            self.run_until(self.times[0])
+
+
+# Compares the state of the simulated CPU against the emulator after every
+# instruction. The register nets are `r0` to `r6`, the program counter `pc`
+# and the step counter `step`.
+class Comparison:
+    def __init__(self, emulator: Emulator):
+        self.emulator = emulator
+        self.mismatch: Optional[str] = None
+        self.done = False
+
+    def __call__(self, sim: Simulator):
+        if self.mismatch or self.done:
+            return
+        if sim.net("step") & 0x7:
+            return
+        emulator = self.emulator
+        if sim.cycles != emulator.cycles:
+            self.mismatch = (f"instruction boundary after {sim.cycles} cycles, but the "
+                             f"emulator needs {emulator.cycles} cycles for {emulator.steps} instructions")
+            return
+        hardware = [sim.net(f"r{i}") for i in range(NUM_REGISTERS)] + [sim.net("pc")]
+        expected = emulator.registers + [emulator.pc]
+        if hardware != expected:
+            names = [f"r{i}" for i in range(NUM_REGISTERS)] + ["pc"]
+            self.mismatch = f"state differs after {emulator.steps} instructions: " + ", ".join(
+                f"{n} = {h:02X}, expected {e:02X}"
+                for n, h, e in zip(names, hardware, expected) if h != e)
+            return
+        if emulator.halted:
+            self.done = True
+            return
+        emulator.execute(1)
+
+
+def main():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input", metavar="INPUT",
+        help="binary image or assembly source to run")
+    parser.add_argument("--netlist", type=str, default=os.path.join(directory, "cpu.net"),
+        help="netlist of the CPU (default: cpu.net)")
+    parser.add_argument("--microcode-dir", type=str,
+        default=os.path.join(directory, "microcode"),
+        help="directory with the control ROM images written by microcode_compiler.py")
+    parser.add_argument("-n", "--cycles", type=int, default=10000,
+        help="number of clock cycles to simulate")
+    parser.add_argument("--compare", action="store_true",
+        help="compare the registers against the emulator after every instruction")
+    args = parser.parse_args()
+
+    binary = load_image(args.input)
+    images = {
+        "program_low": bytes(binary[0::2]),
+        "program_high": bytes(binary[1::2]),
+    }
+    for rom in ("left", "right"):
+        path = os.path.join(args.microcode_dir, f"microcode_{rom}.bin")
+        try:
+            with open(path, "rb") as f:
+                images[f"microcode_{rom}"] = f.read()
+        except OSError as e:
+            error(f"cannot read '{path}': {e.strerror}",
+                  "build the control ROM images with microcode/microcode_compiler.py")
+
+    sim = Simulator(parse_netlist(args.netlist, images))
+    comparison = None
+    if args.compare:
+        emulator = Emulator()
+        emulator.load_binary(binary)
+        comparison = Comparison(emulator)
+        sim.on_clock.append(comparison)
+
+    start = time.perf_counter()
+    while sim.cycles < args.cycles and not (comparison and (comparison.mismatch or comparison.done)):
+        sim.run_cycles(min(100, args.cycles - sim.cycles))
+    elapsed = time.perf_counter() - start
+
+    registers = " ".join(f"r{i}={sim.net(f'r{i}'):02X}" for i in range(NUM_REGISTERS))
+    print(f"pc={sim.net('pc'):04X} {registers} cycles={sim.cycles}")
+    print(f"{sim.events} events in {elapsed:.2f}s "
+          f"({sim.cycles / elapsed if elapsed else 0:.0f} cycles/s)")
+    for cycle, net, drivers in sim.conflicts[:10]:
+        print(f"bus conflict on '{net}' in cycle {cycle}: {', '.join(drivers)}")
+    if comparison:
+        if comparison.mismatch:
+            print(f"mismatch: {comparison.mismatch}")
+        else:
+            state = "halted" if comparison.done else "running"
+            print(f"matches the emulator for {comparison.emulator.steps} instructions ({state})")
+    if sim.conflicts or (comparison and comparison.mismatch):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()